@@ -0,0 +1,132 @@
+#!/bin/python3
+# -*- coding: utf-8 -*-
+'''
+###############################################################################
+##
+## 88        88 88
+## 88        88 88
+## 88        88 88
+## 88        88 88,dPPYba,   ,adPPYba,   ,adPPYba,
+## 88        88 88P'    "8a a8"     "8a a8P_____88
+## 88        88 88       d8 8b       d8 8PP"""""""
+## Y8a.    .a8P 88b,   ,a8" "8a,   ,a8" "8b,   ,aa
+##  `"Y8888Y"'  `"8Ybbd8"'   `"YbbdP"'   `"Ybbd8"'
+##
+###############################################################################
+Microbenchmark of the chat message dispatch.
+Compares the former regex if/elif chain of KeybaseBot.__call__ with
+CommandRouter.resolve, on regular chat traffic (messages that are not commands)
+and on commands, and reports the cost per message.
+'''
+from __future__ import annotations
+import os
+import sys
+import argparse
+import re
+import time
+
+this_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(this_dir, '..', 'tools'))
+
+from command_router import Arg, CommandRouter
+
+from typing import Callable, List
+
+ALLOWED_USERS = ['admin']
+CHAT_TRAFFIC = [
+    "Printer 3 is done, can someone take the part out?",
+    "ok",
+    "The new PLA spool is on the shelf",
+    "/giphy printer",
+    "Did anyone change the nozzle on printhive-2 ?",
+]
+COMMAND_TRAFFIC = [
+    "/uboe_bot status",
+    "/uboe_bot camera id=1 rotate=90 max_size=640",
+    "/uboe_bot config set log_level debug",
+    "/uboe_bot debug notifications",
+]
+
+
+def legacy_dispatch(chat_msg: str, sender: str) -> str:
+    '''
+    Decision part of the former KeybaseBot.__call__ (without running the commands)
+    '''
+    bot_command = re.match(r'(^/uboe_bot)', chat_msg)
+    debug = False
+    msg = "Command not recognized. Try `/uboe_bot help`"
+    match = re.match(r'(^/uboe_bot)\s+(.*$)', chat_msg)
+    if bot_command:
+        if re.match(r'(^/uboe_bot)\s+(debug)\s+(.*$)', chat_msg):
+            if sender in ALLOWED_USERS:
+                match = re.match(r'(^/uboe_bot)\s+debug\s+(.*$)', chat_msg)
+                debug = True
+            else:
+                msg = "You are not allowed to enable debug mode"
+        if match:
+            command = match.group(2)
+            if command == "help":
+                msg = "help"
+            elif command == "status":
+                msg = "status"
+            elif command == "snapshot":
+                msg = "snapshot"
+            elif re.match(r'(^camera)', command):
+                arguments = re.match(r'.*?id=(\d+)\s+rotate=(\d+)(?:\s+max_size=(\d+))?', command)
+                msg = "camera" if arguments else "malformed"
+            elif re.match(r'^config', command):
+                config_set = re.match(r'^config\s+set\s+(\w+)\s+(\S+)$', command)
+                msg = "config set" if config_set else "config"
+            elif command == "emergency_stop":
+                msg = "emergency_stop"
+            elif debug and command in ("moonraker", "reconnect_moonraker", "emulate_job", "notifications", "snapshots", "commands"):
+                msg = command
+    return msg
+
+
+def build_router() -> CommandRouter:
+    '''
+    @return: Router with the same commands as KeybaseBot
+    '''
+    router = CommandRouter('/uboe_bot')
+
+    async def handler(*args, **kwargs) -> None:
+        pass
+
+    for verb in ('help', 'status', 'snapshot', 'emergency_stop', 'config', '🌴ping🌴'):
+        router.command(verb, help=verb)(handler)
+    router.command(
+        'camera', Arg('id', int, keyword=True), Arg('rotate', int, keyword=True), Arg('max_size', int, keyword=True, optional=True)
+    )(handler)
+    router.command('config set', Arg('key'), Arg('value'), restricted="denied")(handler)
+    for verb in ("moonraker", "reconnect_moonraker", "emulate_job", "notifications", "snapshots", "commands"):
+        router.command(verb, debug=True)(handler)
+    return router
+
+
+def measure(dispatch: Callable[[str, str], object], messages: List[str], repeat: int) -> float:
+    '''
+    @return: Average cost of one dispatch in nanoseconds
+    '''
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for message in messages:
+            dispatch(message, 'admin')
+    return (time.perf_counter() - start) / (repeat * len(messages)) * 1e9
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Chat command dispatch microbenchmark")
+    parser.add_argument('--repeat', type=int, default=100000, help='Passes over each message set')
+    args = parser.parse_args()
+
+    router = build_router()
+    resolve = lambda text, sender: router.resolve(text, sender, ALLOWED_USERS)
+    print(f"{'traffic':<10} {'dispatch':<10} {'ns/message':>12}")
+    for name, messages in (('chat', CHAT_TRAFFIC), ('commands', COMMAND_TRAFFIC)):
+        for label, dispatch in (('legacy', legacy_dispatch), ('router', resolve)):
+            print(f"{name:<10} {label:<10} {measure(dispatch, messages, args.repeat):>12.0f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,191 @@
+#!/bin/python3
+# -*- coding: utf-8 -*-
+'''
+###############################################################################
+##
+## 88        88 88
+## 88        88 88
+## 88        88 88
+## 88        88 88,dPPYba,   ,adPPYba,   ,adPPYba,
+## 88        88 88P'    "8a a8"     "8a a8P_____88
+## 88        88 88       d8 8b       d8 8PP"""""""
+## Y8a.    .a8P 88b,   ,a8" "8a,   ,a8" "8b,   ,aa
+##  `"Y8888Y"'  `"8Ybbd8"'   `"YbbdP"'   `"Ybbd8"'
+##
+###############################################################################
+End to end benchmark of the bot on replayed traffic, without a printer or a
+Keybase account. The bot runs in process against:
+- FakeMoonraker, replaying bench/data/moonraker_capture.jsonl at --event-rate
+  and reporting finished jobs (bench/data/history_changed.jsonl) at --job-rate
+- FakeWebcam, serving the snapshots
+- FakeBot, standing for the pykeybasebot session, which receives the
+  notifications and /uboe_bot status commands sent at --command-rate
+Reported: notification to chat latency, command latency percentiles, CPU
+usage and RSS of the process.
+'''
+from __future__ import annotations
+import os
+import sys
+import asyncio
+import argparse
+import json
+import logging
+import re
+import resource
+import tempfile
+import time
+
+this_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(this_dir, '..', 'tools'))
+
+from bench_framer import CAPTURE, load_capture
+from fake_keybase import FakeBot
+from fake_moonraker import FakeMoonraker
+from fake_webcam import FakeWebcam
+
+from typing import Any, Dict, List
+
+HISTORY_CHANGED = os.path.join(this_dir, 'data', 'history_changed.jsonl')
+# notifications raised by the job events only, the replayed traffic must not add any
+REPLAYED_METHODS = ('notify_status_update', 'notify_proc_stat_update', 'notify_gcode_response')
+JOB_RE = re.compile(r'Job bench_(\d+)\.gcode')
+
+
+def percentile(samples: List[float], q: float) -> float:
+    return samples[min(len(samples) - 1, int(len(samples) * q))]
+
+
+def rss_bytes() -> int:
+    with open('/proc/self/statm', 'r') as file:
+        return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def completed_job() -> Dict[str, Any]:
+    with open(HISTORY_CHANGED, 'r') as file:
+        samples = [json.loads(line) for line in file if line.strip()]
+    return next(s for s in samples if s['params'][0]['job']['status'] == 'completed')
+
+
+def print_latencies(name: str, samples: List[float]) -> None:
+    if not samples:
+        print(f"{name:<24} {'no samples':>10}")
+        return
+    samples = sorted(samples)
+    print(f"{name:<24} {len(samples):>6} {percentile(samples, .5):>9.1f} {percentile(samples, .9):>9.1f} "
+          f"{percentile(samples, .99):>9.1f} {samples[-1]:>9.1f}")
+
+
+async def run(args: argparse.Namespace) -> None:
+    import KeybaseBot as kb
+    logging.basicConfig(level=logging.WARNING)
+    tmp = tempfile.mkdtemp()
+    # every event is sent on its own, the digest and the policy would merge or drop them
+    with open(os.path.join(tmp, 'service.json'), 'w') as file:
+        json.dump({'notify_digest_window' : 0, 'notify_policy' : {}, 'metrics_listen' : ''}, file)
+    with open(os.path.join(tmp, 'camera.json'), 'w') as file:
+        json.dump({'1' : {'rotate' : 0, 'use' : ['default', 'status']}}, file)
+    kb.ServiceConfig._path = os.path.join(tmp, 'service.json')
+
+    moonraker = FakeMoonraker(os.path.join(tmp, 'moonraker.sock'), latency=args.moonraker_latency)
+    webcam = FakeWebcam(latency=args.webcam_latency, size=args.image_size)
+    await moonraker.start()
+    await webcam.start()
+    bot = FakeBot(send_latency=args.keybase_latency)
+    printer = kb.KeybaseBot(
+        moonraker.sockpath, presets=[{'method' : 'printer.info'}], paperkey=None, logger=logging.getLogger('bench'),
+        bot=bot, name='bench', camera_config=os.path.join(tmp, 'camera.json'), http_host=webcam.http_host,
+        cache_dir=os.path.join(tmp, 'cache')
+    )
+    # the bot makes the standard streams non-blocking for its interactive mode
+    os.set_blocking(sys.stdout.fileno(), True)
+    printer._loop = asyncio.get_event_loop()
+    asyncio.ensure_future(printer.run_bot())
+    asyncio.ensure_future(printer.run_moonraker())
+    await printer.keybase_ready.wait()
+    while not printer.printer_state.ready:
+        await asyncio.sleep(0.01)
+
+    frames = [f for f in load_capture(CAPTURE) if any(m.encode() in f[:80] for m in REPLAYED_METHODS)]
+    job = completed_job()
+    job_sent: Dict[int, float] = {}
+    command_latencies: List[float] = []
+
+    async def jobs() -> None:
+        i = 0
+        while True:
+            i += 1
+            job['params'][0]['job']['filename'] = f'bench_{i}.gcode'
+            job_sent[i] = time.monotonic()
+            moonraker.notify(job['method'], job['params'])
+            await asyncio.sleep(1. / args.job_rate)
+
+    async def command() -> None:
+        start = time.monotonic()
+        await printer(bot, bot.message('/uboe_bot status'))
+        command_latencies.append((time.monotonic() - start) * 1000)
+
+    async def commands() -> None:
+        while True:
+            asyncio.ensure_future(command())
+            await asyncio.sleep(1. / args.command_rate)
+
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    started = time.monotonic()
+    rss_start = rss_bytes()
+    generators = [asyncio.ensure_future(moonraker.replay(frames, args.event_rate))]
+    if args.job_rate > 0:
+        generators.append(asyncio.ensure_future(jobs()))
+    if args.command_rate > 0:
+        generators.append(asyncio.ensure_future(commands()))
+    rss_peak = rss_start
+    while time.monotonic() - started < args.duration:
+        await asyncio.sleep(0.1)
+        rss_peak = max(rss_peak, rss_bytes())
+    for task in generators:
+        task.cancel()
+    await asyncio.gather(*generators, return_exceptions=True)
+    # let the last notifications and commands complete
+    deadline = time.monotonic() + args.drain
+    while time.monotonic() < deadline and printer.notifications.stats()['depth']:
+        await asyncio.sleep(0.05)
+    await asyncio.sleep(0.2)
+    elapsed = time.monotonic() - started
+    end_usage = resource.getrusage(resource.RUSAGE_SELF)
+
+    notification_latencies = []
+    for message in bot.chat.messages:
+        match = JOB_RE.search(message.text)
+        if match and int(match.group(1)) in job_sent:
+            notification_latencies.append((message.at - job_sent.pop(int(match.group(1)))) * 1000)
+    busy = sum(1 for m in bot.chat.messages if "I'm busy" in m.text)
+    cpu = (end_usage.ru_utime - usage.ru_utime) + (end_usage.ru_stime - usage.ru_stime)
+
+    print(f"{args.duration:.0f}s: {args.event_rate:.0f} replayed events/s, {args.job_rate:g} jobs/s, "
+          f"{args.command_rate:g} status commands/s")
+    print(f"latencies: Moonraker {args.moonraker_latency * 1000:.1f} ms, webcam {args.webcam_latency * 1000:.1f} ms "
+          f"({args.image_size // 1024} KB), Keybase send {args.keybase_latency * 1000:.1f} ms")
+    print(f"{'':<24} {'count':>6} {'p50':>9} {'p90':>9} {'p99':>9} {'max':>9}  (ms)")
+    print_latencies('notification -> chat', notification_latencies)
+    print_latencies('status command', command_latencies)
+    print(f"notifications lost: {len(job_sent)}, busy replies: {busy}, snapshots served: {webcam.requests}")
+    print(f"CPU: {cpu / elapsed * 100:.1f}% of a core, RSS: {rss_start / 2**20:.1f} MB at start, "
+          f"{rss_peak / 2**20:.1f} MB peak")
+    await webcam.stop()
+    await moonraker.stop()
+    printer.shutdown()
+    # the bot tasks run forever
+    os._exit(0)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="End to end benchmark of the bot on replayed traffic")
+    parser.add_argument('-d', '--duration', type=float, default=10., help='Load duration (s)')
+    parser.add_argument('-e', '--event-rate', type=float, default=50., help='Replayed Moonraker notifications per second')
+    parser.add_argument('-j', '--job-rate', type=float, default=1., help='Finished jobs reported per second')
+    parser.add_argument('-c', '--command-rate', type=float, default=2., help='Status commands per second')
+    parser.add_argument('--moonraker-latency', type=float, default=0.002, help='Simulated Moonraker latency per request (s)')
+    parser.add_argument('--webcam-latency', type=float, default=0.02, help='Simulated webcam snapshot latency (s)')
+    parser.add_argument('--image-size', type=int, default=200 * 1024, help='Snapshot size (bytes)')
+    parser.add_argument('--keybase-latency', type=float, default=0.05, help='Simulated Keybase send latency (s)')
+    parser.add_argument('--drain', type=float, default=10., help='Time allowed to deliver the last notifications (s)')
+    asyncio.run(run(parser.parse_args()))
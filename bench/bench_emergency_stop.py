@@ -0,0 +1,193 @@
+#!/bin/python3
+# -*- coding: utf-8 -*-
+'''
+###############################################################################
+##
+## 88        88 88
+## 88        88 88
+## 88        88 88
+## 88        88 88,dPPYba,   ,adPPYba,   ,adPPYba,
+## 88        88 88P'    "8a a8"     "8a a8P_____88
+## 88        88 88       d8 8b       d8 8PP"""""""
+## Y8a.    .a8P 88b,   ,a8" "8a,   ,a8" "8b,   ,aa
+##  `"Y8888Y"'  `"8Ybbd8"'   `"YbbdP"'   `"Ybbd8"'
+##
+###############################################################################
+Latency of emergency_stop under simulated load.
+While status commands keep the scheduler and the socket busy, Moonraker floods
+the stream with recorded notifications and worker threads hold the GIL (like
+snapshot processing does), emergency stops are sent through the priority path
+(prebuilt frame) and through the regular path (router, scheduler, rpc.call).
+The time from chat receipt to socket write and to Moonraker's response is
+reported for both. With --max-write-ms the script exits with an error when
+the p99 write latency of the priority path exceeds the given bound.
+'''
+from __future__ import annotations
+import os
+import sys
+import asyncio
+import argparse
+import tempfile
+import threading
+import time
+
+this_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(this_dir, '..', 'tools'))
+
+from fake_moonraker import FakeMoonraker
+from bench_framer import CAPTURE, load_capture
+from command_router import CommandRouter
+from command_scheduler import CommandScheduler
+from moonraker_framer import EtxFramer, READ_SIZE
+from moonraker_rpc import MoonrakerRpc
+
+from typing import Any, Dict, List, Optional, Tuple
+
+STATUS_CALLS: List[Tuple[str, Optional[Dict[str, Any]]]] = [
+    ("printer.objects.query", {'objects' : {'print_stats' : None, 'display_status' : None}}),
+    ("access.spoolman.info", None),
+    ("server.webcams.list", None),
+]
+EMERGENCY_STOP_FRAME = MoonrakerRpc.prebuild("printer.emergency_stop")
+
+
+class WriterProxy:
+    '''
+    Stream writer recording when the last emergency_stop request was written
+    '''
+    def __init__(self, writer: asyncio.StreamWriter) -> None:
+        self._writer = writer
+        self.stop_written_at = 0.
+
+    def write(self, data: bytes) -> None:
+        self._writer.write(data)
+        if b'emergency_stop' in data:
+            self.stop_written_at = time.monotonic()
+
+    async def drain(self) -> None:
+        await self._writer.drain()
+
+    def close(self) -> None:
+        self._writer.close()
+
+
+def percentile(samples: List[float], q: float) -> float:
+    return samples[min(len(samples) - 1, int(len(samples) * q))]
+
+
+def burn_cpu(stop: threading.Event) -> None:
+    # pure python work keeps the GIL busy, like image processing stalls do
+    while not stop.is_set():
+        sum(i * i for i in range(20000))
+
+
+async def run(args: argparse.Namespace) -> bool:
+    sockpath = os.path.join(tempfile.mkdtemp(), 'moonraker.sock')
+    server = FakeMoonraker(sockpath, latency=args.latency)
+    await server.start()
+    reader, writer = await asyncio.open_unix_connection(sockpath)
+    proxy = WriterProxy(writer)
+    rpc = MoonrakerRpc()
+    rpc.attach(proxy)
+
+    async def read_stream() -> None:
+        framer = EtxFramer()
+        while True:
+            data = await reader.read(READ_SIZE)
+            if not data:
+                return
+            framer.feed(data)
+            for frame in framer:
+                item = framer.decode(frame)
+                if "id" in item:
+                    rpc.resolve(item)
+
+    router = CommandRouter('/uboe_bot')
+    scheduler = CommandScheduler()
+
+    async def status() -> Any:
+        return await rpc.call_batch(STATUS_CALLS)
+
+    async def regular_stop() -> Any:
+        return await rpc.call("printer.emergency_stop")
+
+    router.command('status', concurrency=1, coalesce=True)(status)
+    router.command('emergency_stop')(regular_stop)
+
+    async def dispatch(text: str) -> Any:
+        route = router.resolve(text, 'user', ())
+        command = route.command
+        key = (command.verb,) if command.coalesce else None
+        return await scheduler.run(command.verb, command.concurrency, key, command.handler)
+
+    running = True
+
+    async def status_load() -> None:
+        while running:
+            await asyncio.gather(*(dispatch('/uboe_bot status') for _ in range(4)), return_exceptions=True)
+
+    async def notification_load(frames: bytes) -> None:
+        while running:
+            server.push_raw(frames)
+            await asyncio.sleep(args.flood_interval)
+
+    stop_threads = threading.Event()
+    threads = [threading.Thread(target=burn_cpu, args=(stop_threads,), daemon=True) for _ in range(args.cpu_threads)]
+    for thread in threads:
+        thread.start()
+    tasks = [asyncio.ensure_future(read_stream())]
+    tasks += [asyncio.ensure_future(status_load()) for _ in range(args.status_workers)]
+    tasks.append(asyncio.ensure_future(notification_load(b''.join(load_capture(CAPTURE)))))
+    await asyncio.sleep(0.2)
+
+    results: Dict[str, Tuple[List[float], List[float]]] = {'priority': ([], []), 'regular': ([], [])}
+    for i in range(args.iterations * 2):
+        path = 'priority' if i % 2 == 0 else 'regular'
+        received = time.monotonic()
+        if path == 'priority':
+            text = '/uboe_bot emergency_stop'
+            if text.split() == ['/uboe_bot', 'emergency_stop']:
+                await rpc.call_prebuilt(EMERGENCY_STOP_FRAME)
+        else:
+            await dispatch('/uboe_bot emergency_stop')
+        done = time.monotonic()
+        results[path][0].append((proxy.stop_written_at - received) * 1000)
+        results[path][1].append((done - received) * 1000)
+        await asyncio.sleep(args.interval)
+
+    running = False
+    stop_threads.set()
+    # let the load tasks finish their calls in flight before closing the connection
+    await asyncio.gather(*tasks[1:], return_exceptions=True)
+    tasks[0].cancel()
+    await asyncio.gather(tasks[0], return_exceptions=True)
+    proxy.close()
+    await server.stop()
+
+    print(f"load: {args.status_workers} status workers, notification flood every {args.flood_interval * 1000:.0f} ms, "
+          f"{args.cpu_threads} CPU threads, {args.latency * 1000:.1f} ms Moonraker latency")
+    print(f"{'path':<10} {'write p50':>10} {'write p99':>10} {'write max':>10} {'resp p50':>10} {'resp p99':>10}  (ms)")
+    for path, (writes, responses) in results.items():
+        writes.sort()
+        responses.sort()
+        print(f"{path:<10} {percentile(writes, .5):>10.3f} {percentile(writes, .99):>10.3f} {writes[-1]:>10.3f} "
+              f"{percentile(responses, .5):>10.3f} {percentile(responses, .99):>10.3f}")
+    if args.max_write_ms is not None:
+        p99 = percentile(results['priority'][0], .99)
+        if p99 > args.max_write_ms:
+            print(f"FAILED: priority path p99 write latency {p99:.3f} ms > {args.max_write_ms} ms")
+            return False
+        print(f"OK: priority path p99 write latency {p99:.3f} ms <= {args.max_write_ms} ms")
+    return True
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="emergency_stop latency under simulated load")
+    parser.add_argument('-n', '--iterations', type=int, default=200, help='Emergency stops sent per path')
+    parser.add_argument('-l', '--latency', type=float, default=0.002, help='Simulated Moonraker latency per request (s)')
+    parser.add_argument('--interval', type=float, default=0.005, help='Delay between two emergency stops (s)')
+    parser.add_argument('--status-workers', type=int, default=8, help='Tasks sending status command bursts')
+    parser.add_argument('--flood-interval', type=float, default=0.01, help='Delay between two notification bursts (s)')
+    parser.add_argument('--cpu-threads', type=int, default=1, help='Threads holding the GIL')
+    parser.add_argument('--max-write-ms', type=float, default=None, help='Fail when the priority p99 write latency exceeds it')
+    sys.exit(0 if asyncio.run(run(parser.parse_args())) else 1)
@@ -0,0 +1,187 @@
+#!/bin/python3
+# -*- coding: utf-8 -*-
+'''
+###############################################################################
+##
+## 88        88 88
+## 88        88 88
+## 88        88 88
+## 88        88 88,dPPYba,   ,adPPYba,   ,adPPYba,
+## 88        88 88P'    "8a a8"     "8a a8P_____88
+## 88        88 88       d8 8b       d8 8PP"""""""
+## Y8a.    .a8P 88b,   ,a8" "8a,   ,a8" "8b,   ,aa
+##  `"Y8888Y"'  `"8Ybbd8"'   `"YbbdP"'   `"Ybbd8"'
+##
+###############################################################################
+Microbenchmark of the Moonraker stream decoding on recorded traffic
+(bench/data/moonraker_capture.jsonl).
+Compares the former readuntil/slice/decode/json.loads path with EtxFramer,
+and reports frames/sec, the buffer copies made by the framer (a frame still
+referenced when data is fed forces one) and the peak memory allocated while
+handling a frame, with and without the NotificationFilter allowlist (checked
+on the raw frames with json, on the decoded ones with orjson).
+--read-size sets the size of the socket reads of the framer.
+'''
+from __future__ import annotations
+import os
+import sys
+import asyncio
+import argparse
+import json
+import time
+import tracemalloc
+
+this_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(this_dir, '..', 'tools'))
+
+from moonraker_framer import EtxFramer, NotificationFilter, READ_SIZE, json_backend
+
+from typing import Callable, List, Optional, Tuple
+
+CAPTURE = os.path.join(this_dir, 'data', 'moonraker_capture.jsonl')
+# same list as KeybaseBot.HANDLED_NOTIFICATIONS
+ALLOWLIST = [
+    'notify_history_changed', 'notify_check_failure', 'notify_status_update', 'notify_klippy_ready',
+    'notify_klippy_shutdown', 'notify_klippy_disconnected', 'notify_active_spool_set', 'notify_webcams_changed',
+]
+
+
+def load_capture(path: str) -> List[bytes]:
+    '''
+    @return: Recorded frames, as sent on the socket (ETX terminated)
+    '''
+    with open(path, 'rb') as f:
+        return [line.strip() + b'\x03' for line in f if line.strip()]
+
+
+async def legacy_stream(reader: asyncio.StreamReader) -> Tuple[int, Optional[int]]:
+    count = 0
+    while True:
+        try:
+            data = await reader.readuntil(b'\x03')
+        except asyncio.IncompleteReadError:
+            return count, None
+        decoded = data[:-1].decode(encoding="utf-8")
+        json.loads(decoded)
+        count += 1
+
+
+def make_filter(allowlist: Optional[List[str]], prefilter: bool) -> Optional[NotificationFilter]:
+    return NotificationFilter(allowlist, prefilter) if allowlist is not None else None
+
+
+def framer_stream(
+    use_orjson: bool, allowlist: Optional[List[str]] = None, read_size: int = READ_SIZE, prefilter: Optional[bool] = None
+) -> Callable:
+    async def run(reader: asyncio.StreamReader) -> Tuple[int, Optional[int]]:
+        framer = EtxFramer(use_orjson=use_orjson)
+        notify_filter = make_filter(allowlist, not use_orjson if prefilter is None else prefilter)
+        count = 0
+        while True:
+            data = await reader.read(read_size)
+            if not data:
+                return count, framer.copies
+            framer.feed(data)
+            for frame in framer:
+                count += 1
+                if notify_filter is not None and not notify_filter.accept(frame):
+                    continue
+                item = framer.decode(frame)
+                if notify_filter is not None:
+                    notify_filter.accept_item(item)
+    return run
+
+
+def legacy_frame_func() -> Callable:
+    buffer = bytearray()
+
+    def run(frame: bytes) -> None:
+        # same buffer handling as StreamReader.feed_data()/readuntil()
+        buffer.extend(frame)
+        chunk = buffer[:len(frame)]
+        del buffer[:len(frame)]
+        data = bytes(chunk)
+        decoded = data[:-1].decode(encoding="utf-8")
+        json.loads(decoded)
+    return run
+
+
+def framer_frame(use_orjson: bool, allowlist: Optional[List[str]] = None, prefilter: Optional[bool] = None) -> Callable:
+    framer = EtxFramer(use_orjson=use_orjson)
+    notify_filter = make_filter(allowlist, not use_orjson if prefilter is None else prefilter)
+
+    def run(frame: bytes) -> None:
+        framer.feed(frame)
+        for view in framer:
+            if notify_filter is not None and not notify_filter.accept(view):
+                continue
+            item = framer.decode(view)
+            if notify_filter is not None:
+                notify_filter.accept_item(item)
+    return run
+
+
+def bench_throughput(stream: bytes, func: Callable, repeat: int) -> Tuple[float, Optional[int]]:
+    '''
+    @return: Best frames/sec over the runs and buffer copies of a run (None for the former path)
+    '''
+    async def once() -> Tuple[float, Optional[int]]:
+        reader = asyncio.StreamReader(limit=len(stream) + 1)
+        reader.feed_data(stream)
+        reader.feed_eof()
+        # CPU time, less sensitive than wall time to the other processes of the host
+        start = time.process_time()
+        count, copies = await func(reader)
+        return count / (time.process_time() - start), copies
+    runs = [asyncio.run(once()) for _ in range(repeat)]
+    return max(rate for rate, _ in runs), runs[-1][1]
+
+
+def bench_allocations(frames: List[bytes], func: Callable) -> float:
+    '''
+    @return: Mean peak of memory (bytes) allocated while handling one frame
+    '''
+    tracemalloc.start()
+    total = 0
+    for frame in frames:
+        tracemalloc.clear_traces()
+        func(frame)
+        total += tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return total / len(frames)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Moonraker stream framing microbenchmark")
+    parser.add_argument('-c', '--capture', default=CAPTURE, help='Recorded traffic (one JSON frame per line)')
+    parser.add_argument('-n', '--loops', type=int, default=200, help='Times the capture is replayed per run')
+    parser.add_argument('-r', '--repeat', type=int, default=10, help='Runs per mode, the best one is kept')
+    parser.add_argument('-s', '--read-size', type=int, default=READ_SIZE, help='Size of the framer socket reads')
+    args = parser.parse_args()
+
+    frames = load_capture(args.capture)
+    stream = b''.join(frames) * args.loops
+    print(f"{len(frames)} recorded frames, {len(stream) / len(frames) / args.loops:.0f} bytes/frame on average, "
+          f"{len(frames) * args.loops} frames per run")
+    modes = [
+        ("readuntil + json", legacy_stream, legacy_frame_func()),
+        ("framer + json", framer_stream(False, None, args.read_size), framer_frame(False)),
+        ("filter + json", framer_stream(False, ALLOWLIST, args.read_size), framer_frame(False, ALLOWLIST)),
+    ]
+    if json_backend() == "orjson":
+        modes.append(("framer + orjson", framer_stream(True, None, args.read_size), framer_frame(True)))
+        modes.append(("filter + orjson", framer_stream(True, ALLOWLIST, args.read_size), framer_frame(True, ALLOWLIST)))
+        # the raw frame prefilter, which the filter skips with orjson
+        modes.append((
+            "regex + orjson", framer_stream(True, ALLOWLIST, args.read_size, prefilter=True),
+            framer_frame(True, ALLOWLIST, prefilter=True)
+        ))
+    for name, stream_func, frame_func in modes:
+        rate, copies = bench_throughput(stream, stream_func, args.repeat)
+        peak = bench_allocations(frames, frame_func)
+        print(f"{name:<18} {rate:>12,.0f} frames/s   {'-' if copies is None else copies:>6} buffer copies"
+              f"   peak {peak:>10,.0f} bytes allocated/frame")
+
+
+if __name__ == "__main__":
+    main()
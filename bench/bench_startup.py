@@ -0,0 +1,144 @@
+#!/bin/python3
+# -*- coding: utf-8 -*-
+'''
+###############################################################################
+##
+## 88        88 88
+## 88        88 88
+## 88        88 88
+## 88        88 88,dPPYba,   ,adPPYba,   ,adPPYba,
+## 88        88 88P'    "8a a8"     "8a a8P_____88
+## 88        88 88       d8 8b       d8 8PP"""""""
+## Y8a.    .a8P 88b,   ,a8" "8a,   ,a8" "8b,   ,aa
+##  `"Y8888Y"'  `"8Ybbd8"'   `"YbbdP"'   `"Ybbd8"'
+##
+###############################################################################
+Time to first notification of a cold started bot.
+Each run starts a fresh interpreter that imports the bot, creates it with a
+fake Keybase session (whose initialization takes --keybase-init seconds) and
+connects it to a fake Moonraker, which reports a finished job as soon as the
+bot is connected. The run ends when the notification has been sent to Keybase.
+The startup phases recorded by the bot (see startup_timings) are reported, and
+so is the wall time from spawning the process. --sequential waits for the
+Keybase session before connecting to Moonraker, as the bot used to.
+'''
+from __future__ import annotations
+import os
+import sys
+import asyncio
+import argparse
+import json
+import logging
+import shutil
+import statistics
+import tempfile
+import time
+
+this_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(this_dir, '..', 'tools'))
+
+# first import of the child process: the startup timings count from here
+from startup_timings import STARTUP
+from attachments import attachment_dir
+from fake_keybase import FakeBot
+from fake_moonraker import FakeMoonraker
+
+from typing import Dict, List
+
+JOB_FINISHED = [{'action': 'finished', 'job': {
+    'filename': 'cable_tie_PLA_7m50s.gcode', 'status': 'completed', 'job_id': '00000E', 'metadata': {},
+    'print_duration': 281.2, 'total_duration': 290.1, 'filament_used': 1200.0, 'exists': True,
+}}]
+
+
+async def child(args: argparse.Namespace) -> None:
+    import KeybaseBot as kb
+    STARTUP.mark('imports')
+    logging.basicConfig(level=logging.WARNING)
+    tmp = tempfile.mkdtemp()
+    kb.ServiceConfig._path = os.path.join(tmp, 'service.json')
+    keybase = FakeBot(init_delay=args.keybase_init)
+    printer = kb.KeybaseBot(
+        args.child, presets=[{'method': 'printer.info'}], paperkey=None, logger=logging.getLogger('bench'),
+        bot=keybase, name=args.name, camera_config=os.path.join(tmp, 'camera.json'),
+        cache_dir=os.path.join(tmp, 'cache')
+    )
+    printer._loop = asyncio.get_event_loop()
+    STARTUP.mark('bot_created')
+    asyncio.ensure_future(printer.run_bot())
+    if args.sequential:
+        await printer.keybase_ready.wait()
+    asyncio.ensure_future(printer.run_moonraker())
+    await keybase.chat.first_sent
+    STARTUP.mark('first_notification')
+    sys.stdout.write(json.dumps(STARTUP.phases) + '\n')
+    sys.stdout.flush()
+    printer.shutdown()
+    shutil.rmtree(tmp, ignore_errors=True)
+    # the bot tasks run forever
+    os._exit(0)
+
+
+async def run_once(args: argparse.Namespace, sockpath: str, name: str) -> Dict[str, float]:
+    server = FakeMoonraker(sockpath, latency=args.latency)
+    await server.start()
+    cmd = [
+        sys.executable, os.path.abspath(__file__), '--child', sockpath, '--name', name,
+        '--keybase-init', str(args.keybase_init)
+    ]
+    if args.sequential:
+        cmd.append('--sequential')
+    spawned = time.monotonic()
+    proc = await asyncio.create_subprocess_exec(
+        *cmd, stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.PIPE
+    )
+    try:
+        # the job finishes as soon as the bot is connected
+        while not server.writers and proc.returncode is None:
+            await asyncio.sleep(0.001)
+        server.notify('notify_history_changed', JOB_FINISHED)
+        line = await asyncio.wait_for(proc.stdout.readline(), args.timeout)
+        wall = time.monotonic() - spawned
+        await asyncio.wait_for(proc.wait(), args.timeout)
+    finally:
+        if proc.returncode is None:
+            proc.kill()
+            await proc.wait()
+        await server.stop()
+        # a child killed or failing before its shutdown leaves its attachment directory
+        shutil.rmtree(attachment_dir(os.path.join(this_dir, '..', 'tmp'), name), ignore_errors=True)
+    if not line:
+        raise RuntimeError(f"The bot process exited ({proc.returncode}) before sending a notification")
+    phases = json.loads(line)
+    phases['process_wall'] = round(wall, 3)
+    return phases
+
+
+async def run(args: argparse.Namespace) -> None:
+    tmp = tempfile.mkdtemp()
+    runs: List[Dict[str, float]] = []
+    try:
+        for i in range(args.runs):
+            runs.append(await run_once(args, os.path.join(tmp, 'moonraker.sock'), f'bench-{os.getpid()}-{i}'))
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    mode = 'sequential' if args.sequential else 'concurrent'
+    print(f"{args.runs} cold starts, {mode} init, keybase init {args.keybase_init * 1000:.0f} ms, "
+          f"Moonraker latency {args.latency * 1000:.1f} ms")
+    print(f"{'phase':<22} {'median':>10} {'min':>10} {'max':>10}  (s)")
+    for phase in runs[0]:
+        values = [r[phase] for r in runs if phase in r]
+        print(f"{phase:<22} {statistics.median(values):>10.3f} {min(values):>10.3f} {max(values):>10.3f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time to first notification of a cold started bot")
+    parser.add_argument('-n', '--runs', type=int, default=5, help='Cold starts')
+    parser.add_argument('-k', '--keybase-init', type=float, default=1., help='Simulated Keybase initialization (s)')
+    parser.add_argument('-l', '--latency', type=float, default=0.002, help='Simulated Moonraker latency per request (s)')
+    parser.add_argument('--sequential', action='store_true', help='Connect to Moonraker once Keybase is initialized')
+    parser.add_argument('--timeout', type=float, default=30., help='Time allowed to a run (s)')
+    parser.add_argument('--child', type=str, default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--name', type=str, default='bench', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    asyncio.run(child(args) if args.child else run(args))
@@ -0,0 +1,88 @@
+#!/bin/python3
+# -*- coding: utf-8 -*-
+'''
+###############################################################################
+##
+## 88        88 88
+## 88        88 88
+## 88        88 88
+## 88        88 88,dPPYba,   ,adPPYba,   ,adPPYba,
+## 88        88 88P'    "8a a8"     "8a a8P_____88
+## 88        88 88       d8 8b       d8 8PP"""""""
+## Y8a.    .a8P 88b,   ,a8" "8a,   ,a8" "8b,   ,aa
+##  `"Y8888Y"'  `"8Ybbd8"'   `"YbbdP"'   `"Ybbd8"'
+##
+###############################################################################
+Compares the latency of the RPCs behind a `status` command when they are sent
+one after the other and when they are sent as a single batch.
+'''
+from __future__ import annotations
+import os
+import sys
+import asyncio
+import argparse
+import json
+import statistics
+import tempfile
+import time
+
+this_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(this_dir, '..', 'tools'))
+
+from fake_moonraker import FakeMoonraker
+from moonraker_rpc import MoonrakerRpc
+
+from typing import Any, Dict, List, Optional, Tuple
+
+STATUS_CALLS: List[Tuple[str, Optional[Dict[str, Any]]]] = [
+    ("printer.objects.query", {'objects' : {'print_stats' : None, 'display_status' : None}}),
+    ("access.spoolman.info", None),
+    ("server.webcams.list", None),
+    ("server.webcams.list", None),
+]
+
+
+async def run(iterations: int, latency: float) -> None:
+    sockpath = os.path.join(tempfile.mkdtemp(), 'moonraker.sock')
+    server = FakeMoonraker(sockpath, latency=latency)
+    await server.start()
+    reader, writer = await asyncio.open_unix_connection(sockpath)
+    rpc = MoonrakerRpc()
+    rpc.attach(writer)
+
+    async def read_stream() -> None:
+        while True:
+            data = await reader.readuntil(b'\x03')
+            rpc.resolve(json.loads(data[:-1]))
+    reader_task = asyncio.ensure_future(read_stream())
+
+    async def sequential() -> None:
+        for method, params in STATUS_CALLS:
+            await rpc.call(method, params)
+
+    async def batched() -> None:
+        await rpc.call_batch(STATUS_CALLS)
+
+    for name, func in (("sequential", sequential), ("batched", batched)):
+        samples = []
+        for _ in range(iterations):
+            start = time.perf_counter()
+            await func()
+            samples.append((time.perf_counter() - start) * 1000)
+        samples.sort()
+        print(f"{name:<12} {len(STATUS_CALLS)} calls: "
+              f"mean {statistics.mean(samples):.3f} ms, "
+              f"p50 {samples[len(samples) // 2]:.3f} ms, "
+              f"p95 {samples[int(len(samples) * .95) - 1]:.3f} ms")
+
+    reader_task.cancel()
+    writer.close()
+    await server.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Sequential vs batched status RPC latency")
+    parser.add_argument('-n', '--iterations', type=int, default=200, help='Number of status renders per mode')
+    parser.add_argument('-l', '--latency', type=float, default=0.002, help='Simulated Moonraker latency per request (s)')
+    args = parser.parse_args()
+    asyncio.run(run(args.iterations, args.latency))
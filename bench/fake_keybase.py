@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+'''
+###############################################################################
+##
+## 88        88 88
+## 88        88 88
+## 88        88 88
+## 88        88 88,dPPYba,   ,adPPYba,   ,adPPYba,
+## 88        88 88P'    "8a a8"     "8a a8P_____88
+## 88        88 88       d8 8b       d8 8PP"""""""
+## Y8a.    .a8P 88b,   ,a8" "8a,   ,a8" "8b,   ,aa
+##  `"Y8888Y"'  `"8Ybbd8"'   `"YbbdP"'   `"Ybbd8"'
+##
+###############################################################################
+Stand-in for the pykeybasebot Bot used by the benchmarks.
+It provides the part of the Bot/chat API used by KeybaseBot (username,
+ensure_initialized, start, chat.send, chat.attach): sent messages are recorded
+with their time, after a configurable send latency. message() builds the chat
+events that the bot handler receives.
+'''
+from __future__ import annotations
+import asyncio
+import time
+from types import SimpleNamespace
+
+from typing import Any, Dict, List, Optional
+
+
+class SentMessage:
+    def __init__(self, channel: Any, text: str, file: Optional[str]) -> None:
+        self.at = time.monotonic()
+        self.channel = channel
+        self.text = text
+        self.file = file
+
+
+class FakeChat:
+    def __init__(self, latency: float = 0.) -> None:
+        '''
+        @param latency: Delay (in seconds) of each send, like a round trip to the Keybase service
+        '''
+        self.latency = latency
+        self.messages: List[SentMessage] = []
+        self.first_sent = asyncio.get_event_loop().create_future()
+
+    async def send(self, channel: Any, text: str) -> None:
+        await self._record(channel, text, None)
+
+    async def attach(self, channel: Any, file: str, text: str) -> None:
+        await self._record(channel, text, file)
+
+    async def _record(self, channel: Any, text: str, file: Optional[str]) -> None:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        self.messages.append(SentMessage(channel, text, file))
+        if not self.first_sent.done():
+            self.first_sent.set_result(self.messages[-1].at)
+
+
+class FakeBot:
+    def __init__(self, init_delay: float = 0., send_latency: float = 0., username: str = 'uboe_bot') -> None:
+        '''
+        @param init_delay: Time (in seconds) taken by ensure_initialized()
+        @param send_latency: Delay (in seconds) of each chat send
+        @param username: Bot user name
+        '''
+        self.init_delay = init_delay
+        self.username = username
+        self.chat = FakeChat(send_latency)
+        # referenced so that the task waiting in start() is not garbage collected
+        self._stopped = asyncio.Event()
+
+    async def ensure_initialized(self) -> None:
+        await asyncio.sleep(self.init_delay)
+
+    async def start(self, listen_options: Dict[str, Any]) -> None:
+        await self._stopped.wait()
+
+    @staticmethod
+    def message(text: str, sender: str = 'user', topic_name: str = 'bench', team: str = 'printhive') -> Any:
+        '''
+        @return: Chat event of a text message, with the attributes the bot handler reads
+        '''
+        channel = SimpleNamespace(name=team, public=None, members_type='team', topic_type='chat', topic_name=topic_name)
+        content = SimpleNamespace(type_name='text', text=SimpleNamespace(body=text))
+        return SimpleNamespace(msg=SimpleNamespace(content=content, sender=SimpleNamespace(username=sender), channel=channel))
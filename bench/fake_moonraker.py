@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+'''
+###############################################################################
+##
+## 88        88 88
+## 88        88 88
+## 88        88 88
+## 88        88 88,dPPYba,   ,adPPYba,   ,adPPYba,
+## 88        88 88P'    "8a a8"     "8a a8P_____88
+## 88        88 88       d8 8b       d8 8PP"""""""
+## Y8a.    .a8P 88b,   ,a8" "8a,   ,a8" "8b,   ,aa
+##  `"Y8888Y"'  `"8Ybbd8"'   `"YbbdP"'   `"Ybbd8"'
+##
+###############################################################################
+Fake Moonraker Unix socket server used by the benchmarks.
+It answers JSON-RPC requests with canned results after a configurable latency
+(plus a random jitter, so that responses can arrive out of order), and pushes
+notifications or replays recorded traffic to its clients.
+'''
+from __future__ import annotations
+import asyncio
+import json
+import os
+import random
+
+from typing import Any, Dict, List, Optional
+
+DEFAULT_RESULTS: Dict[str, Any] = {
+    "server.connection.identify": {"connection_id": 1},
+    "printer.objects.subscribe": {"eventtime": 1.0, "status": {
+        "print_stats": {"filename": "cable_tie_PLA_7m50s.gcode", "total_duration": 281.2, "print_duration": 120.0,
+                        "filament_used": 1200.0, "state": "printing", "message": "",
+                        "info": {"total_layer": 9, "current_layer": 3}},
+        "display_status": {"progress": 0.42, "message": None}}},
+    "printer.objects.query": {"eventtime": 1.0, "status": {
+        "print_stats": {"filename": "cable_tie_PLA_7m50s.gcode", "total_duration": 281.2, "print_duration": 120.0,
+                        "filament_used": 1200.0, "state": "printing", "message": "",
+                        "info": {"total_layer": 9, "current_layer": 3}},
+        "display_status": {"progress": 0.42, "message": None}}},
+    "access.spoolman.info": {"filament": {"density": 1.24, "diameter": 1.75}},
+    "server.webcams.list": {"webcams": [{"name": "cam", "snapshot_url": "/webcam/?action=snapshot"}]},
+    "printer.emergency_stop": "ok",
+}
+
+
+class FakeMoonraker:
+    def __init__(
+        self, sockpath: str, latency: float = 0., results: Optional[Dict[str, Any]] = None, jitter: float = 0.
+    ) -> None:
+        '''
+        @param sockpath: Path of the Unix socket to serve
+        @param latency: Delay (in seconds) before each response is sent
+        @param results: Result returned for each method, DEFAULT_RESULTS if omitted. A callable result
+            is called with the request params.
+        @param jitter: Maximum random delay (in seconds) added to the latency
+        '''
+        self.sockpath = sockpath
+        self.latency = latency
+        self.jitter = jitter
+        self.results = dict(DEFAULT_RESULTS if results is None else results)
+        self.requests: List[Dict[str, Any]] = []
+        self.writers: List[asyncio.StreamWriter] = []
+        self._handlers: List[asyncio.Task] = []
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self) -> None:
+        if os.path.exists(self.sockpath):
+            os.unlink(self.sockpath)
+        self._server = await asyncio.start_unix_server(self._handle, self.sockpath)
+
+    async def stop(self) -> None:
+        '''
+        Stop the server and drop every client connection
+        '''
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+        for writer in self.writers:
+            writer.close()
+        self.writers = []
+        for task in self._handlers:
+            task.cancel()
+        await asyncio.gather(*self._handlers, return_exceptions=True)
+        self._handlers = []
+
+    def notify(self, method: str, params: List[Any]) -> None:
+        '''
+        Push a notification to every connected client
+        '''
+        data = json.dumps({"jsonrpc": "2.0", "method": method, "params": params}).encode() + b"\x03"
+        for writer in self.writers:
+            writer.write(data)
+
+    def push_raw(self, data: bytes) -> None:
+        '''
+        Push already serialized frames to every connected client
+        '''
+        for writer in self.writers:
+            writer.write(data)
+
+    async def replay(self, frames: List[bytes], rate: float, duration: Optional[float] = None) -> int:
+        '''
+        Push recorded frames to every connected client, in a loop, at a steady rate
+        @param frames: Serialized frames (ETX terminated), e.g. from bench_framer.load_capture()
+        @param rate: Frames per second
+        @param duration: Time (in seconds) to replay for, None until cancelled
+        @return: Number of frames pushed
+        '''
+        loop = asyncio.get_event_loop()
+        start = loop.time()
+        pushed = 0
+        tick = 0.01
+        while duration is None or loop.time() - start < duration:
+            # frames due since the start, pushed in batches so high rates do not depend on the timer resolution
+            due = int((loop.time() - start) * rate)
+            if due > pushed:
+                self.push_raw(b"".join(frames[i % len(frames)] for i in range(pushed, due)))
+                pushed = due
+            await asyncio.sleep(tick)
+        return pushed
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self.writers.append(writer)
+        self._handlers.append(asyncio.current_task())
+        try:
+            while True:
+                data = await reader.readuntil(b"\x03")
+                request = json.loads(data[:-1])
+                self.requests.append(request)
+                asyncio.ensure_future(self._respond(writer, request))
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            if asyncio.current_task() in self._handlers:
+                self._handlers.remove(asyncio.current_task())
+            if writer in self.writers:
+                self.writers.remove(writer)
+            writer.close()
+
+    async def _respond(self, writer: asyncio.StreamWriter, request: Dict[str, Any]) -> None:
+        delay = self.latency + (random.uniform(0., self.jitter) if self.jitter else 0.)
+        if delay:
+            await asyncio.sleep(delay)
+        method = request.get("method")
+        if method in self.results:
+            result = self.results[method]
+            if callable(result):
+                result = result(request.get("params"))
+            response = {"jsonrpc": "2.0", "result": result, "id": request.get("id")}
+        else:
+            response = {"jsonrpc": "2.0", "error": {"code": -32601, "message": f"Method not found: {method}"}, "id": request.get("id")}
+        if not writer.is_closing():
+            writer.write(json.dumps(response).encode() + b"\x03")
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+'''
+###############################################################################
+##
+## 88        88 88
+## 88        88 88
+## 88        88 88
+## 88        88 88,dPPYba,   ,adPPYba,   ,adPPYba,
+## 88        88 88P'    "8a a8"     "8a a8P_____88
+## 88        88 88       d8 8b       d8 8PP"""""""
+## Y8a.    .a8P 88b,   ,a8" "8a,   ,a8" "8b,   ,aa
+##  `"Y8888Y"'  `"8Ybbd8"'   `"YbbdP"'   `"Ybbd8"'
+##
+###############################################################################
+Fake webcam HTTP server used by the benchmarks.
+Every GET is answered with the same image after a configurable latency, on
+keep-alive connections like the Moonraker/crowsnest endpoints.
+'''
+from __future__ import annotations
+import asyncio
+import os
+
+from typing import List, Optional
+
+# JPEG start of image marker, the rest of the generated image is filler
+_JPEG_HEADER = b'\xff\xd8\xff\xe0\x00\x10JFIF\x00'
+
+
+class FakeWebcam:
+    def __init__(
+        self, host: str = '127.0.0.1', port: int = 0, latency: float = 0., size: int = 200 * 1024,
+        image: Optional[bytes] = None
+    ) -> None:
+        '''
+        @param host: Address to listen on
+        @param port: Port to listen on, 0 picks a free one (see port after start())
+        @param latency: Delay (in seconds) before each response is sent
+        @param size: Size (in bytes) of the generated image
+        @param image: Image served, generated if omitted
+        '''
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.image = image if image is not None else _JPEG_HEADER + os.urandom(max(0, size - len(_JPEG_HEADER)))
+        self.requests = 0
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._handlers: List[asyncio.Task] = []
+
+    @property
+    def http_host(self) -> str:
+        return f'{self.host}:{self.port}'
+
+    async def start(self) -> None:
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+        for task in self._handlers:
+            task.cancel()
+        await asyncio.gather(*self._handlers, return_exceptions=True)
+        self._handlers = []
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self._handlers.append(asyncio.current_task())
+        try:
+            while True:
+                request = await reader.readuntil(b'\r\n\r\n')
+                self.requests += 1
+                if self.latency:
+                    await asyncio.sleep(self.latency)
+                keep_alive = b'connection: close' not in request.lower()
+                writer.write(
+                    b'HTTP/1.1 200 OK\r\nContent-Type: image/jpeg\r\n'
+                    + f'Content-Length: {len(self.image)}\r\n'.encode()
+                    + (b'\r\n' if keep_alive else b'Connection: close\r\n\r\n')
+                    + self.image
+                )
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            if asyncio.current_task() in self._handlers:
+                self._handlers.remove(asyncio.current_task())
+            writer.close()
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+'''
+The tests import the bot modules from tools/ and the fake servers from bench/,
+like the benchmarks do.
+'''
+import asyncio
+import logging
+import os
+import sys
+
+import pytest
+
+this_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(this_dir, '..', 'tools'))
+sys.path.insert(0, os.path.join(this_dir, '..', 'bench'))
+
+
+async def _wait_for(condition, timeout: float = 5.) -> None:
+    loop = asyncio.get_event_loop()
+    deadline = loop.time() + timeout
+    while not condition():
+        assert loop.time() < deadline, "timed out"
+        await asyncio.sleep(0.01)
+
+
+@pytest.fixture
+def wait_for():
+    '''
+    Coroutine function polling condition() until it is true, the test fails after timeout seconds.
+    '''
+    return _wait_for
+
+
+@pytest.fixture
+def methods():
+    '''
+    Function returning the methods of the requests a FakeMoonraker received, in order.
+    '''
+    return lambda server: [r['method'] for r in server.requests]
+
+
+@pytest.fixture
+def sockpath(tmp_path) -> str:
+    '''
+    Path of the Unix socket of a FakeMoonraker, removed with tmp_path.
+    '''
+    return str(tmp_path / 'moonraker.sock')
+
+
+@pytest.fixture
+def make_printer(tmp_path, monkeypatch):
+    '''
+    Factory of KeybaseBot instances talking to a FakeBot, with their settings files and caches under tmp_path.
+    Must be called from the event loop of the test.
+    '''
+    pytest.importorskip('pykeybasebot')
+    import KeybaseBot as kb
+    from config_store import CONFIG
+    from fake_keybase import FakeBot
+
+    config_dir = tmp_path / 'config'
+    config_dir.mkdir()
+    monkeypatch.setattr(kb.ServiceConfig, '_path', str(config_dir / 'service.json'))
+    monkeypatch.setattr(
+        kb, '_allowed_users_file', lambda: CONFIG.open(str(config_dir / 'allowed_users.json'), [], kb._validate_users)
+    )
+    # the bot makes stdin and stdout non-blocking for its interactive mode, pytest replaces them
+    stdin = open(os.devnull, 'r')
+    stdout = open(str(tmp_path / 'stdout'), 'w')
+    monkeypatch.setattr(sys, 'stdin', stdin)
+    monkeypatch.setattr(sys, 'stdout', stdout)
+    printers = []
+
+    def make(sockpath: str, **kwargs):
+        kwargs.setdefault('cache_dir', str(tmp_path / 'cache'))
+        printer = kb.KeybaseBot(
+            sockpath, presets=[{'method' : 'printer.info'}], paperkey=None, logger=logging.getLogger('test'),
+            bot=FakeBot(), name='test', camera_config=str(config_dir / 'camera.json'), **kwargs
+        )
+        printer._loop = asyncio.get_event_loop()
+        printers.append(printer)
+        return printer
+
+    yield make
+    for printer in printers:
+        printer.shutdown()
+    stdin.close()
+    stdout.close()
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+'''
+AsyncHttpClient against a local server whose snapshot stalls mid-body: the
+event loop keeps running while get() waits, the timeout fires and the stalled
+connection is not returned to the pool. Redirects are followed and malformed
+responses raise HttpError.
+'''
+import asyncio
+import time
+
+import pytest
+
+from async_http import AsyncHttpClient, HttpError, MAX_REDIRECTS
+
+BODY_SIZE = 100 * 1024
+TIMEOUT = 0.5
+
+
+class StallingServer:
+    def __init__(self) -> None:
+        self.closed = asyncio.Event()
+        self.requests = 0
+
+    async def start(self) -> None:
+        self._server = await asyncio.start_server(self._handle, '127.0.0.1', 0)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self) -> None:
+        self._server.close()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        await reader.readuntil(b'\r\n\r\n')
+        self.requests += 1
+        # headers and half of the image, then nothing until the client gives up
+        writer.write(
+            f'HTTP/1.1 200 OK\r\nContent-Type: image/jpeg\r\nContent-Length: {BODY_SIZE}\r\n\r\n'.encode()
+            + b'\xff' * (BODY_SIZE // 2)
+        )
+        await writer.drain()
+        await reader.read()
+        self.closed.set()
+        writer.close()
+
+
+async def measure_lag(stop: asyncio.Event, interval: float = 0.01) -> float:
+    loop = asyncio.get_event_loop()
+    worst = 0.
+    while not stop.is_set():
+        start = loop.time()
+        await asyncio.sleep(interval)
+        worst = max(worst, loop.time() - start - interval)
+    return worst
+
+
+def test_stalled_download_does_not_block_the_loop() -> None:
+    async def run() -> None:
+        server = StallingServer()
+        await server.start()
+        client = AsyncHttpClient(timeout=TIMEOUT)
+        stop = asyncio.Event()
+        lag = asyncio.ensure_future(measure_lag(stop))
+        start = time.monotonic()
+        with pytest.raises(asyncio.TimeoutError):
+            await client.get(f'http://127.0.0.1:{server.port}/webcam/?action=snapshot')
+        elapsed = time.monotonic() - start
+        stop.set()
+        worst_lag = await lag
+
+        assert TIMEOUT <= elapsed < TIMEOUT + 0.5
+        assert worst_lag < 0.1
+        # the half read connection is closed, not pooled
+        assert not any(client._pool.values())
+        await asyncio.wait_for(server.closed.wait(), 1.)
+        client.close()
+        await server.stop()
+
+    asyncio.run(run())
+
+
+class CannedServer:
+    '''
+    Answers each request path with a canned response head, the body being the path itself
+    '''
+    def __init__(self, responses) -> None:
+        self.responses = responses
+        self.paths = []
+
+    async def start(self) -> None:
+        self._server = await asyncio.start_server(self._handle, '127.0.0.1', 0)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self) -> None:
+        self._server.close()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                request = await reader.readuntil(b'\r\n\r\n')
+                path = request.split(b' ')[1].decode()
+                self.paths.append(path)
+                head = self.responses.get(path, 'HTTP/1.1 200 OK\r\nContent-Length: {length}\r\n')
+                writer.write(head.format(length=len(path)).encode() + b'\r\n' + path.encode())
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            writer.close()
+
+
+def test_redirects_are_followed() -> None:
+    async def run() -> None:
+        server = CannedServer({
+            '/webcam/?action=snapshot' : 'HTTP/1.1 302 Found\r\nLocation: /snapshot.jpg\r\nContent-Length: {length}\r\n',
+            '/loop' : 'HTTP/1.1 307 Temporary Redirect\r\nLocation: /loop\r\nContent-Length: {length}\r\n',
+        })
+        await server.start()
+        client = AsyncHttpClient(timeout=TIMEOUT)
+        response = await client.get(f'http://127.0.0.1:{server.port}/webcam/?action=snapshot')
+        assert (response.status, response.body) == (200, b'/snapshot.jpg')
+        assert response.url == f'http://127.0.0.1:{server.port}/snapshot.jpg'
+        with pytest.raises(HttpError):
+            await client.get(f'http://127.0.0.1:{server.port}/loop')
+        assert server.paths.count('/loop') == MAX_REDIRECTS + 1
+        client.close()
+        await server.stop()
+
+    asyncio.run(run())
+
+
+def test_malformed_content_length_raises_http_error() -> None:
+    async def run() -> None:
+        server = CannedServer({'/bad' : 'HTTP/1.1 200 OK\r\nContent-Length: 12ab\r\n'})
+        await server.start()
+        client = AsyncHttpClient(timeout=TIMEOUT)
+        with pytest.raises(HttpError):
+            await client.get(f'http://127.0.0.1:{server.port}/bad')
+        assert not any(client._pool.values())
+        client.close()
+        await server.stop()
+
+    asyncio.run(run())
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+'''
+AttachmentStore files: shared while in use, removed with their last reference,
+cleared when the printer starts again and removed on shutdown.
+'''
+import os
+
+import attachments
+from attachments import AttachmentStore
+
+
+def test_files_are_removed_with_their_last_reference(tmp_path) -> None:
+    store = AttachmentStore(str(tmp_path), 'printer')
+    data = b'\xff\xd8 snapshot'
+    first = store.create(data, '.jpeg')
+    second = store.create(data, '.jpeg')
+    assert first is second
+    with first as path:
+        assert open(path, 'rb').read() == data
+    assert os.path.exists(path)
+    second.release()
+    assert not os.path.exists(path)
+    assert len(store) == 0
+    store.cleanup()
+
+
+def test_leftovers_are_cleared_at_start_and_removed_on_shutdown(tmp_path, monkeypatch) -> None:
+    monkeypatch.setattr(attachments, 'TMPFS_DIRS', [str(tmp_path)])
+    store = AttachmentStore(str(tmp_path / 'fallback'), 'printer')
+    # a run that was killed while uploading
+    leftover = store.create(b'in flight', '.jpeg').path
+    restarted = AttachmentStore(str(tmp_path / 'fallback'), 'printer')
+    assert restarted.dir == store.dir
+    assert not os.path.exists(leftover)
+    other = AttachmentStore(str(tmp_path / 'fallback'), 'other')
+    assert other.dir != restarted.dir
+    path = restarted.create(b'in flight', '.jpeg').path
+    restarted.cleanup()
+    other.cleanup()
+    assert not os.path.exists(path)
+    assert os.listdir(str(tmp_path)) == []
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+'''
+Camera settings saved by older versions of the bot are still loaded.
+'''
+import asyncio
+import json
+
+import pytest
+
+
+def test_legacy_camera_settings_are_loaded(make_printer, tmp_path) -> None:
+    with open(str(tmp_path / 'config' / 'camera.json'), 'w') as file:
+        json.dump({'1' : {'rotate' : '180'}, '2' : {'rotate' : '90', 'max_size' : ' 640', 'use' : ['status']}}, file)
+
+    async def run() -> None:
+        printer = make_printer('/nonexistent.sock')
+        assert printer.camera_settings == {'1' : {'rotate' : 180}, '2' : {'rotate' : 90, 'max_size' : 640, 'use' : ['status']}}
+
+    asyncio.run(run())
+
+
+def test_invalid_camera_settings_are_rejected() -> None:
+    pytest.importorskip('pykeybasebot')
+    from KeybaseBot import _validate_cameras
+    from config_store import ConfigError
+
+    for settings in ({'rotate' : 'upside down'}, {'rotate' : 1.5}, {'use' : 'status'}):
+        with pytest.raises(ConfigError):
+            _validate_cameras({'1' : settings})
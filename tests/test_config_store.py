@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+'''
+Configuration files are reloaded off the event loop, and an invalid file
+never stops the bot: it starts with the defaults and keeps its current
+content on reload.
+'''
+import asyncio
+import json
+import os
+import threading
+
+from config_store import ConfigError, ConfigFile
+
+
+def validate(data):
+    if not isinstance(data, dict) or not isinstance(data.get('level', 0), int):
+        raise ConfigError("level must be an int")
+    return data
+
+
+def write(path, content: str) -> None:
+    with open(path, 'w') as file:
+        file.write(content)
+    # the modification time has a coarse resolution on some filesystems
+    stat = os.stat(path)
+    os.utime(path, (stat.st_atime, stat.st_mtime + 1))
+
+
+def test_invalid_file_at_startup_falls_back_to_the_defaults(tmp_path) -> None:
+    path = str(tmp_path / 'service.json')
+    write(path, '{"level": "high"')
+    config = ConfigFile(path, {'level' : 1}, validate)
+    assert config.data == {'level' : 1}
+    assert config.errors == 1
+    # the file is left for the user to fix
+    with open(path) as file:
+        assert file.read() == '{"level": "high"'
+
+    async def run() -> None:
+        assert not await config.check()
+        write(path, '{"level": 2}')
+        assert await config.check()
+        assert config.data == {'level' : 2}
+
+    asyncio.run(run())
+
+
+def test_reload_reads_off_the_loop_and_keeps_the_content_when_invalid(tmp_path, monkeypatch) -> None:
+    path = str(tmp_path / 'service.json')
+    config = ConfigFile(path, {'level' : 1}, validate)
+    changes = []
+    config.subscribe(lambda old, new: changes.append((old, new)))
+    threads = []
+    read = ConfigFile._read
+
+    def record(self):
+        threads.append(threading.current_thread())
+        return read(self)
+
+    monkeypatch.setattr(ConfigFile, '_read', record)
+
+    async def run() -> None:
+        write(path, '{"level": "high"}')
+        assert not await config.check()
+        assert config.data == {'level' : 1}
+        write(path, json.dumps({'level' : 3}))
+        assert await config.check()
+
+    asyncio.run(run())
+    assert changes == [({'level' : 1}, {'level' : 3})]
+    assert config.errors == 1
+    assert threads and threading.main_thread() not in threads
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+'''
+emergency_stop goes through the priority path: its request reaches Moonraker
+while slow status and snapshot commands are still queued or running.
+'''
+import asyncio
+import json
+
+from bench_framer import CAPTURE, load_capture
+from fake_keybase import FakeBot
+from fake_moonraker import FakeMoonraker
+from fake_webcam import FakeWebcam
+
+MOONRAKER_LATENCY = 0.3
+WEBCAM_LATENCY = 0.5
+
+
+def test_emergency_stop_overtakes_the_queued_commands(make_printer, tmp_path, sockpath, wait_for, methods) -> None:
+    with open(str(tmp_path / 'config' / 'camera.json'), 'w') as file:
+        json.dump({'1' : {'rotate' : 0, 'use' : ['default', 'status']}}, file)
+
+    async def run() -> None:
+        server = FakeMoonraker(sockpath, latency=MOONRAKER_LATENCY)
+        webcam = FakeWebcam(latency=WEBCAM_LATENCY, size=1024)
+        await server.start()
+        await webcam.start()
+        printer = make_printer(sockpath, http_host=webcam.http_host)
+        task = asyncio.ensure_future(printer.run_moonraker())
+        await wait_for(lambda: printer.printer_state.ready)
+        # the stream keeps the bot busy with recorded notifications
+        replay = asyncio.ensure_future(server.replay(load_capture(CAPTURE), 500.))
+
+        queued = [
+            asyncio.ensure_future(printer(printer.bot, FakeBot.message(text)))
+            for text in ('/uboe_bot status', '/uboe_bot snapshot', '/uboe_bot status', '/uboe_bot snapshot')
+        ]
+        await asyncio.sleep(0.05)
+        stop = asyncio.ensure_future(printer(printer.bot, FakeBot.message('/uboe_bot emergency_stop')))
+        await wait_for(lambda: 'printer.emergency_stop' in methods(server))
+        assert not any(command.done() for command in queued)
+
+        await asyncio.wait_for(stop, 2.)
+        assert 'Emergency stop confirmed' in printer.bot.chat.messages[-1].text
+        stats = printer.emergency_stats
+        assert stats['count'] == 1
+        assert 0. <= stats['last_write_ms'] == stats['max_write_ms'] < MOONRAKER_LATENCY * 1000
+        assert stats['last_confirm_ms'] >= MOONRAKER_LATENCY * 1000
+
+        await asyncio.gather(*queued)
+        replay.cancel()
+        task.cancel()
+        await asyncio.gather(replay, task, return_exceptions=True)
+        await printer.close()
+        await webcam.stop()
+        await server.stop()
+
+    asyncio.run(run())
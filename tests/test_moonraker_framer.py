@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+'''
+EtxFramer on recorded traffic: frames split across reads are rebuilt and the
+buffer is trimmed in place, without copies, while the consumer iterates.
+'''
+import json
+
+import pytest
+
+from bench_framer import CAPTURE, load_capture
+from moonraker_framer import EtxFramer, NotificationFilter
+
+
+@pytest.mark.parametrize('read_size', [7, 512, 65536])
+def test_frames_are_rebuilt_without_buffer_copies(read_size: int) -> None:
+    frames = load_capture(CAPTURE)
+    stream = b''.join(frames) * 3
+    framer = EtxFramer(use_orjson=False)
+    decoded = []
+    for i in range(0, len(stream), read_size):
+        framer.feed(stream[i:i + read_size])
+        for frame in framer:
+            decoded.append(framer.decode(frame))
+    assert decoded == [json.loads(f[:-1]) for f in frames] * 3
+    assert framer.copies == 0
+    assert len(framer) == 0
+
+
+def test_frame_is_released_when_the_iteration_moves_on() -> None:
+    framer = EtxFramer()
+    framer.feed(b'{"id": 1}\x03{"id": 2}\x03')
+    frames = list(framer)
+    assert len(frames) == 2
+    with pytest.raises(ValueError):
+        frames[0].tobytes()
+    framer.feed(b'{"id": 3}\x03')
+    assert [framer.decode(f) for f in framer] == [{'id' : 3}]
+    assert framer.copies == 0
+
+
+@pytest.mark.parametrize('prefilter', [True, False])
+def test_notification_filter(prefilter: bool) -> None:
+    notify_filter = NotificationFilter(['notify_status_update'], prefilter)
+    framer = EtxFramer()
+    framer.feed(
+        b'{"jsonrpc": "2.0", "method": "notify_status_update", "params": [{}, 1.0]}\x03'
+        b'{"jsonrpc": "2.0", "method": "notify_proc_stat_update", "params": [{}]}\x03'
+        b'{"jsonrpc": "2.0", "result": "ok", "id": 3}\x03'
+    )
+    kept = []
+    for frame in framer:
+        if not notify_filter.accept(frame):
+            continue
+        item = framer.decode(frame)
+        if notify_filter.accept_item(item):
+            kept.append(item.get('method', item.get('id')))
+    assert kept == ['notify_status_update', 3]
+    assert notify_filter.stats() == {
+        'handled' : {'notify_status_update' : 1, 'response' : 1}, 'dropped' : {'notify_proc_stat_update' : 1}
+    }
+    notify_filter.allowlist = ['notify_status_update', 'notify_proc_stat_update']
+    framer.feed(b'{"jsonrpc": "2.0", "method": "notify_proc_stat_update", "params": [{}]}\x03')
+    assert all(notify_filter.accept(f) and notify_filter.accept_item(framer.decode(f)) for f in framer)
+
+
+def test_notification_filter_counts_decoded_frames_with_orjson() -> None:
+    pytest.importorskip('orjson')
+    notify_filter = NotificationFilter(['notify_status_update'])
+    assert not notify_filter.prefilter
+    items = [
+        {'jsonrpc' : '2.0', 'method' : 'notify_status_update', 'params' : [{}, 1.0]},
+        {'jsonrpc' : '2.0', 'method' : 'notify_status_update', 'params' : [{}, 2.0]},
+        {'jsonrpc' : '2.0', 'method' : 'notify_proc_stat_update', 'params' : [{}]},
+    ]
+    assert [notify_filter.accept_item(item) for item in items] == [True, True, False]
+    assert notify_filter.stats() == {'handled' : {'notify_status_update' : 2}, 'dropped' : {'notify_proc_stat_update' : 1}}
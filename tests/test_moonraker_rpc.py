@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+'''
+Stress test of MoonrakerRpc against the fake Moonraker socket: concurrent
+call() and call_batch() with responses arriving out of order. Every request
+gets a unique id and every caller gets its own response back.
+'''
+import asyncio
+
+from fake_moonraker import FakeMoonraker
+from moonraker_framer import EtxFramer, READ_SIZE
+from moonraker_rpc import ConnectionLostError, MoonrakerRpc
+
+CALLS = 300
+BATCHES = 50
+BATCH_SIZE = 5
+
+
+async def read_responses(reader: asyncio.StreamReader, rpc: MoonrakerRpc) -> None:
+    framer = EtxFramer()
+    while True:
+        data = await reader.read(READ_SIZE)
+        if not data:
+            rpc.detach()
+            return
+        framer.feed(data)
+        for frame in framer:
+            rpc.resolve(framer.decode(frame))
+
+
+async def connect(server: FakeMoonraker) -> MoonrakerRpc:
+    reader, writer = await asyncio.open_unix_connection(server.sockpath)
+    rpc = MoonrakerRpc(default_timeout=5.)
+    rpc.attach(writer)
+    asyncio.ensure_future(read_responses(reader, rpc))
+    return rpc
+
+
+def test_concurrent_calls_and_batches(sockpath) -> None:
+    async def run() -> None:
+        server = FakeMoonraker(
+            sockpath, latency=0.001, jitter=0.02,
+            results={'echo' : lambda params: params}
+        )
+        await server.start()
+        rpc = await connect(server)
+
+        async def single(i: int) -> None:
+            response = await rpc.call('echo', {'n' : i})
+            assert response['result'] == {'n' : i}
+
+        async def batch(i: int) -> None:
+            calls = [('echo', {'n' : i, 'k' : k}) for k in range(BATCH_SIZE)]
+            responses = await rpc.call_batch(calls)
+            assert [r['result'] for r in responses] == [params for _, params in calls]
+
+        await asyncio.gather(*[single(i) for i in range(CALLS)], *[batch(i) for i in range(BATCHES)])
+
+        ids = [r['id'] for r in server.requests]
+        assert len(ids) == CALLS + BATCHES * BATCH_SIZE
+        assert len(set(ids)) == len(ids)
+        assert not rpc.pending_reqs
+        await server.stop()
+
+    asyncio.run(run())
+
+
+def test_pending_calls_fail_when_the_connection_drops(sockpath) -> None:
+    async def run() -> None:
+        server = FakeMoonraker(sockpath, latency=1.)
+        await server.start()
+        rpc = await connect(server)
+        calls = asyncio.gather(*[rpc.call('printer.info') for _ in range(20)], return_exceptions=True)
+        await asyncio.sleep(0.05)
+        await server.stop()
+        results = await asyncio.wait_for(calls, 2.)
+        assert all(isinstance(r, ConnectionLostError) for r in results)
+        assert not rpc.pending_reqs
+
+    asyncio.run(run())
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+'''
+A flapping sensor reports when it starts and once it settles, with the number
+of events suppressed in between, and invalid policies are rejected.
+'''
+import asyncio
+import json
+
+import pytest
+
+from notification_policy import NotificationPolicy
+
+
+def test_debounce_releases_the_last_event_once_settled() -> None:
+    policy = NotificationPolicy({'notify_check_failure' : {'debounce' : 10.}})
+    assert policy.check('notify_check_failure', now=0.) == 0
+    for now in (1., 2., 3.):
+        assert policy.check('notify_check_failure', now=now) is None
+    assert policy.held_for('notify_check_failure', now=5.) == 8.
+    assert policy.settle('notify_check_failure', now=5.) is None
+    assert policy.settle('notify_check_failure', now=13.) == 2
+    assert policy.held_for('notify_check_failure', now=14.) is None
+    assert policy.stats() == {'notify_check_failure' : {'passed' : 2, 'suppressed' : 2, 'held_dropped' : 0}}
+    # quiet since, the next event is sent right away
+    assert policy.check('notify_check_failure', now=30.) == 0
+
+
+def test_released_event_is_charged_to_the_rate_limit() -> None:
+    policy = NotificationPolicy({'notify_check_failure' : {'debounce' : 1., 'rate_per_minute' : 1., 'burst' : 2}})
+    assert policy.check('notify_check_failure', now=0.) == 0
+    assert policy.check('notify_check_failure', now=0.5) is None
+    assert policy.settle('notify_check_failure', now=1.5) == 0
+    # the release took the last token of the burst
+    assert policy.check('notify_check_failure', now=3.) is None
+    assert policy.check('notify_check_failure', now=3.5) is None
+    assert policy.settle('notify_check_failure', now=4.5) is None
+    assert policy.held_for('notify_check_failure', now=4.5) is None
+    assert policy.stats()['notify_check_failure'] == {'passed' : 2, 'suppressed' : 2, 'held_dropped' : 1}
+    assert policy.check('notify_check_failure', now=70.) == 2
+
+
+def test_rate_limited_event_drops_the_held_one() -> None:
+    policy = NotificationPolicy({'notify_check_failure' : {'debounce' : 1., 'rate_per_minute' : 1., 'burst' : 1}})
+    assert policy.check('notify_check_failure', now=0.) == 0
+    assert policy.check('notify_check_failure', now=0.5) is None
+    # past the debounce, before the release, and over the rate
+    assert policy.check('notify_check_failure', now=2.) is None
+    assert policy.held_for('notify_check_failure', now=3.) is None
+    assert policy.settle('notify_check_failure', now=3.) is None
+    assert policy.stats()['notify_check_failure'] == {'passed' : 1, 'suppressed' : 2, 'held_dropped' : 1}
+
+
+def test_rate_limited_events_are_not_held() -> None:
+    policy = NotificationPolicy({'paused' : {'rate_per_minute' : 1., 'burst' : 1}})
+    assert policy.check('paused', now=0.) == 0
+    assert policy.check('paused', now=1.) is None
+    assert policy.held_for('paused', now=100.) is None
+    assert policy.check('paused', now=60.) == 1
+
+
+def test_service_config_validates_the_rule_values() -> None:
+    pytest.importorskip('pykeybasebot')
+    from KeybaseBot import ServiceConfig
+    from config_store import ConfigError
+
+    values = ServiceConfig._validate({'notify_policy' : {'paused' : {'debounce' : 5, 'burst' : 2}}})
+    assert values['notify_policy'] == {'paused' : {'debounce' : 5., 'burst' : 2.}}
+    for rule in ({'debounce' : '5'}, {'burst' : True}, {'rate_per_minute' : -1}, {'delay' : 1}, 3):
+        with pytest.raises(ConfigError):
+            ServiceConfig._validate({'notify_policy' : {'paused' : rule}})
+
+
+def test_bot_sends_the_held_notification_once_settled(make_printer, tmp_path) -> None:
+    with open(str(tmp_path / 'config' / 'service.json'), 'w') as file:
+        json.dump({'notify_digest_window' : 0, 'notify_policy' : {'notify_check_failure' : {'debounce' : 0.2}}}, file)
+
+    async def run() -> None:
+        printer = make_printer('/nonexistent.sock')
+        sent = []
+        printer.notifications.submit = lambda kind, message, **options: sent.append(message)
+        for i in range(4):
+            printer._handle_item({'method' : 'notify_check_failure', 'params' : [{'message' : f'runout {i}'}]})
+            await asyncio.sleep(0.05)
+        assert sent == ["Check filament failure: \nrunout 0"]
+        await asyncio.sleep(0.3)
+        assert sent[1:] == ["Check filament failure: \nrunout 3\n(2 similar events suppressed)"]
+
+    asyncio.run(run())
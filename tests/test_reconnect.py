@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+'''
+The bot keeps running when Moonraker restarts: it reconnects in process,
+identifies and subscribes again, and answers commands sent during the outage.
+'''
+import asyncio
+
+from fake_keybase import FakeBot
+from fake_moonraker import FakeMoonraker
+
+# covers the first delays of the reconnection backoff (0.5s, 1s, 2s at most)
+RECONNECT_TIMEOUT = 5.
+
+
+def test_reconnects_and_resubscribes_after_a_moonraker_restart(make_printer, sockpath, wait_for, methods) -> None:
+    async def run() -> None:
+        server = FakeMoonraker(sockpath)
+        await server.start()
+        printer = make_printer(server.sockpath)
+        task = asyncio.ensure_future(printer.run_moonraker())
+        await wait_for(lambda: printer.printer_state.ready)
+        assert methods(server) == ['server.connection.identify', 'printer.objects.subscribe']
+
+        await server.stop()
+        await wait_for(lambda: not printer.connected)
+        assert not printer.printer_state.ready
+        # a command during the outage gets an answer instead of hanging
+        await asyncio.wait_for(printer(printer.bot, FakeBot.message('/uboe_bot status')), 2.)
+        assert 'Moonraker is not connected' in printer.bot.chat.messages[-1].text
+
+        server.requests.clear()
+        await server.start()
+        await wait_for(lambda: printer.printer_state.ready, RECONNECT_TIMEOUT)
+        assert methods(server) == ['server.connection.identify', 'printer.objects.subscribe']
+        assert printer.reconnect_stats['disconnects'] == 1
+
+        # the new connection is used by commands
+        await printer(printer.bot, FakeBot.message('/uboe_bot status'))
+        assert 'Moonraker is not connected' not in printer.bot.chat.messages[-1].text
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        await printer.close()
+        await server.stop()
+
+    asyncio.run(run())
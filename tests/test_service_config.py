@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+'''
+The notifications the bot depends on are always decoded, whatever
+notify_allowlist says, and only its extra entries are kept in service.json.
+'''
+import asyncio
+import json
+
+import pytest
+
+
+def test_allowlist_keeps_only_the_extra_notifications() -> None:
+    pytest.importorskip('pykeybasebot')
+    from KeybaseBot import HANDLED_NOTIFICATIONS, ServiceConfig
+    from config_store import ConfigError
+
+    assert ServiceConfig._validate({})['notify_allowlist'] == []
+    # files written by older versions list every handled notification
+    values = ServiceConfig._validate({'notify_allowlist' : HANDLED_NOTIFICATIONS + ['notify_gcode_response'] * 2})
+    assert values['notify_allowlist'] == ['notify_gcode_response']
+    for allowlist in (['notify_status_updat'], [3]):
+        with pytest.raises(ConfigError):
+            ServiceConfig._validate({'notify_allowlist' : allowlist})
+
+
+def test_handled_notifications_are_decoded_without_the_allowlist(make_printer, tmp_path) -> None:
+    service_path = tmp_path / 'config' / 'service.json'
+    with open(str(service_path), 'w') as file:
+        json.dump({'notify_allowlist' : ['notify_gcode_response']}, file)
+
+    async def run() -> None:
+        printer = make_printer('/nonexistent.sock')
+        assert {'notify_status_update', 'notify_webcams_changed', 'notify_gcode_response'} <= printer.notify_filter.allowlist
+        await printer.service_config.update(notify_allowlist=[])
+        assert 'notify_gcode_response' not in printer.notify_filter.allowlist
+        assert {'notify_status_update', 'notify_webcams_changed'} <= printer.notify_filter.allowlist
+        with open(str(service_path)) as file:
+            assert json.load(file)['notify_allowlist'] == []
+
+    asyncio.run(run())
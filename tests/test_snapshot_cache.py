@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+'''
+Concurrent snapshot requests share one fetch, and a fetch running when the
+camera settings change is neither stored nor shared with later requests.
+'''
+import asyncio
+
+from snapshot_cache import SnapshotCache
+
+
+def test_concurrent_requests_share_a_fetch() -> None:
+    fetches = []
+
+    async def fetch() -> bytes:
+        fetches.append(1)
+        await asyncio.sleep(0.01)
+        return b'image'
+
+    async def run() -> None:
+        cache = SnapshotCache(max_age=10.)
+        assert await asyncio.gather(*[cache.get('1', fetch) for _ in range(5)]) == [b'image'] * 5
+        assert await cache.get('1', fetch) == b'image'
+        assert len(fetches) == 1
+        assert cache.stats()['coalesced'] == 4
+
+    asyncio.run(run())
+
+
+def test_fetch_started_before_an_invalidation_is_discarded() -> None:
+    rotation = {'value' : 0}
+
+    async def run() -> None:
+        started = asyncio.Event()
+        go = asyncio.Event()
+
+        async def fetch() -> bytes:
+            value = rotation['value']
+            started.set()
+            await go.wait()
+            return f'rotate={value}'.encode()
+
+        cache = SnapshotCache(max_age=10.)
+        stale = asyncio.ensure_future(cache.get('1', fetch))
+        await started.wait()
+        rotation['value'] = 180
+        cache.invalidate('1')
+        fresh = asyncio.ensure_future(cache.get('1', fetch))
+        await asyncio.sleep(0)
+        go.set()
+        assert await stale == b'rotate=0'
+        assert await fresh == b'rotate=180'
+        # only the fetch started after the change was stored
+        assert await cache.get('1', fetch) == b'rotate=180'
+        assert cache.stats()['misses'] == 2
+
+    asyncio.run(run())
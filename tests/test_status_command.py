@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+'''
+The status command gets the printer state and the snapshots concurrently,
+without requesting the same data from Moonraker twice.
+'''
+import asyncio
+import json
+
+from fake_keybase import FakeBot
+from fake_moonraker import FakeMoonraker
+from fake_webcam import FakeWebcam
+
+
+def test_status_requests_the_webcam_list_once(make_printer, tmp_path, sockpath, wait_for, methods) -> None:
+    with open(str(tmp_path / 'config' / 'camera.json'), 'w') as file:
+        json.dump({'1' : {'rotate' : 0, 'use' : ['default', 'status']}}, file)
+
+    async def run() -> None:
+        server = FakeMoonraker(sockpath)
+        webcam = FakeWebcam()
+        await server.start()
+        await webcam.start()
+        printer = make_printer(server.sockpath, http_host=webcam.http_host)
+        task = asyncio.ensure_future(printer.run_moonraker())
+        await wait_for(lambda: printer.printer_state.ready)
+        assert not printer.webcams.is_fresh
+
+        await printer(printer.bot, FakeBot.message('/uboe_bot status'))
+        assert methods(server).count('server.webcams.list') == 1
+        assert webcam.requests == 1
+        assert printer.webcams.is_fresh
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        await printer.close()
+        # a Moonraker disconnect keeps the webcam connections pooled
+        assert any(printer.http._pool.values())
+        await webcam.stop()
+        await server.stop()
+
+    asyncio.run(run())
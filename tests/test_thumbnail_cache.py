@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+'''
+Thumbnails are downloaded once per gcode file, the disk cache survives a
+restart and its files are only touched from the executor.
+'''
+import asyncio
+import os
+import threading
+
+import thumbnail_cache
+from thumbnail_cache import ThumbnailCache
+
+
+def test_disk_cache_survives_a_restart_and_evicts_lru(tmp_path) -> None:
+    cache_dir = str(tmp_path / 'thumbnails')
+    downloads = []
+
+    def fetch(data: bytes):
+        async def download() -> bytes:
+            downloads.append(data)
+            return data
+        return download
+
+    async def run() -> None:
+        cache = ThumbnailCache(cache_dir, max_bytes=250)
+        assert await cache.get('a', fetch(b'a' * 100)) == b'a' * 100
+        assert await cache.get('a', fetch(b'a' * 100)) == b'a' * 100
+        await cache.get('b', fetch(b'b' * 100))
+
+        cache = ThumbnailCache(cache_dir, max_bytes=250, memory_entries=0)
+        assert await cache.get('a', fetch(b'a' * 100)) == b'a' * 100
+        assert cache.stats()['disk_hits'] == 1
+        # 'b' is the least recently used file
+        await cache.get('c', fetch(b'c' * 100))
+        assert cache.stats()['evictions'] == 1
+        assert sorted(os.listdir(cache_dir)) == ['a.png', 'c.png']
+
+    asyncio.run(run())
+    assert downloads == [b'a' * 100, b'b' * 100, b'c' * 100]
+
+
+def test_files_are_accessed_off_the_event_loop(tmp_path, monkeypatch) -> None:
+    threads = []
+    for name in ('_list_files', '_read_file', '_write_file'):
+        def record(*args, _call=getattr(thumbnail_cache, name)):
+            threads.append(threading.current_thread())
+            return _call(*args)
+        monkeypatch.setattr(thumbnail_cache, name, record)
+
+    async def fetch() -> bytes:
+        return b'png'
+
+    async def run() -> None:
+        cache = ThumbnailCache(str(tmp_path / 'thumbnails'), memory_entries=0)
+        await cache.get('a', fetch)
+        await cache.get('a', fetch)
+        assert cache.stats()['disk_hits'] == 1
+
+    asyncio.run(run())
+    assert len(threads) == 3
+    assert threading.main_thread() not in threads
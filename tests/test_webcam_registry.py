@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+'''
+Lookups made while the webcam list is being fetched wait for that fetch
+instead of requesting the list again.
+'''
+import asyncio
+
+from webcam_registry import WebcamRegistry
+
+WEBCAMS = [{'name' : 'cam', 'snapshot_url' : '/webcam/?action=snapshot'}]
+
+
+def test_lookups_share_the_announced_fetch() -> None:
+    loads = []
+
+    async def loader():
+        loads.append(1)
+        return WEBCAMS
+
+    async def run() -> None:
+        registry = WebcamRegistry(loader)
+        fetch = registry.expect()
+        assert registry.expect() is None
+        lookup = asyncio.ensure_future(registry.get_snapshot_url(1))
+        await asyncio.sleep(0)
+        fetch.set_result(WEBCAMS)
+        assert await lookup == '/webcam/?action=snapshot'
+        assert registry.is_fresh
+        assert not loads
+
+    asyncio.run(run())
+
+
+def test_concurrent_lookups_load_once() -> None:
+    loads = []
+
+    async def loader():
+        loads.append(1)
+        await asyncio.sleep(0.01)
+        return WEBCAMS
+
+    async def run() -> None:
+        registry = WebcamRegistry(loader)
+        urls = await asyncio.gather(*[registry.get_snapshot_url(1) for _ in range(5)])
+        assert urls == ['/webcam/?action=snapshot'] * 5
+        assert len(loads) == 1
+
+    asyncio.run(run())
+
+
+def test_a_failed_fetch_is_not_cached() -> None:
+    async def loader():
+        return WEBCAMS
+
+    async def run() -> None:
+        registry = WebcamRegistry(loader)
+        registry.expect().set_exception(LookupError("Webcam list not retrieved"))
+        await asyncio.sleep(0)
+        assert not registry.is_fresh
+        assert await registry.get() == WEBCAMS
+
+    asyncio.run(run())
@@ -20,46 +20,241 @@ Heavily inspired by :
 '''
 from __future__ import annotations
 from math import log
+import copy
 import os
 import sys
 import asyncio
 import pathlib
 import json
-import shutil
 import textwrap
-import re
-import requests
 import datetime
-from PIL import Image
+import time
+import random
+import signal
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 import pykeybasebot.types.chat1 as chat1
 from pykeybasebot import Bot
 import logging
 
-from typing import Any, Dict, List, Optional
+from async_http import AsyncHttpClient
+from webcam_registry import WebcamRegistry
+from printer_state import PrinterState, STATUS_OBJECTS
+from moonraker_rpc import ConnectionLostError, MoonrakerRpc
+from snapshot_image import needs_processing, process_snapshot
+from snapshot_cache import SnapshotCache
+from attachments import Attachment, AttachmentStore
+from command_router import Arg, CommandRouter
+from command_scheduler import CommandScheduler, SchedulerBusyError
+from notification_policy import NotificationPolicy
+from notification_queue import Notification, NotificationQueue
+from thumbnail_cache import ThumbnailCache, select_thumbnail, thumbnail_key
+from moonraker_framer import EtxFramer, FrameTooLargeError, NotificationFilter, READ_SIZE
+from metrics import REGISTRY, serve_metrics
+from startup_timings import STARTUP
+from config_store import CONFIG, ConfigError, ConfigFile, check_type
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
 
 this_dir = os.path.dirname(os.path.abspath(__file__))
 
 SOCKET_LIMIT = 20 * 1024 * 1024
+# per camera deadline (in seconds) for a snapshot capture
+SNAPSHOT_TIMEOUT = 5.
+# threads used to rotate/downscale/encode snapshots
+IMAGE_WORKERS = 2
+# printer.emergency_stop request serialized once, written by the priority path (see KeybaseBot.emergency_stop)
+EMERGENCY_STOP_FRAME = MoonrakerRpc.prebuild("printer.emergency_stop")
+EMERGENCY_STOP_WORDS = ['/uboe_bot', 'emergency_stop']
+# time (in seconds) Moonraker has to confirm an emergency stop
+EMERGENCY_STOP_TIMEOUT = 2.
+# chat commands waiting for a free handler before new ones get a busy reply
+COMMAND_QUEUE_SIZE = 8
+# bounds (in seconds) of the Moonraker reconnection backoff
+RECONNECT_MIN_DELAY = 0.5
+RECONNECT_MAX_DELAY = 30.
 MENU = [
     "List API Request Presets",
     "Select API Request Preset",
     "Manual API Entry",
     "Start Notification View",
 ]
-LISTEN_OPTIONS = {
-    "filter-channels": [
-        {'name' : 'printhive', 'public' : None, 'members_type' : 'team', 'topic_type' : 'chat', 'topic_name' : "printfarm"},
-        {'name' : 'printhive', 'public' : None, 'members_type' : 'team', 'topic_type' : 'chat', 'topic_name' : os.uname().nodename}
-    ]
-}
-ALLOWED_USERS = json.load(open(os.path.join(this_dir, '..', 'config', 'allowed_users.json'), 'r'))
+KEYBASE_TEAM = 'printhive'
+# channel shared by every printer of the farm
+PRINTFARM_CHANNEL = 'printfarm'
+KEYBASED_PID_FILE = '/run/user/1000/keybase/keybased.pid'
+
+
+def listen_options(channels : List[str]) -> Dict[str, Any]:
+    '''
+    Keybase listen options
+    @param channels: Printer channels, the printfarm channel is always listened to
+    '''
+    return {
+        "filter-channels": [
+            {'name' : KEYBASE_TEAM, 'public' : None, 'members_type' : 'team', 'topic_type' : 'chat', 'topic_name' : name}
+            for name in [PRINTFARM_CHANNEL] + channels
+        ]
+    }
+
+
+def team_channel(topic_name : str) -> chat1.ChatChannel:
+    '''
+    @param topic_name: Channel name in the keybase team
+    @return: Channel to send messages to
+    '''
+    return chat1.ChatChannel(
+        name=KEYBASE_TEAM, public=None, members_type='team', topic_type='chat', topic_name=topic_name
+    )
+
+
+def create_bot(paperkey : str, handler : Any, logger : logging.Logger) -> Bot:
+    '''
+    Create the Keybase bot session
+    @param paperkey: Path of the file holding the Keybase paperkey
+    @param handler: Chat event handler
+    @param logger: Logger instance
+    '''
+    # get paperkey from file
+    with open(paperkey, 'r') as file:
+        key = file.read().replace('\n', '')
+    # if pidfile exists use it to connect the bot
+    if os.path.isfile(KEYBASED_PID_FILE):
+        logger.info("PID file exists")
+        return Bot(username="uboe_bot", paperkey=key, handler=handler, pid_file=KEYBASED_PID_FILE, loop=None)
+    return Bot(username="uboe_bot", paperkey=key, handler=handler, loop=None)
+
+
+LISTEN_OPTIONS = listen_options([os.uname().nodename])
+
+
+def _validate_users(data : Any) -> List[str]:
+    if not isinstance(data, list) or not all(isinstance(user, str) for user in data):
+        raise ConfigError("allowed users must be a list of Keybase user names")
+    return data
+
+
+def _validate_cameras(data : Any) -> Dict[str, Dict[str, Any]]:
+    if not isinstance(data, dict):
+        raise ConfigError("the camera settings must be a JSON object")
+    cameras = {}
+    for id, settings in data.items():
+        if not isinstance(settings, dict):
+            raise ConfigError(f"settings of camera {id} must be a JSON object")
+        settings = dict(settings)
+        for key, expected in (('rotate', int), ('max_size', int), ('use', list)):
+            if key not in settings:
+                continue
+            value = settings[key]
+            # the camera command of older versions saved numbers as strings ("rotate": "180")
+            if expected is int and isinstance(value, str) and value.strip().lstrip('-').isdigit():
+                value = int(value)
+            settings[key] = check_type(f"{id}.{key}", value, expected)
+        cameras[id] = settings
+    return cameras
+
+
+@lru_cache(maxsize=None)
+def _allowed_users_file() -> ConfigFile:
+    return CONFIG.open(os.path.join(this_dir, '..', 'config', 'allowed_users.json'), [], _validate_users)
+
+
+def allowed_users() -> List[str]:
+    '''
+    Users allowed to run the restricted commands, config/allowed_users.json is read on the first command
+    and reloaded when it changes
+    '''
+    return _allowed_users_file().data
+
 
 _LOG_LEVELS = {'DEBUG': 0, 'INFO': 1, 'WARNING': 2, 'ERROR': 3, 'CRITICAL': 4}
+# Moonraker notifications handled by the bot, always decoded: the printer state, webcam list and
+# notifications depend on them. Any other one is dropped before being decoded unless it is in
+# ServiceConfig.notify_allowlist.
+HANDLED_NOTIFICATIONS = [
+    'notify_history_changed',
+    'notify_check_failure',
+    'notify_status_update',
+    'notify_klippy_ready',
+    'notify_klippy_shutdown',
+    'notify_klippy_disconnected',
+    'notify_active_spool_set',
+    'notify_webcams_changed',
+]
+# other notifications Moonraker sends, the only names accepted in ServiceConfig.notify_allowlist
+MOONRAKER_NOTIFICATIONS = [
+    'notify_gcode_response',
+    'notify_filelist_changed',
+    'notify_update_response',
+    'notify_update_refreshed',
+    'notify_cpu_throttled',
+    'notify_proc_stat_update',
+    'notify_user_created',
+    'notify_user_deleted',
+    'notify_user_logged_out',
+    'notify_service_state_changed',
+    'notify_job_queue_changed',
+    'notify_button_event',
+    'notify_announcement_update',
+    'notify_announcement_dismissed',
+    'notify_announcement_wake',
+    'notify_sudo_alert',
+    'notify_power_changed',
+    'notify_spoolman_status_changed',
+    'notify_agent_event',
+    'sensors:sensor_update',
+]
+# chat commands, registered by the KeybaseBot methods decorated with COMMANDS.command
+COMMANDS = CommandRouter('/uboe_bot')
+
+# metrics served on ServiceConfig.metrics_listen, labelled by printer
+RPC_DURATION = REGISTRY.histogram(
+    'keybase_bot_moonraker_rpc_duration_seconds', 'Moonraker JSON-RPC round trip', ['printer', 'method']
+)
+RPC_PENDING = REGISTRY.gauge('keybase_bot_moonraker_pending_requests', 'Moonraker requests waiting for a response', ['printer'])
+MOONRAKER_FRAMES = REGISTRY.counter('keybase_bot_moonraker_frames_total', 'Frames parsed from the Moonraker socket', ['printer'])
+MOONRAKER_CONNECTED = REGISTRY.gauge('keybase_bot_moonraker_connected', '1 while the Moonraker socket is connected', ['printer'])
+SNAPSHOT_DURATION = REGISTRY.histogram(
+    'keybase_bot_snapshot_duration_seconds', 'Snapshot capture, cache hits included', ['printer', 'camera']
+)
+KEYBASE_SEND_DURATION = REGISTRY.histogram(
+    'keybase_bot_keybase_send_duration_seconds', 'Keybase message and attachment sends', ['printer', 'kind']
+)
+NOTIFICATION_DEPTH = REGISTRY.gauge('keybase_bot_notification_queue_depth', 'Notifications waiting to be sent', ['printer'])
+COMMAND_QUEUE_DEPTH = REGISTRY.gauge('keybase_bot_command_queue_depth', 'Chat commands waiting for a handler', ['printer'])
+STARTUP_PHASE = REGISTRY.gauge('keybase_bot_startup_seconds', 'Time from the process start to each startup phase', ['phase'])
+
+
+def default_cache_dir(name : str) -> str:
+    '''
+    @param name: Printer name
+    @return: Thumbnail cache directory of a printer, under $XDG_CACHE_HOME (~/.cache when unset)
+    '''
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'keybase_bot', 'thumbnails', name)
+
+
+def _share_reply(reply : Any) -> None:
+    '''
+    Take an extra reference on the attachment of a reply handed to a coalesced request
+    '''
+    if isinstance(reply, tuple) and reply[1] is not None :
+        reply[1].acquire()
+
+
+def _with_suppressed(message : str, suppressed : int) -> str:
+    '''
+    @return: The message with the number of similar events the notification policy suppressed before it
+    '''
+    if not suppressed :
+        return message
+    return message + f"\n({suppressed} similar event{'s' if suppressed > 1 else ''} suppressed)"
+
 
 class ServiceConfig:
     '''
     Persistent service configuration backed by config/service.json.
-    Attribute defaults are written to disk the first time the file is absent.
+    Attribute defaults are written to disk the first time the file is absent, and are the schema of the file:
+    a setting must have the type of its default. Edits of the file are picked up without a restart.
     '''
     _path: str = os.path.join(this_dir, '..', 'config', 'service.json')
 
@@ -67,89 +262,155 @@ class ServiceConfig:
     notify_print_start: bool = True
     notify_print_end: bool = True
     log_level: str = 'INFO'
+    # fallback expiry (in seconds) of the cached webcam list, 0 keeps it until Moonraker reports a change
+    webcam_cache_ttl: float = 0.
+    # snapshots younger than this (in seconds) are served from memory, 0 disables the cache
+    snapshot_max_age: float = 2.
+    # memory cap (in bytes) of the snapshot cache
+    snapshot_cache_bytes: int = 8 * 1024 * 1024
+    # disk cap (in bytes) of the gcode thumbnail cache, 0 disables it
+    thumbnail_cache_bytes: int = 16 * 1024 * 1024
+    # events of the same kind following one another within this window (in seconds) are sent as one digest, 0 disables it
+    notify_digest_window: float = 30.
+    # debounce/rate limit/suppression of the notifications per event type (job status or Moonraker method),
+    # settings: debounce (s, the last event of a burst is sent once the type settles), rate_per_minute and burst
+    # (token bucket), suppress (s after a message was sent)
+    notify_policy: Dict[str, Dict[str, float]] = {
+        'notify_check_failure' : {'debounce' : 10., 'rate_per_minute' : 2., 'burst' : 3},
+        'paused' : {'rate_per_minute' : 6., 'burst' : 3},
+        'cancelled' : {'rate_per_minute' : 6., 'burst' : 3},
+    }
+    # Moonraker notifications decoded on top of HANDLED_NOTIFICATIONS (e.g. to count them with the notifications command)
+    notify_allowlist: List[str] = []
+    # metrics endpoint: host:port or Unix socket path, empty disables it
+    metrics_listen: str = '127.0.0.1:9465'
 
-    def __init__(self) -> None:
-        os.makedirs(os.path.dirname(self._path), exist_ok=True)
-        if os.path.exists(self._path):
-            with open(self._path, 'r') as f:
-                data = json.load(f)
-            for key, value in data.items():
-                if hasattr(self, key):
-                    setattr(self, key, value)
-        else:
-            self.save()
-
-    def save(self) -> None:
-        '''Persist current settings to config/service.json.'''
-        with open(self._path, 'w') as f:
-            json.dump(self._to_dict(), f, indent=4)
-
-    def _to_dict(self) -> Dict[str, Any]:
-        return {
-            'notify_print_start': self.notify_print_start,
-            'notify_print_end': self.notify_print_end,
-            'log_level': self.log_level,
-        }
+    def __init__(self, store=CONFIG) -> None:
+        '''
+        @param store: Configuration store (see config_store), config/service.json is shared by every printer
+        '''
+        self._subscribers : List[Callable[[Set[str]], None]] = []
+        self._file = store.open(self._path, self._defaults(), self._validate)
+        self._apply(self._file.data)
+        self._file.subscribe(self._on_change)
+
+    @classmethod
+    def _defaults(cls) -> Dict[str, Any]:
+        return {key : copy.deepcopy(getattr(cls, key)) for key in cls.__annotations__ if not key.startswith('_')}
+
+    @classmethod
+    def _validate(cls, data : Any) -> Dict[str, Any]:
+        '''
+        Check every setting against the type of its default, missing settings take their default value
+        '''
+        if not isinstance(data, dict):
+            raise ConfigError("the service configuration must be a JSON object")
+        values = cls._defaults()
+        for key, value in data.items():
+            if key in values:
+                values[key] = check_type(key, value, type(values[key]))
+        values['log_level'] = values['log_level'].upper()
+        if values['log_level'] not in _LOG_LEVELS:
+            raise ConfigError(f"`log_level` must be one of {', '.join(_LOG_LEVELS)}")
+        policy = {}
+        for kind, rule in values['notify_policy'].items():
+            check_type(f"notify_policy.{kind}", rule, dict)
+            policy[kind] = {key : check_type(f"notify_policy.{kind}.{key}", value, float) for key, value in rule.items()}
+            negative = [key for key, value in policy[kind].items() if value < 0]
+            if negative:
+                raise ConfigError(f"`notify_policy.{kind}.{negative[0]}` must not be negative")
+        try :
+            values['notify_policy'] = NotificationPolicy(policy).rules
+        except ValueError as e :
+            raise ConfigError(str(e)) from e
+        extra = []
+        for i, method in enumerate(values['notify_allowlist']):
+            check_type(f"notify_allowlist[{i}]", method, str)
+            if method not in HANDLED_NOTIFICATIONS + MOONRAKER_NOTIFICATIONS:
+                raise ConfigError(f"`notify_allowlist`: unknown Moonraker notification `{method}`")
+            # the handled ones are always decoded, files written by older versions list them all
+            if method not in HANDLED_NOTIFICATIONS and method not in extra:
+                extra.append(method)
+        values['notify_allowlist'] = extra
+        return values
+
+    @property
+    def decoded_notifications(self) -> List[str]:
+        '''
+        @return: Moonraker notifications decoded by the bot, the handled ones and the extra ones of notify_allowlist
+        '''
+        return HANDLED_NOTIFICATIONS + self.notify_allowlist
+
+    def _apply(self, data : Dict[str, Any]) -> None:
+        for key, value in data.items():
+            setattr(self, key, value)
+        # numeric threshold compared by passes_log_level() for every event
+        self.log_threshold = _LOG_LEVELS[self.log_level]
+
+    def _on_change(self, old : Dict[str, Any], new : Dict[str, Any]) -> None:
+        self._apply(new)
+        changed = {key for key, value in new.items() if old.get(key) != value}
+        for callback in self._subscribers:
+            callback(changed)
+
+    def subscribe(self, callback : Callable[[Set[str]], None]) -> None:
+        '''
+        @param callback: Called with the names of the changed settings, after a save or a reload of the file
+        '''
+        self._subscribers.append(callback)
+
+    async def update(self, **changes : Any) -> None:
+        '''
+        Change settings and persist them to config/service.json
+        Raises ConfigError if a value is invalid, nothing is changed then.
+        '''
+        data = dict(self._file.data)
+        data.update(changes)
+        await self._file.save(data)
 
     def items(self):
-        return self._to_dict().items()
+        return self._file.data.items()
 
     def passes_log_level(self, event_level: str) -> bool:
         '''
         Return True if event_level is at or above the configured log_level.
         @param event_level: Severity of the event (DEBUG/INFO/WARNING/ERROR/CRITICAL)
         '''
-        configured = _LOG_LEVELS.get(self.log_level.upper(), 1)
-        event = _LOG_LEVELS.get(event_level.upper(), 1)
-        return event >= configured
+        return _LOG_LEVELS.get(event_level, 1) >= self.log_threshold
 
 
 class KeybaseBot:
     def __init__(
-        self, sockpath: pathlib.Path, presets: List[Dict[str, Any]], paperkey: str, logger : logging
+        self, sockpath: pathlib.Path, presets: List[Dict[str, Any]], paperkey: Optional[str], logger : logging,
+        bot: Optional[Bot] = None, name: Optional[str] = None, camera_config: Optional[str] = None,
+        http_host: Optional[str] = None, cache_dir: Optional[str] = None
     ) -> None:
         '''
         The class represents a Keybase bot that connects to Moonraker via a Unix Socket and to keybase via the keybase bot API.
         It is used to send messages to the keybase channel and to send commands or receive notifications from Moonraker.
         @param sockpath: Path to the Unix Socket
         @param presets: List of API presets to send to Moonraker
-        @param paperkey: Keybase paperkey
+        @param paperkey: Path of the Keybase paperkey file, unused when a bot is given
         @param logger: Logger instance
+        @param bot: Keybase session shared with other printers (see PrinterSupervisor), a new one is created if None
+        @param name: Printer name, also the name of its keybase channel (defaults to the hostname)
+        @param camera_config: Camera settings file (defaults to config/camera.json)
+        @param http_host: Moonraker HTTP host[:port] for snapshots and thumbnails (defaults to the hostname)
+        @param cache_dir: Directory of the gcode thumbnail cache (see default_cache_dir)
         '''
         self.logger : logging = logger
-        # get paperkey from file
-        with open(paperkey, 'r') as file:
-            self.paperkey = file.read().replace('\n', '')
-
-        # if pidfile exists use it to connect the bot
         self._loop = None
-        if os.path.isfile('/run/user/1000/keybase/keybased.pid'):
-            self.bot : Bot = Bot(
-                username="uboe_bot", paperkey=self.paperkey, handler=self, pid_file='/run/user/1000/keybase/keybased.pid', loop=self._loop
-            )
-            self.logger.info("PID file exists")
-        else:
-            self.bot : Bot = Bot(
-                username="uboe_bot", paperkey=self.paperkey, handler=self, loop=self._loop
-            )
-        self.printfarmchannel = chat1.ChatChannel(
-            name=LISTEN_OPTIONS['filter-channels'][0]['name'],
-            public=LISTEN_OPTIONS['filter-channels'][0]['public'],
-            members_type=LISTEN_OPTIONS['filter-channels'][0]['members_type'],
-            topic_type=LISTEN_OPTIONS['filter-channels'][0]['topic_type'],
-            topic_name=LISTEN_OPTIONS['filter-channels'][0]['topic_name']
-        )
-        self.printerchannel = chat1.ChatChannel(
-            name=LISTEN_OPTIONS['filter-channels'][1]['name'],
-            public=LISTEN_OPTIONS['filter-channels'][1]['public'],
-            members_type=LISTEN_OPTIONS['filter-channels'][1]['members_type'],
-            topic_type=LISTEN_OPTIONS['filter-channels'][1]['topic_type'],
-            topic_name=LISTEN_OPTIONS['filter-channels'][1]['topic_name']
-        )
+        # a shared session dispatches the chat events itself (see PrinterSupervisor)
+        self.bot : Bot = bot if bot is not None else create_bot(paperkey, self, self.logger)
         self.hostname = os.uname().nodename
+        self.name = name or self.hostname
+        self.http_host = http_host or self.hostname
+        self.camera_config = camera_config or os.path.join(this_dir, '..', 'config', 'camera.json')
+        self.cache_dir = cache_dir or default_cache_dir(self.name)
+        self.printfarmchannel = team_channel(PRINTFARM_CHANNEL)
+        self.printerchannel = team_channel(self.name)
         self.sockpath = sockpath
         self.api_presets = presets
-        self.pending_req: Dict[str, Any] = {}
         self.connected = False
         self.kb_fd = sys.stdin.fileno()
         self.out_fd = sys.stdout.fileno()
@@ -157,19 +418,52 @@ class KeybaseBot:
         os.set_blocking(self.out_fd, False)
         self.kb_buf = b""
         self.kb_fut: Optional[asyncio.Future[str]] = None
-        self.pending_reqs: Dict[int, asyncio.Future[Dict[str, Any]]] = {}
+        self.rpc = MoonrakerRpc(logger=self.logger)
+        self._stream_task: Optional[asyncio.Task] = None
+        self._disconnected_at: Optional[float] = None
+        self._reconnect_now = asyncio.Event()
+        # set once the keybase session is initialized, Moonraker connects meanwhile
+        self.keybase_ready = asyncio.Event()
+        self.emergency_stats: Dict[str, Any] = {
+            'count' : 0, 'last_write_ms' : None, 'max_write_ms' : 0., 'last_confirm_ms' : None
+        }
+        self.reconnect_stats: Dict[str, Any] = {
+            'disconnects' : 0, 'last_attempts' : 0, 'last_downtime' : 0., 'max_downtime' : 0., 'total_downtime' : 0.
+        }
         self.print_lock = asyncio.Lock()
         self.mode: int = 0
         self.need_print_help: bool = True
         self.print_notifications: bool = False
-        self.manual_entry: Dict[str, Any] = {}
         self.max_method_len: int = max(
             [len(p.get("method", "")) for p in self.api_presets]
         )
         self._init_camera_settings()
+        self.http = AsyncHttpClient(logger=self.logger)
+        self._image_pool = ThreadPoolExecutor(max_workers=IMAGE_WORKERS, thread_name_prefix='snapshot')
         self.service_config = ServiceConfig()
+        self.printer_state = PrinterState()
+        self.notify_filter = NotificationFilter(self.service_config.decoded_notifications)
+        self.snapshot_cache = SnapshotCache(
+            max_age=float(self.service_config.snapshot_max_age), max_bytes=int(self.service_config.snapshot_cache_bytes)
+        )
+        self.scheduler = CommandScheduler(max_queued=COMMAND_QUEUE_SIZE)
+        self.notify_policy = NotificationPolicy(self.service_config.notify_policy)
+        # last notification held back by the debounce of each event type, and the timers releasing them
+        self._held_notifications : Dict[str, Tuple[str, Dict[str, Any]]] = {}
+        self._release_timers : Dict[str, asyncio.TimerHandle] = {}
+        self.notifications = NotificationQueue(
+            self._deliver_notification, window=float(self.service_config.notify_digest_window), logger=self.logger
+        )
+        self.thumbnails = ThumbnailCache(
+            self.cache_dir, max_bytes=int(self.service_config.thumbnail_cache_bytes), logger=self.logger
+        )
+        self.attachments = AttachmentStore(os.path.join(this_dir, '..', 'tmp'), self.name, logger=self.logger)
+        self.webcams = WebcamRegistry(self._load_webcams, ttl=float(self.service_config.webcam_cache_ttl), logger=self.logger)
+        self.service_config.subscribe(self._on_service_config)
+        self._init_metrics()
+        printer = f" - Printer: `{self.name}`" if self.name != self.hostname else ""
         self.header_message = textwrap.dedent(f"""
-            * Hostname: `{self.hostname}` *
+            * Hostname: `{self.hostname}`{printer} *
             """)
         self.footer_message = textwrap.dedent(f"""
             * ============================================= *
@@ -181,6 +475,7 @@ class KeybaseBot:
         @param bot: Keybase bot instance
         @param chat_event: Keybase chat event
         '''
+        received = time.monotonic()
         if chat_event.msg.content.type_name != chat1.MessageTypeStrings.TEXT.value:
             return
 
@@ -188,158 +483,229 @@ class KeybaseBot:
         if chat_event.msg.sender.username == bot.username:
             return
 
-        channel = chat_event.msg.channel
         chat_msg = chat_event.msg.content.text.body
-        bot_command = re.match(r'(^/uboe_bot)', chat_msg)
-        debug = False
-        msg = "Command not recognized. Try `/uboe_bot help`"
-        match = re.match(r'(^/uboe_bot)\s+(.*$)', chat_msg)
+        channel = chat_event.msg.channel
+        if chat_msg.endswith('emergency_stop') and chat_msg.split() == EMERGENCY_STOP_WORDS :
+            # priority path: the request is on the socket before anything else runs
+            msg = await self.emergency_stop(received)
+            await self._send(channel, self.header_message + msg + self.footer_message)
+            return
+
+        route = COMMANDS.resolve(chat_msg, chat_event.msg.sender.username, allowed_users())
+        if route is None:
+            return
         try :
-            if bot_command :
-                file = None
-                if re.match(r'(^/uboe_bot)\s+(debug)\s+(.*$)', chat_msg) :
-                    if chat_event.msg.sender.username in ALLOWED_USERS:
-                        match = re.match(r'(^/uboe_bot)\s+debug\s+(.*$)', chat_msg)
-                        debug = True
-                    else :
-                        msg = "You are not allowed to enable debug mode"
-
-                if match :
-                    if len(match.groups()) == 2 :
-                        command = match.group(2)
-                        # if "help" in command :
-                        if command == "help":
-                            msg = textwrap.dedent("""
-                                Hello there! I'm uboe_bot, a bot for print farm management.
-                                I can help you with the following commands:
-                                    `help` - this help message
-                                    `status` - display the printer's status
-                                    `snapshot` - display the printer's snapshot
-                                    `emergency_stop` - emergency stop
-                                    `camera id=<int> rotate=<int>` - configure camera
-                                    `config` - show current service configuration
-                                    `config set <key> <value>` - update service configuration
-                                            Keys: `notify_print_start`, `notify_print_end` (true/false)
-                                                  `log_level` (DEBUG/INFO/WARNING/ERROR/CRITICAL)
-                                    `debug` - enable debug mode (followed by the command you want to debug)
-                                            Please run `/uboe_bot debug commands` for more info and available commands
-                                More commands coming soon!
-                            """)
-                        #if command == "status" :
-                        elif command == "status" :
-                            msg = await self.kb_status_msg()
-                            file = self._get_snap_file('status')
-                        #if command == "snapshot" :
-                        elif command == "snapshot" :
-                            msg = "Requested snapshot:"
-                            await self.get_snapshots()
-                            file = self._get_snap_file('status')
-                        # configure camera (/uboe_bot camera id=0 rotate=180)
-                        elif re.match(r'(^camera)', command) :
-                            # unpack command arguments without leading /uboe_bot camera
-                            arguments = re.match(r'.*?id=(\d+)\s+rotate=(\d+)', command)
-                            if arguments :
-                                if len(arguments.groups()) == 2 :
-                                    id = arguments.group(1)
-                                    rotate = arguments.group(2)
-                                    # save configuration into a json file
-                                    if not os.path.exists(os.path.join(this_dir, '..', 'config')):
-                                        os.makedirs(os.path.join(this_dir, '..', 'config'))
-                                    self.camera_settings[id] = {'rotate': rotate}
-                                    self._save_camera_settings()
-                                    msg = "Camera settings updated"
-
-                                else :
-                                    msg = "Malformed command received. Try `/uboe_bot help`"
-                            else :
-                                msg = "Malformed command received. Try `/uboe_bot help`"
-
-                        elif re.match(r'^config', command):
-                            config_set = re.match(r'^config\s+set\s+(\w+)\s+(\S+)$', command)
-                            if command == 'config':
-                                lines = [f"`{k}`: `{v}`" for k, v in self.service_config.items()]
-                                msg = "Current service configuration:\n" + "\n".join(lines)
-                            elif config_set:
-                                if chat_event.msg.sender.username in ALLOWED_USERS:
-                                    key = config_set.group(1)
-                                    value = config_set.group(2)
-                                    if key in ('notify_print_start', 'notify_print_end'):
-                                        if value.lower() in ('true', 'false'):
-                                            setattr(self.service_config, key, value.lower() == 'true')
-                                            self.service_config.save()
-                                            msg = f"Updated `{key}` to `{getattr(self.service_config, key)}`"
-                                        else:
-                                            msg = f"Invalid value `{value}`. Use `true` or `false`"
-                                    elif key == 'log_level':
-                                        if value.upper() in ('DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'):
-                                            self.service_config.log_level = value.upper()
-                                            self.service_config.save()
-                                            msg = f"Updated `log_level` to `{self.service_config.log_level}`"
-                                        else:
-                                            msg = f"Invalid log level `{value}`. Use: DEBUG, INFO, WARNING, ERROR or CRITICAL"
-                                    else:
-                                        msg = f"Unknown setting `{key}`. Available: notify_print_start, notify_print_end, log_level"
-                                else:
-                                    msg = "You are not allowed to change service settings"
-                            else:
-                                msg = "Malformed config command. Try `/uboe_bot config` or `/uboe_bot help`"
-
-                        elif command == "emergency_stop" :
-                            msg = "Emergency stop requested"
-                            self.manual_entry = {
-                                "method": "printer.emergency_stop",
-                                "params": {}
-                            }
-                            self.logger.debug(f"Sending : {self.manual_entry}")
-                            ret = await self._send_manual_request()
-                            self.logger.debug(f"Response: {ret}")
-                            self.manual_entry = {}
-
-                        # if "🌴ping🌴" == command :
-                        elif "🌴ping🌴" == command :
-                            msg = "🍹PONG!🍹"
-                        else :
-                            if debug :
-                                if command == "moonraker" :
-                                    # check if socket is connected
-                                    if self.connected :
-                                        msg = "Moonraker is connected"
-                                    else :
-                                        msg = "Moonraker is not connected"
-                                elif command == "reconnect_moonraker" :
-                                    # check if socket is connected
-                                    if self.connected :
-                                        msg = "Moonraker is already connected"
-                                    else :
-                                        await self._connect()
-                                        msg = "Moonraker reconnected"
-                                elif command == "emulate_job" :
-                                    message = f"Emulated job started"
-                                    self._loop.create_task(self.pending_status_message(message))
-                                elif command == "commands" : # list all commands
-                                    msg = textwrap.dedent("""
-                                        Available commands:
-                                            `moonraker` - check if moonraker is connected
-                                            `reconnect_moonraker` - reconnect to moonraker
-                                            `emulate_job` - emulate a job
-                                            `commands` - list all debug commands
-                                    """)
-
-                    else :
-                        msg = "Malformed command received. Try `/uboe_bot help`"
-                else :
-                    msg = "Not command received. Try `/uboe_bot help`"
+            attachment = None
+            if route.error is not None :
+                msg = route.error
+            else :
+                command = route.command
+                key = None
+                if command.coalesce :
+                    key = (channel.name, channel.topic_name, command.verb, tuple(sorted(route.kwargs.items())))
+                try :
+                    msg = await self.scheduler.run(
+                        command.verb, command.concurrency, key, lambda: command.handler(self, **route.kwargs),
+                        share=_share_reply
+                    )
+                except SchedulerBusyError as e :
+                    self.logger.warning(f"Command {command.verb} refused: {e}")
+                    msg = "I'm busy with other commands right now, please try again in a moment"
+                if isinstance(msg, tuple) :
+                    msg, attachment = msg
 
-                if not file:
-                    await bot.chat.send(channel, self.header_message + msg + self.footer_message)
-                else :
-                    if not os.path.exists(file):
-                        await bot.chat.send(channel, self.header_message + msg + self.footer_message)
-                    else :
-                        await bot.chat.attach(channel, file, self.header_message + msg + self.footer_message)
+            if not attachment:
+                await self._send(channel, self.header_message + msg + self.footer_message)
+            else :
+                with attachment as file :
+                    await self._send(channel, self.header_message + msg + self.footer_message, file)
         except Exception as e:
             self.logger.error(f"Error: {e}")
-            await bot.chat.send(channel, self.header_message + f"Error: {e}" + self.footer_message)
+            await self._send(channel, self.header_message + f"Error: {e}" + self.footer_message)
+
+    def _init_metrics(self) -> None:
+        '''
+        Create the metric children of this printer and hook them to the components
+        '''
+        printer = self.name
+        rpc_duration: Dict[str, Any] = {}
+
+        def observe_rpc(method : str, seconds : float) -> None:
+            child = rpc_duration.get(method)
+            if child is None :
+                child = rpc_duration[method] = RPC_DURATION.labels(printer=printer, method=method)
+            child.observe(seconds)
+        self.rpc.observe = observe_rpc
+        self._frames_metric = MOONRAKER_FRAMES.labels(printer=printer)
+        RPC_PENDING.labels(printer=printer).set_function(lambda: len(self.rpc.pending_reqs))
+        MOONRAKER_CONNECTED.labels(printer=printer).set_function(lambda: int(self.rpc.connected))
+        NOTIFICATION_DEPTH.labels(printer=printer).set_function(lambda: self.notifications.stats()['depth'])
+        COMMAND_QUEUE_DEPTH.labels(printer=printer).set_function(lambda: self.scheduler.queued)
+
+    async def _send(
+        self, channel : chat1.ChatChannel, text : str, file : Optional[str] = None, kind : str = 'reply'
+    ) -> None:
+        '''
+        Send a message, with an attachment if file is given, and record the send latency
+        @param channel: Keybase channel
+        @param text: Message text
+        @param file: Path of the file to attach
+        @param kind: Metric label of the message (reply or notification)
+        '''
+        start = time.monotonic()
+        if file is None :
+            await self.bot.chat.send(channel, text)
+        else :
+            await self.bot.chat.attach(channel, file, text)
+        KEYBASE_SEND_DURATION.labels(printer=self.name, kind=kind).observe(time.monotonic() - start)
+
+    @COMMANDS.command('help', help="this help message")
+    async def _cmd_help(self) -> str:
+        return (
+            "\nHello there! I'm uboe_bot, a bot for print farm management.\n"
+            "I can help you with the following commands:\n"
+            + textwrap.indent(COMMANDS.help(), ' ' * 4) + "\n"
+            + "    `debug` - enable debug mode (followed by the command you want to debug)\n"
+            + f"            Please run `{COMMANDS.prefix} debug commands` for more info and available commands\n"
+            + "More commands coming soon!\n"
+        )
+
+    @COMMANDS.command('status', help="display the printer's status", concurrency=1, coalesce=True)
+    async def _cmd_status(self) -> Tuple[str, Attachment]:
+        msg, snapshots = await asyncio.gather(self.kb_status_msg(), self.get_snapshots())
+        return msg, self._snapshot_attachment(snapshots, 'status')
+
+    @COMMANDS.command('snapshot', help="display the printer's snapshot", concurrency=1, coalesce=True)
+    async def _cmd_snapshot(self) -> Tuple[str, Attachment]:
+        snapshots = await self.get_snapshots()
+        return "Requested snapshot:", self._snapshot_attachment(snapshots, 'status')
+
+    @COMMANDS.command('emergency_stop', help="emergency stop")
+    async def _cmd_emergency_stop(self) -> str:
+        # only reached through the debug keyword, __call__ handles the plain command
+        return await self.emergency_stop(time.monotonic())
+
+    # configure camera (/uboe_bot camera id=0 rotate=180)
+    @COMMANDS.command(
+        'camera', Arg('id', int, keyword=True), Arg('rotate', int, keyword=True), Arg('max_size', int, keyword=True, optional=True),
+        help="configure camera (max_size downscales snapshots, in pixels)", concurrency=1
+    )
+    async def _cmd_camera(self, id : int, rotate : int, max_size : Optional[int]) -> str:
+        id = str(id)
+        settings = dict(self.camera_settings.get(id) or {})
+        settings['rotate'] = rotate
+        settings.pop('max_size', None)
+        if max_size :
+            settings['max_size'] = max_size
+        await self.camera_file.save(dict(self.camera_settings, **{id : settings}))
+        return "Camera settings updated"
+
+    @COMMANDS.command('config', help="show current service configuration")
+    async def _cmd_config(self) -> str:
+        lines = [f"`{k}`: `{v}`" for k, v in self.service_config.items()]
+        return "Current service configuration:\n" + "\n".join(lines)
+
+    @COMMANDS.command(
+        'config set', Arg('key'), Arg('value'),
+        restricted="You are not allowed to change service settings", concurrency=1,
+        help=textwrap.dedent("""\
+            update service configuration
+                    Keys: `notify_print_start`, `notify_print_end` (true/false)
+                          `log_level` (DEBUG/INFO/WARNING/ERROR/CRITICAL)""")
+    )
+    async def _cmd_config_set(self, key : str, value : str) -> str:
+        if key in ('notify_print_start', 'notify_print_end'):
+            if value.lower() not in ('true', 'false'):
+                return f"Invalid value `{value}`. Use `true` or `false`"
+            await self.service_config.update(**{key : value.lower() == 'true'})
+            return f"Updated `{key}` to `{getattr(self.service_config, key)}`"
+        if key == 'log_level':
+            if value.upper() not in _LOG_LEVELS:
+                return f"Invalid log level `{value}`. Use: DEBUG, INFO, WARNING, ERROR or CRITICAL"
+            await self.service_config.update(log_level=value.upper())
+            return f"Updated `log_level` to `{self.service_config.log_level}`"
+        return f"Unknown setting `{key}`. Available: notify_print_start, notify_print_end, log_level"
+
+    @COMMANDS.command('🌴ping🌴')
+    async def _cmd_ping(self) -> str:
+        return "🍹PONG!🍹"
+
+    @COMMANDS.command('moonraker', debug=True, help="check if moonraker is connected")
+    async def _cmd_moonraker(self) -> str:
+        msg = "Moonraker is connected" if self.connected else "Moonraker is not connected"
+        msg += "\n" + "\n".join(f"`{k}`: `{v}`" for k, v in self.reconnect_stats.items())
+        return msg + "\n" + "\n".join(f"`emergency_stop_{k}`: `{v}`" for k, v in self.emergency_stats.items())
+
+    @COMMANDS.command('reconnect_moonraker', debug=True, help="reconnect to moonraker")
+    async def _cmd_reconnect_moonraker(self) -> str:
+        if self.connected :
+            return "Moonraker is already connected"
+        # wake the reconnection loop up instead of waiting for the backoff
+        self._reconnect_now.set()
+        return "Moonraker reconnection requested"
+
+    @COMMANDS.command('emulate_job', debug=True, help="emulate a job")
+    async def _cmd_emulate_job(self) -> str:
+        message = f"Emulated job started"
+        self.notifications.submit('emulate_job', message, status='', to_printfarm=False, job=None)
+        return message
+
+    @COMMANDS.command('notifications', debug=True, help="handled/dropped Moonraker message counters")
+    async def _cmd_notifications(self) -> str:
+        stats = self.notify_filter.stats()
+        lines = [f"`{m}`: {n}" for m, n in sorted(stats['handled'].items())]
+        lines += [f"`{m}`: {n} (dropped)" for m, n in sorted(stats['dropped'].items())]
+        return "Moonraker messages received:\n" + "\n".join(lines)
+
+    @COMMANDS.command('outbox', debug=True, help="notification queue depth, latency, delivery and suppression counters")
+    async def _cmd_outbox(self) -> str:
+        msg = "Notification queue:\n" + "\n".join(f"`{k}`: `{v}`" for k, v in self.notifications.stats().items())
+        return msg + "\nNotification policy:\n" + "\n".join(f"`{k}`: `{v}`" for k, v in self.notify_policy.stats().items())
+
+    @COMMANDS.command('scheduler', debug=True, help="command scheduler counters")
+    async def _cmd_scheduler(self) -> str:
+        return "Command scheduler:\n" + "\n".join(f"`{k}`: `{v}`" for k, v in self.scheduler.stats().items())
+
+    @COMMANDS.command('snapshots', debug=True, help="snapshot/thumbnail cache hit/miss counters")
+    async def _cmd_snapshots(self) -> str:
+        msg = "Snapshot cache:\n" + "\n".join(f"`{k}`: `{v}`" for k, v in self.snapshot_cache.stats().items())
+        return msg + "\nThumbnail cache:\n" + "\n".join(f"`{k}`: `{v}`" for k, v in self.thumbnails.stats().items())
+
+    @COMMANDS.command('startup', debug=True, help="startup phase timings")
+    async def _cmd_startup(self) -> str:
+        return "Startup (seconds since the process start):\n" + "\n".join(
+            f"`{phase}`: `{seconds}`" for phase, seconds in STARTUP.phases.items()
+        )
+
+    @COMMANDS.command('commands', debug=True, help="list all debug commands")
+    async def _cmd_commands(self) -> str:
+        return "\nAvailable commands:\n" + textwrap.indent(COMMANDS.help(debug=True), ' ' * 4) + "\n"
+
+    async def emergency_stop(self, received : float) -> str:
+        '''
+        Send printer.emergency_stop straight to the Moonraker socket, skipping the command
+        router, the scheduler and the writes waiting to be drained
+        @param received: time.monotonic() at which the chat command was received
+        @return: Reply message, with the measured latencies
+        '''
+        try :
+            ret, sent_at = await self.rpc.call_prebuilt(EMERGENCY_STOP_FRAME, EMERGENCY_STOP_TIMEOUT)
+        except ConnectionLostError as e :
+            self.logger.error(f"Emergency stop NOT sent: {e}")
+            return "Moonraker is not connected, emergency stop NOT sent"
+        except asyncio.TimeoutError :
+            self.logger.error("Emergency stop sent but not confirmed")
+            return f"Emergency stop sent but not confirmed by Moonraker within {EMERGENCY_STOP_TIMEOUT}s"
+        write_ms = (sent_at - received) * 1000
+        confirm_ms = (time.monotonic() - received) * 1000
+        self.emergency_stats['count'] += 1
+        self.emergency_stats['last_write_ms'] = round(write_ms, 3)
+        self.emergency_stats['max_write_ms'] = round(max(self.emergency_stats['max_write_ms'], write_ms), 3)
+        self.emergency_stats['last_confirm_ms'] = round(confirm_ms, 3)
+        self.logger.warning(f"Emergency stop written after {write_ms:.3f} ms, response after {confirm_ms:.3f} ms: {ret}")
+        if 'error' in ret :
+            return f"Emergency stop rejected by Moonraker: {ret['error'].get('message', ret['error'])}"
+        return f"Emergency stop confirmed\nSocket write after `{write_ms:.2f}` ms, Moonraker response after `{confirm_ms:.2f}` ms"
 
     async def _process_stream(
             self, reader: asyncio.StreamReader
@@ -351,149 +717,206 @@ class KeybaseBot:
         When status changes, Moonraker sends a notification to the Unix Socket.
         '''
         errors_remaining: int = 10
+        framer = EtxFramer(max_frame=SOCKET_LIMIT)
         while not reader.at_eof():
             try:
-                data = await reader.readuntil(b'\x03')
-                decoded = data[:-1].decode(encoding="utf-8")
-                item: Dict[str, Any] = json.loads(decoded)
-            except (ConnectionError, asyncio.IncompleteReadError):
+                data = await reader.read(READ_SIZE)
+                if not data:
+                    break
+                framer.feed(data)
+            except ConnectionError:
                 break
             except asyncio.CancelledError:
                 raise
-            except Exception:
+            except FrameTooLargeError:
                 errors_remaining -= 1
                 if not errors_remaining or not self.connected:
                     break
                 continue
-            errors_remaining = 10
-            if "id" in item:
-                fut = self.pending_reqs.pop(item["id"], None)
-                if fut is not None:
-                    fut.set_result(item)
-            elif self.print_notifications:
-                self._loop.create_task(self.print(f"Notification: {item}\n"))
-            # CANCELLED: {'jsonrpc': '2.0', 'method': 'notify_history_changed', 'params': [{'action': 'finished', 'job': {'end_time': 1695313459.7578163, 'filament_used': 0.0, 'filename': 'ROY_cover_PLA_1h26m.gcode', 'metadata': {'size': 2417349, 'modified': 1695304875.0769384, 'uuid': '2488b052-ad04-4de3-8158-16acd85f273f', 'slicer': 'OrcaSlicer', 'slicer_version': '1.7.0', 'gcode_start_byte': 24778, 'gcode_end_byte': 2402984, 'layer_count': 10, 'object_height': 3.0, 'estimated_time': 5132, 'nozzle_diameter': 0.4, 'layer_height': 0.3, 'first_layer_height': 0.3, 'first_layer_extr_temp': 220.0, 'first_layer_bed_temp': 60.0, 'chamber_temp': 0.0, 'filament_name': 'Rosa 3D PLA Silk Rainbow', 'filament_type': 'PLA', 'filament_used': '25.59', 'filament_total': 8509.96, 'filament_weight_total': 25.59, 'thumbnails': [{'width': 32, 'height': 24, 'size': 707, 'relative_path': '.thumbs/ROY_cover_PLA_1h26m-32x32.png'}, {'width': 160, 'height': 120, 'size': 2347, 'relative_path': '.thumbs/ROY_cover_PLA_1h26m-160x120.png'}]}, 'print_duration': 0.0, 'status': 'cancelled', 'start_time': 1695313285.310055, 'total_duration': 174.37510105301044, 'job_id': '00000F', 'exists': True}}]}
-            # COMPLETED: {'jsonrpc': '2.0', 'method': 'notify_history_changed', 'params': [{'action': 'finished', 'job': {'end_time': 1695312127.3214107, 'filament_used': 8545.623679997632, 'filename': 'ROY_cover_PLA_1h26m.gcode', 'metadata': {'size': 2417349, 'modified': 1695304875.0769384, 'uuid': '2488b052-ad04-4de3-8158-16acd85f273f', 'slicer': 'OrcaSlicer', 'slicer_version': '1.7.0', 'gcode_start_byte': 24778, 'gcode_end_byte': 2402984, 'layer_count': 10, 'object_height': 3.0, 'estimated_time': 5132, 'nozzle_diameter': 0.4, 'layer_height': 0.3, 'first_layer_height': 0.3, 'first_layer_extr_temp': 220.0, 'first_layer_bed_temp': 60.0, 'chamber_temp': 0.0, 'filament_name': 'Rosa 3D PLA Silk Rainbow', 'filament_type': 'PLA', 'filament_used': '25.59', 'filament_total': 8509.96, 'filament_weight_total': 25.59, 'thumbnails': [{'width': 32, 'height': 24, 'size': 707, 'relative_path': '.thumbs/ROY_cover_PLA_1h26m-32x32.png'}, {'width': 160, 'height': 120, 'size': 2347, 'relative_path': '.thumbs/ROY_cover_PLA_1h26m-160x120.png'}]}, 'print_duration': 6051.890782442992, 'status': 'completed', 'start_time': 1695305884.7087114, 'total_duration': 6242.467836786003, 'job_id': '00000E', 'exists': True}}]}
-            # START: {'jsonrpc': '2.0', 'method': 'notify_history_changed', 'params': [{'action': 'added', 'job': {'end_time': None, 'filament_used': 0.0, 'filename': 'ROY_cover_PLA_1h26m.gcode', 'metadata': {'size': 2417349, 'modified': 1695304875.0769384, 'uuid': '2488b052-ad04-4de3-8158-16acd85f273f', 'slicer': 'OrcaSlicer', 'slicer_version': '1.7.0', 'gcode_start_byte': 24778, 'gcode_end_byte': 2402984, 'layer_count': 10, 'object_height': 3.0, 'estimated_time': 5132, 'nozzle_diameter': 0.4, 'layer_height': 0.3, 'first_layer_height': 0.3, 'first_layer_extr_temp': 220.0, 'first_layer_bed_temp': 60.0, 'chamber_temp': 0.0, 'filament_name': 'Rosa 3D PLA Silk Rainbow', 'filament_type': 'PLA', 'filament_used': '25.59', 'filament_total': 8509.96, 'filament_weight_total': 25.59, 'thumbnails': [{'width': 32, 'height': 24, 'size': 707, 'relative_path': '.thumbs/ROY_cover_PLA_1h26m-32x32.png'}, {'width': 160, 'height': 120, 'size': 2347, 'relative_path': '.thumbs/ROY_cover_PLA_1h26m-160x120.png'}]}, 'print_duration': 0.0, 'status': 'in_progress', 'start_time': 1695313479.608397, 'total_duration': 0.049926147010410205, 'job_id': '000010', 'exists': True}}]}
-            status = ""
-            message = None
-            level = 'INFO'
-            to_printfarm = False
-            # check the status of the job
-            if 'method' in item and item['method'] in  ['notify_history_changed', 'notify_check_failure'] :
-                self.logger.debug(f"Notification: {item}\n")
-
-            if 'method' in item and item['method'] == 'notify_history_changed' :
-
-                if item['params'][0]['action'] == 'finished' and item['params'][0]['job']['status'] == 'completed':
-                    status = 'completed'
-                    level = 'INFO'
-                    if self.service_config.notify_print_end:
-                        message = f"Job {item['params'][0]['job']['filename']} completed"
-                    # remove thumbnail files
-                    if os.path.exists(os.path.join(this_dir, '..', 'tmp', 'thumbail_*.png')):
-                        shutil.rmtree(os.path.join(this_dir, '..', 'tmp', 'thumbail_*.png'))
-
-                # job cancelled
-                elif item['params'][0]['action'] == 'finished' and item['params'][0]['job']['status'] == 'cancelled':
-                    status = 'cancelled'
-                    level = 'WARNING'
-                    if self.service_config.notify_print_end:
-                        message = f"Job {item['params'][0]['job']['filename']} cancelled"
-                    # remove thumbnail files
-                    if os.path.exists(os.path.join(this_dir, '..', 'tmp', 'thumbail_*.png')):
-                        shutil.rmtree(os.path.join(this_dir, '..', 'tmp', 'thumbail_*.png'))
-
-                # job paused
-                elif item['params'][0]['action'] == 'finished' and item['params'][0]['job']['status'] == 'paused':
-                    status = 'paused'
-                    level = 'WARNING'
-                    if self.service_config.notify_print_end:
-                        message = f"Job {item['params'][0]['job']['filename']} paused"
-                # job started
-                elif item['params'][0]['action'] == 'added' and item['params'][0]['job']['status'] == 'in_progress':
-                    status = 'in_progress'
-                    level = 'INFO'
-                    to_printfarm = True
-                    if self.service_config.notify_print_start:
-                        message = f"Job {item['params'][0]['job']['filename']} started"
-                    # save the thumbnails
-                    if not os.path.exists(os.path.join(this_dir, '..', 'tmp')):
-                        os.makedirs(os.path.join(this_dir, '..', 'tmp'))
-                    for i, thumbnail in enumerate(item['params'][0]['job']['metadata']['thumbnails']) :
-                        url = f'http://{self.hostname}/server/files/gcodes/{thumbnail["relative_path"]}'
-                        self.logger.debug(f"Downloading thumbnail from {url}")
-                        res = requests.get(url, stream = True)
-                        self.logger.debug(f"Response: {res}")
-                        if res.status_code == 200:
-                            with open(os.path.join(this_dir, '..', 'tmp', f'thumbnail_{i}.png'),'wb') as f:
-                                shutil.copyfileobj(res.raw, f)
-                        else:
-                            self.logger.info('Thumbnail Couldn\'t be retrieved')
-                            message += f"\nThumbnail Couldn\'t be retrieved"
-
-            if 'method' in item and item['method'] == 'notify_check_failure' :
-                level = 'ERROR'
-                message = f"Check filament failure: \n{item['params'][0]['message']}"
-
-            # if message is not None send it to the keybase channel
-            if message and self.service_config.passes_log_level(level):
-                self._loop.create_task(self.pending_status_message(message, status, to_printfarm))
+            for frame in framer:
+                self._frames_metric.inc()
+                if not self.notify_filter.accept(frame):
+                    continue
+                try:
+                    item: Dict[str, Any] = framer.decode(frame)
+                except Exception:
+                    errors_remaining -= 1
+                    if not errors_remaining or not self.connected:
+                        errors_remaining = 0
+                        break
+                    continue
+                errors_remaining = 10
+                if self.notify_filter.accept_item(item):
+                    self._handle_item(item)
+            if not errors_remaining:
+                break
 
         self.logger.info("Unix Socket Disconnection from _process_stream()")
         await self.close()
 
-    def _make_rpc_msg(self, method: str, **kwargs) -> Dict[str, Any]:
+    def _handle_item(self, item : Dict[str, Any]) -> None:
+        '''
+        Handle a response or a notification received from Moonraker
+        @param item: Decoded JSON-RPC message
+        '''
+        if "id" in item:
+            self.rpc.resolve(item)
+        elif self.print_notifications:
+            self._loop.create_task(self.print(f"Notification: {item}\n"))
+        # CANCELLED: {'jsonrpc': '2.0', 'method': 'notify_history_changed', 'params': [{'action': 'finished', 'job': {'end_time': 1695313459.7578163, 'filament_used': 0.0, 'filename': 'ROY_cover_PLA_1h26m.gcode', 'metadata': {'size': 2417349, 'modified': 1695304875.0769384, 'uuid': '2488b052-ad04-4de3-8158-16acd85f273f', 'slicer': 'OrcaSlicer', 'slicer_version': '1.7.0', 'gcode_start_byte': 24778, 'gcode_end_byte': 2402984, 'layer_count': 10, 'object_height': 3.0, 'estimated_time': 5132, 'nozzle_diameter': 0.4, 'layer_height': 0.3, 'first_layer_height': 0.3, 'first_layer_extr_temp': 220.0, 'first_layer_bed_temp': 60.0, 'chamber_temp': 0.0, 'filament_name': 'Rosa 3D PLA Silk Rainbow', 'filament_type': 'PLA', 'filament_used': '25.59', 'filament_total': 8509.96, 'filament_weight_total': 25.59, 'thumbnails': [{'width': 32, 'height': 24, 'size': 707, 'relative_path': '.thumbs/ROY_cover_PLA_1h26m-32x32.png'}, {'width': 160, 'height': 120, 'size': 2347, 'relative_path': '.thumbs/ROY_cover_PLA_1h26m-160x120.png'}]}, 'print_duration': 0.0, 'status': 'cancelled', 'start_time': 1695313285.310055, 'total_duration': 174.37510105301044, 'job_id': '00000F', 'exists': True}}]}
+        # COMPLETED: {'jsonrpc': '2.0', 'method': 'notify_history_changed', 'params': [{'action': 'finished', 'job': {'end_time': 1695312127.3214107, 'filament_used': 8545.623679997632, 'filename': 'ROY_cover_PLA_1h26m.gcode', 'metadata': {'size': 2417349, 'modified': 1695304875.0769384, 'uuid': '2488b052-ad04-4de3-8158-16acd85f273f', 'slicer': 'OrcaSlicer', 'slicer_version': '1.7.0', 'gcode_start_byte': 24778, 'gcode_end_byte': 2402984, 'layer_count': 10, 'object_height': 3.0, 'estimated_time': 5132, 'nozzle_diameter': 0.4, 'layer_height': 0.3, 'first_layer_height': 0.3, 'first_layer_extr_temp': 220.0, 'first_layer_bed_temp': 60.0, 'chamber_temp': 0.0, 'filament_name': 'Rosa 3D PLA Silk Rainbow', 'filament_type': 'PLA', 'filament_used': '25.59', 'filament_total': 8509.96, 'filament_weight_total': 25.59, 'thumbnails': [{'width': 32, 'height': 24, 'size': 707, 'relative_path': '.thumbs/ROY_cover_PLA_1h26m-32x32.png'}, {'width': 160, 'height': 120, 'size': 2347, 'relative_path': '.thumbs/ROY_cover_PLA_1h26m-160x120.png'}]}, 'print_duration': 6051.890782442992, 'status': 'completed', 'start_time': 1695305884.7087114, 'total_duration': 6242.467836786003, 'job_id': '00000E', 'exists': True}}]}
+        # START: {'jsonrpc': '2.0', 'method': 'notify_history_changed', 'params': [{'action': 'added', 'job': {'end_time': None, 'filament_used': 0.0, 'filename': 'ROY_cover_PLA_1h26m.gcode', 'metadata': {'size': 2417349, 'modified': 1695304875.0769384, 'uuid': '2488b052-ad04-4de3-8158-16acd85f273f', 'slicer': 'OrcaSlicer', 'slicer_version': '1.7.0', 'gcode_start_byte': 24778, 'gcode_end_byte': 2402984, 'layer_count': 10, 'object_height': 3.0, 'estimated_time': 5132, 'nozzle_diameter': 0.4, 'layer_height': 0.3, 'first_layer_height': 0.3, 'first_layer_extr_temp': 220.0, 'first_layer_bed_temp': 60.0, 'chamber_temp': 0.0, 'filament_name': 'Rosa 3D PLA Silk Rainbow', 'filament_type': 'PLA', 'filament_used': '25.59', 'filament_total': 8509.96, 'filament_weight_total': 25.59, 'thumbnails': [{'width': 32, 'height': 24, 'size': 707, 'relative_path': '.thumbs/ROY_cover_PLA_1h26m-32x32.png'}, {'width': 160, 'height': 120, 'size': 2347, 'relative_path': '.thumbs/ROY_cover_PLA_1h26m-160x120.png'}]}, 'print_duration': 0.0, 'status': 'in_progress', 'start_time': 1695313479.608397, 'total_duration': 0.049926147010410205, 'job_id': '000010', 'exists': True}}]}
+        status = ""
+        message = None
+        job = None
+        level = 'INFO'
+        to_printfarm = False
+        # check the status of the job
+        if 'method' in item and item['method'] in  ['notify_history_changed', 'notify_check_failure'] :
+            # formatted only when debug is on, history notifications carry the whole job
+            self.logger.debug("Notification: %s", item, extra={'printer' : self.name, 'method' : item['method']})
 
-        msg = {"jsonrpc": "2.0", "method": method}
-        uid = id(msg)
-        msg["id"] = uid
-        self.pending_req = msg
-        if kwargs:
-            msg["params"] = kwargs
-        return msg
+        if 'method' in item and item['method'] == 'notify_history_changed' :
 
-    async def _send_manual_request(self) -> Dict[str, Any]:
-        '''
-        Send a manual request to Moonraker.
-        @return: Response from Moonraker
+            if item['params'][0]['action'] == 'finished' and item['params'][0]['job']['status'] == 'completed':
+                status = 'completed'
+                level = 'INFO'
+                if self.service_config.notify_print_end:
+                    message = f"Job {item['params'][0]['job']['filename']} completed"
+
+            # job cancelled
+            elif item['params'][0]['action'] == 'finished' and item['params'][0]['job']['status'] == 'cancelled':
+                status = 'cancelled'
+                level = 'WARNING'
+                if self.service_config.notify_print_end:
+                    message = f"Job {item['params'][0]['job']['filename']} cancelled"
+
+            # job paused
+            elif item['params'][0]['action'] == 'finished' and item['params'][0]['job']['status'] == 'paused':
+                status = 'paused'
+                level = 'WARNING'
+                if self.service_config.notify_print_end:
+                    message = f"Job {item['params'][0]['job']['filename']} paused"
+            # job started
+            elif item['params'][0]['action'] == 'added' and item['params'][0]['job']['status'] == 'in_progress':
+                status = 'in_progress'
+                level = 'INFO'
+                to_printfarm = True
+                if self.service_config.notify_print_start:
+                    message = f"Job {item['params'][0]['job']['filename']} started"
+                # the thumbnail is downloaded by the message task to keep the stream reader going
+                job = item['params'][0]['job']
+
+        if 'method' in item and item['method'] == 'notify_status_update' :
+            self.printer_state.apply_update(item.get('params') or [])
+        elif 'method' in item and item['method'] == 'notify_klippy_ready' :
+            self._loop.create_task(self.subscribe_printer_objects())
+        elif 'method' in item and item['method'] in ['notify_klippy_shutdown', 'notify_klippy_disconnected'] :
+            self.printer_state.reset()
+        elif 'method' in item and item['method'] == 'notify_active_spool_set' :
+            self.printer_state.filament = None
+
+        if 'method' in item and item['method'] == 'notify_webcams_changed' :
+            params = item.get('params') or [{}]
+            if isinstance(params[0], dict) and isinstance(params[0].get('webcams'), list):
+                self.webcams.update(params[0]['webcams'])
+            else :
+                self.webcams.invalidate()
 
-        Send the content of self.manual_entry to Moonraker.
+        if 'method' in item and item['method'] == 'notify_check_failure' :
+            level = 'ERROR'
+            message = f"Check filament failure: \n{item['params'][0]['message']}"
+
+        # if message is not None send it to the keybase channel
+        if message and self.service_config.passes_log_level(level):
+            kind = status or item['method']
+            options = {'status' : status, 'to_printfarm' : to_printfarm, 'job' : job}
+            suppressed = self.notify_policy.check(kind)
+            if suppressed is None :
+                self.logger.debug(
+                    "Notification suppressed by policy (%s): %s", kind, message, extra={'printer' : self.name, 'status' : kind}
+                )
+                delay = self.notify_policy.held_for(kind)
+                if delay is not None :
+                    # the debounce releases the last event once the flapping stops
+                    self._held_notifications[kind] = (message, options)
+                    self._schedule_release(kind, delay)
+                elif self._held_notifications.pop(kind, None) is not None :
+                    self.logger.info(f"Notification held by the debounce dropped by policy ({kind})")
+                return
+            self._held_notifications.pop(kind, None)
+            self.notifications.submit(kind, _with_suppressed(message, suppressed), **options)
+
+    def _schedule_release(self, kind : str, delay : float) -> None:
+        timer = self._release_timers.pop(kind, None)
+        if timer is not None :
+            timer.cancel()
+        self._release_timers[kind] = self._loop.call_later(delay, self._release_notification, kind)
+
+    def _release_notification(self, kind : str) -> None:
         '''
-        if not self.manual_entry:
+        Send the notification held back by the debounce of the policy, once its event type has settled
+        @param kind: Event type
+        '''
+        self._release_timers.pop(kind, None)
+        if kind not in self._held_notifications :
+            return
+        delay = self.notify_policy.held_for(kind)
+        if delay :
+            self._schedule_release(kind, delay)
+            return
+        message, options = self._held_notifications.pop(kind)
+        suppressed = self.notify_policy.settle(kind)
+        if suppressed is None :
+            self.logger.info(f"Notification held by the debounce dropped by policy ({kind}): {message}")
             return
-        params = self.manual_entry.get("params")
-        method = self.manual_entry["method"]
-        message = self._make_rpc_msg(method, **params)
-        fut = self._loop.create_future()
-        self.pending_reqs[message["id"]] = fut
-        self.logger.debug(f"Sending : {message}")
-        await self._write_message(message)
-        return await fut
+        self.notifications.submit(kind, _with_suppressed(message, suppressed), **options)
 
     def _init_camera_settings(self) -> None:
         '''
-        Initialize camera settings
+        Initialize camera settings, an empty camera file is created if absent
         '''
-        if not os.path.exists(os.path.join(this_dir, '..', 'config', 'camera.json')):
-            # create an empty camera.json file
-            os.makedirs(os.path.join(this_dir, '..', 'config'), exist_ok=True)
-            with open(os.path.join(this_dir, '..', 'config', 'camera.json'), 'w') as config_file:
-                json.dump({}, config_file)
-        with open(os.path.join(this_dir, '..', 'config', 'camera.json'), 'r') as file:
-            dic = json.load(file)
-        self.camera_settings = dic
+        self.camera_file = CONFIG.open(self.camera_config, {}, _validate_cameras)
+        self.camera_settings : Dict[str, Dict[str, Any]] = self.camera_file.data
+        self.camera_file.subscribe(self._on_camera_settings)
 
-    def _save_camera_settings(self) -> None:
+    def _on_camera_settings(self, old : Dict[str, Any], new : Dict[str, Any]) -> None:
+        self.camera_settings = new
+        for id in set(old) | set(new):
+            if old.get(id) != new.get(id):
+                self.snapshot_cache.invalidate(id)
+
+    def _on_service_config(self, changed : Set[str]) -> None:
         '''
-        Save camera settings
+        Apply the service settings changed by a command or by an edit of config/service.json
+        @param changed: Names of the changed settings
         '''
-        with open(os.path.join(this_dir, '..', 'config', 'camera.json'), 'w') as config_file:
-            json.dump(self.camera_settings, config_file)
+        config = self.service_config
+        if 'notify_allowlist' in changed :
+            self.notify_filter.allowlist = config.decoded_notifications
+        if 'snapshot_max_age' in changed or 'snapshot_cache_bytes' in changed :
+            self.snapshot_cache.max_age = float(config.snapshot_max_age)
+            self.snapshot_cache.max_bytes = int(config.snapshot_cache_bytes)
+        if 'webcam_cache_ttl' in changed :
+            self.webcams.ttl = float(config.webcam_cache_ttl)
+        if 'notify_digest_window' in changed :
+            self.notifications.window = float(config.notify_digest_window)
+        if 'notify_policy' in changed :
+            self.notify_policy = NotificationPolicy(config.notify_policy)
+            # the new policy has no record of the events held back by the old one
+            for timer in self._release_timers.values():
+                timer.cancel()
+            self._release_timers.clear()
+            self._held_notifications.clear()
+        restart = changed & {'thumbnail_cache_bytes', 'metrics_listen'}
+        if restart :
+            self.logger.warning(f"Changed settings applied on the next restart: {', '.join(sorted(restart))}")
 
-    def _get_snap_file(self, usage : str ="" ) -> str:
+    def _get_snap_camera(self, usage : str ="" ) -> Optional[str]:
         '''
-        Get the snapshot file path
+        Get the camera whose snapshot is used for a given usage
+        @param usage: Usage (e.g. status, completed), falls back to the "default" camera
+        @return: Camera id or None
         '''
         for id in self.camera_settings :
             if not self.camera_settings[id] :
@@ -504,7 +927,7 @@ class KeybaseBot:
                 else :
                     for u in self.camera_settings[id]['use'] :
                         if u == usage :
-                            return os.path.join(this_dir, '..', 'tmp', f'snapshot_{id}.jpeg')
+                            return id
         # find the first snapshot file that contains the "default" use
         for id in self.camera_settings :
             if not self.camera_settings[id] :
@@ -514,47 +937,72 @@ class KeybaseBot:
                     self.logger.warning(f"Camera {id} setting 'use' not found")
                 else :
                     if "default" in self.camera_settings[id]['use'] :
-                        return os.path.join(this_dir, '..', 'tmp', f'snapshot_{id}.jpeg')
-        # return the "no_image" file
-        return os.path.join(this_dir, '..', 'common', 'no_image.png')
+                        return id
+        return None
 
-    async def _write_message(self, message: Dict[str, Any]) -> None:
+    def _snapshot_attachment(self, snapshots : Dict[str, Optional[bytes]], usage : str = "") -> Attachment:
         '''
-        Write a message to the Unix Socket
-        @param message: Message to send
+        Get the attachment of the snapshot used for a given usage
+        @param snapshots: Snapshots returned by get_snapshots()
+        @param usage: Usage (e.g. status, completed)
+        @return: Attachment of the snapshot, or of common/no_image.png if there is none
         '''
-        data = json.dumps(message).encode() + b"\x03"
-        try:
-            self.writer.write(data)
-            await self.writer.drain()
-        except asyncio.CancelledError:
-            raise
-        except Exception:
-            await self.close()
+        id = self._get_snap_camera(usage)
+        data = snapshots.get(id) if id is not None else None
+        if not data :
+            return AttachmentStore.static(os.path.join(this_dir, '..', 'common', 'no_image.png'))
+        return self.attachments.create(data, '.jpeg')
 
-    async def pending_status_message(self, message, status, to_printfarm = False):
+    async def _deliver_notification(self, notification : Notification) -> bool:
         '''
-        Send a status message to the keybase channel with an attached snapshot
-        @param message: Message to send
+        Send a notification (see NotificationQueue) with an attached snapshot, and with the gcode
+        thumbnail to the printfarm channel. Both channels are sent to concurrently, each with retries.
+        @param notification: Notification, its context holds the status, to_printfarm and job
+        @return: False if a channel could not be sent to
         '''
-        self.logger.info(f"Sending message: {message}")
-        await self.get_snapshots()
-        # if there is a thumbnail file attach it to the message
+        message = notification.text
+        status = notification.context['status']
+        to_printfarm = notification.context['to_printfarm']
+        job = notification.context['job']
+        self.logger.info(
+            "Sending message: %s", message,
+            extra={'printer' : self.name, 'status' : status or notification.kind, 'job_id' : (job or {}).get('job_id')}
+        )
+        thumbnail, snapshots = await asyncio.gather(
+            self.get_thumbnail(job) if to_printfarm and job else asyncio.sleep(0),
+            self.get_snapshots()
+        )
+        sends = []
+        # if there is a thumbnail attach it to the message
         if to_printfarm :
-            if os.path.exists(os.path.join(this_dir, '..', 'tmp', 'thumbnail_1.png')):
-                await self.bot.chat.attach(self.printfarmchannel , os.path.join(this_dir, '..', 'tmp', 'thumbnail_1.png'), self.header_message + message + self.footer_message)
+            if thumbnail :
+                farm_attachment = self.attachments.create(thumbnail, '.png')
+                farm_message = self.header_message + message + self.footer_message
             else :
-                await self.bot.chat.attach(self.printfarmchannel , os.path.join(this_dir, '..', 'common', 'no_image.png'), self.header_message + message + '\n(no thumbnail found)' + self.footer_message)
-        await self.bot.chat.attach(self.printerchannel , self._get_snap_file(status), self.header_message + message + self.footer_message)
+                farm_attachment = AttachmentStore.static(os.path.join(this_dir, '..', 'common', 'no_image.png'))
+                farm_message = self.header_message + message + '\n(no thumbnail found)' + self.footer_message
+            sends.append((self.printfarmchannel, farm_attachment, farm_message))
+        sends.append((self.printerchannel, self._snapshot_attachment(snapshots, status), self.header_message + message + self.footer_message))
+
+        async def send(channel : chat1.ChatChannel, attachment : Attachment, text : str) -> bool:
+            with attachment as file :
+                return await self.notifications.retry(
+                    f"notification to {channel.topic_name}", lambda: self._send(channel, text, file, 'notification')
+                )
+        # the snapshots were captured while the keybase session was still starting
+        await self.keybase_ready.wait()
+        results = await asyncio.gather(*(send(*args) for args in sends))
+        if all(results):
+            self.mark_startup('first_notification')
+        return all(results)
 
     async def kb_status_msg(self):
         '''
         Send a status message to the keybase channel with an attached snapshot
         @param message: Message to send
         '''
-        status = await self.get_printer_status()
-        filament = await self.get_filament_info()
-        # Status: {'jsonrpc': '2.0', 'result': {'eventtime': 267760.750332633, 'status': {'print_stats': {'filename': 'cable_tie_PLA_7m50s.gcode', 'total_duration': 281.22244369098917, 'print_duration': 0.0, 'filament_used': 0.0, 'state': 'paused', 'message': '', 'info': {'total_layer': 9, 'current_layer': 0}}}}, 'id': 140316437579168}
+        status, filament = await self.get_status_sources()
+        # Status: {'print_stats': {'filename': 'cable_tie_PLA_7m50s.gcode', 'total_duration': 281.22244369098917, 'print_duration': 0.0, 'filament_used': 0.0, 'state': 'paused', 'message': '', 'info': {'total_layer': 9, 'current_layer': 0}}, 'display_status': {'progress': 0.0, 'message': None}}
         # convert duration in seconds to HH:MM:SS
         def convert(seconds):
             seconds = seconds % (24 * 3600)
@@ -564,12 +1012,12 @@ class KeybaseBot:
             seconds %= 60
             return "%d:%02d:%02d" % (hour, minutes, seconds)
 
-        state = status['result']['status']['print_stats']['state'] if 'state' in status['result']['status']['print_stats'] else 'unknown'
-        progression = int(status['result']['status']['display_status']['progress']*100) if 'progress' in status['result']['status']['display_status'] else 'unknown'
-        total_layers = status['result']['status']['print_stats']['info']['total_layer'] if 'info' in status['result']['status']['print_stats'] and 'total_layer' in status['result']['status']['print_stats']['info'] else 'unknown'
-        current_layer = status['result']['status']['print_stats']['info']['current_layer'] if 'info' in status['result']['status']['print_stats'] and 'current_layer' in status['result']['status']['print_stats']['info'] else 'unknown'
+        state = status['print_stats']['state'] if 'state' in status['print_stats'] else 'unknown'
+        progression = int(status['display_status']['progress']*100) if 'progress' in status['display_status'] else 'unknown'
+        total_layers = status['print_stats']['info']['total_layer'] if 'info' in status['print_stats'] and 'total_layer' in status['print_stats']['info'] else 'unknown'
+        current_layer = status['print_stats']['info']['current_layer'] if 'info' in status['print_stats'] and 'current_layer' in status['print_stats']['info'] else 'unknown'
 
-        used_filament_mm = status['result']['status']['print_stats']['filament_used'] if 'filament_used' in status['result']['status']['print_stats'] else 'unknown'
+        used_filament_mm = status['print_stats']['filament_used'] if 'filament_used' in status['print_stats'] else 'unknown'
         density = 'unknown'
         diameter = 'unknown'
         if 'result' in filament :
@@ -582,12 +1030,12 @@ class KeybaseBot:
         else :
             used_filament_g = 'unknown'
 
-        total_duration = convert(status['result']['status']['print_stats']['total_duration']) if 'total_duration' in status['result']['status']['print_stats'] else 'unknown'
-        print_duration = convert(status['result']['status']['print_stats']['print_duration']) if 'print_duration' in status['result']['status']['print_stats'] else 'unknown'
+        total_duration = convert(status['print_stats']['total_duration']) if 'total_duration' in status['print_stats'] else 'unknown'
+        print_duration = convert(status['print_stats']['print_duration']) if 'print_duration' in status['print_stats'] else 'unknown'
 
         # calculate ETA (datetime at which the print will be finished or finished)
         if not progression == 'unknown' and progression != 100 and progression != 0 :
-            eta = round((100 - progression) * float(status['result']['status']['print_stats']['total_duration']) / progression, 2)
+            eta = round((100 - progression) * float(status['print_stats']['total_duration']) / progression, 2)
             eta = convert(eta)
             # add ETA to current time
             eta = (datetime.datetime.now() + datetime.timedelta(hours=int(eta.split(':')[0]), minutes=int(eta.split(':')[1]), seconds=int(eta.split(':')[2]))).strftime("%H:%M:%S")
@@ -596,16 +1044,15 @@ class KeybaseBot:
             eta = 'unknown'
 
         msg = textwrap.dedent(f"""
-            >`Filename       :` {status['result']['status']['print_stats']['filename'] if 'filename' in status['result']['status']['print_stats'] else 'unknown' }
+            >`Filename       :` {status['print_stats']['filename'] if 'filename' in status['print_stats'] else 'unknown' }
             >`State          :` {state} ({progression}%)
             >`ETA            :` {eta}
-            >`Message        :` {status['result']['status']['print_stats']['message'] if 'message' in status['result']['status']['print_stats'] else 'unknown' }
+            >`Message        :` {status['print_stats']['message'] if 'message' in status['print_stats'] else 'unknown' }
             >`Total duration :` {total_duration}
             >`Print duration :` {print_duration}
             >`Filament used  :` {int(used_filament_mm / 100) if used_filament_mm != "unknown" else "unknown"} m / {used_filament_g} g
             >`Current layer  :` {current_layer} / {total_layers}
         """)
-        await self.get_snapshots()
         return msg
 
     async def run_bot(self):
@@ -617,19 +1064,43 @@ class KeybaseBot:
         except Exception as e:
             self.logger.error(f"Error: {e}")
             sys.exit(1)
+        self.mark_startup('keybase_ready')
+        self.keybase_ready.set()
         asyncio.run(await self.bot.start(listen_options=LISTEN_OPTIONS))
 
+    def mark_startup(self, phase : str) -> None:
+        '''
+        Record a startup phase (see STARTUP), phases reached again later (e.g. on reconnection) are ignored
+        @param phase: Phase name
+        '''
+        if phase in STARTUP.phases:
+            return
+        seconds = STARTUP.mark(phase)
+        STARTUP_PHASE.labels(phase=phase).set(seconds)
+        self.logger.info(f"Startup: {phase} after {seconds:.3f}s ({STARTUP})")
+
     async def run_moonraker(self) -> None:
         '''
-        Start the connection to Moonraker
+        Keep the connection to Moonraker up.
+        When the socket drops, the bot reconnects in process (keeping its Keybase session)
+        with a jittered exponential backoff, then identifies and subscribes again.
         '''
-        await self._connect()
+        if self._loop is None:
+            # started by PrinterSupervisor rather than run()
+            self._loop = asyncio.get_event_loop()
+        while True:
+            await self._connect()
+            await self._stream_task
+            self.reconnect_stats['disconnects'] += 1
+            self._disconnected_at = time.monotonic()
+            self.logger.warning("Moonraker connection lost, reconnecting")
 
     async def _connect(self) -> None:
         '''
-        Connect to Moonraker
+        Connect to Moonraker, retrying with a jittered exponential backoff until it succeeds
         '''
-        print(f"Connecting to Moonraker at {self.sockpath}")
+        self.logger.info(f"Connecting to Moonraker at {self.sockpath}")
+        attempt = 0
         while True:
             try:
                 reader, writer = await asyncio.open_unix_connection(
@@ -637,40 +1108,68 @@ class KeybaseBot:
                 )
             except asyncio.CancelledError:
                 raise
-            except Exception:
-                await asyncio.sleep(1.)
+            except Exception as e:
+                await self._reconnect_delay(attempt, e)
+                attempt += 1
+                continue
+            self.writer = writer
+            self.rpc.attach(writer)
+            self._stream_task = self._loop.create_task(self._process_stream(reader))
+            self.connected = True
+            self.logger.info("Connected to Moonraker")
+            self.mark_startup('moonraker_connected')
+            # webcams may have changed while disconnected
+            self.webcams.invalidate()
+            try:
+                ret = await self.rpc.call("server.connection.identify", {
+                        "client_name": "Unix Socket Test",
+                        "version": "0.0.1",
+                        "type": "other",
+                        "url": "https://github.com/Arksine/moontest"
+                    })
+                self.logger.info(f"Client Identified With Moonraker: {ret}")
+                await self.subscribe_printer_objects()
+                self.mark_startup('moonraker_subscribed')
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # moonraker went away again while starting up
+                await self.close()
+                await self._stream_task
+                await self._reconnect_delay(attempt, e)
+                attempt += 1
                 continue
             break
-        self.writer = writer
-        self._loop.create_task(self._process_stream(reader))
-        self.connected = True
-        self.logger.info("Connected to Moonraker")
-        self.manual_entry = {
-            "method": "server.connection.identify",
-            "params": {
-                "client_name": "Unix Socket Test",
-                "version": "0.0.1",
-                "type": "other",
-                "url": "https://github.com/Arksine/moontest"
-            }
-        }
-        ret = await self._send_manual_request()
-        self.manual_entry = {}
-        self.logger.info(f"Client Identified With Moonraker: {ret}")
+        self.reconnect_stats['last_attempts'] = attempt + 1
+        if self._disconnected_at is not None:
+            downtime = time.monotonic() - self._disconnected_at
+            self._disconnected_at = None
+            self.reconnect_stats['last_downtime'] = round(downtime, 3)
+            self.reconnect_stats['max_downtime'] = round(max(self.reconnect_stats['max_downtime'], downtime), 3)
+            self.reconnect_stats['total_downtime'] = round(self.reconnect_stats['total_downtime'] + downtime, 3)
+            self.logger.info(f"Reconnected to Moonraker after {downtime:.3f}s ({attempt + 1} attempts)")
+
+    async def _reconnect_delay(self, attempt : int, error : Exception) -> None:
+        '''
+        Wait before the next connection attempt, returns early on a reconnect_moonraker debug command
+        @param attempt: Number of failed attempts so far
+        @param error: Error of the last attempt
+        '''
+        delay = min(RECONNECT_MAX_DELAY, RECONNECT_MIN_DELAY * 2 ** attempt) * random.uniform(0.5, 1.)
+        self.logger.debug(f"Moonraker connection attempt {attempt + 1} failed ({error!r}), retrying in {delay:.2f}s")
+        self._reconnect_now.clear()
+        try:
+            await asyncio.wait_for(self._reconnect_now.wait(), delay)
+        except asyncio.TimeoutError:
+            pass
 
     async def get_filament_info(self) -> Dict[str, Any]:
         '''
         Get the filament info from Moonraker
         @return: Response from Moonraker
         '''
-        self.manual_entry = {
-                    "method": "access.spoolman.info",
-                    "params": {}
-                }
-        self.logger.debug(f"Sending : {self.manual_entry}")
-        ret = await self._send_manual_request()
-        self.logger.debug(f"Response: {ret}")
-        self.manual_entry = {}
+        ret = await self.rpc.call("access.spoolman.info")
+        self.logger.debug("Response: %s", ret)
         return ret
 
     async def get_printer_status(self) -> Dict[str, Any]:
@@ -680,88 +1179,224 @@ class KeybaseBot:
         '''
         # Sending: {'jsonrpc': '2.0', 'method': 'printer.objects.list', 'id': 139689691991728}
         # Response: {'jsonrpc': '2.0', 'result': {'objects': ['webhooks', 'configfile', 'mcu', 'gcode_move', 'print_stats', 'virtual_sdcard', 'pause_resume', 'display_status', 'gcode_macro CANCEL_PRINT', ..., 'motion_report', 'query_endstops', 'system_stats', 'manual_probe', 'toolhead', 'extruder']}, 'id': 139689691991728}
-        self.manual_entry = {
-                    "method": "printer.objects.query",
-                    "params": {'objects' : {'print_stats' : None, 'display_status' : None}}
-                }
-        self.logger.debug(f"Sending : {self.manual_entry}")
-        ret = await self._send_manual_request()
-        self.logger.debug(f"Response: {ret}")
-        self.manual_entry = {}
+        ret = await self.rpc.call("printer.objects.query", {'objects' : dict(STATUS_OBJECTS)})
+        self.logger.debug("Response: %s", ret)
         return ret
 
-    async def get_snapshots(self) -> None:
+    async def get_status_sources(self) -> Tuple[Dict[str, Any], Dict[str, Any]]:
         '''
-        Get the snapshot from the printer
+        Get everything the status message needs from Moonraker.
+        Printer objects, filament info and webcams are served from the local state when available,
+        whatever is missing is requested in a single batch (one socket round trip).
+        The webcam list of the batch is shared with the snapshots captured at the same time.
+        @return: Printer objects status (print_stats, display_status) and filament info response
         '''
-        for id in self.camera_settings :
-            self.logger.info(f"Fetching url for snapshot (camera {id})")
-            url = await self.get_snapchot_url(id)
-            if not url :
-                self.logger.info(f"Snapshot (camera {id}) url not found")
+        calls : List[Tuple[str, Optional[Dict[str, Any]]]] = []
+        if not self.printer_state.ready:
+            self.logger.debug("Printer state not subscribed, querying Moonraker")
+            calls.append(("printer.objects.query", {'objects' : dict(STATUS_OBJECTS)}))
+        if self.printer_state.filament is None:
+            calls.append(("access.spoolman.info", None))
+        webcams_load = None
+        if self.camera_settings and not self.webcams.is_fresh:
+            # snapshots captured meanwhile wait for the list of this batch instead of requesting it again
+            webcams_load = self.webcams.expect()
+            if webcams_load is not None:
+                calls.append(("server.webcams.list", None))
+        responses = {}
+        try :
+            if calls:
+                rets = await self.rpc.call_batch(calls)
+                responses = {method : ret for (method, _), ret in zip(calls, rets)}
+                self.logger.debug("Responses: %s", responses)
+        finally :
+            if webcams_load is not None:
+                ret = responses.get("server.webcams.list", {})
+                if 'result' in ret:
+                    webcams_load.set_result(ret['result']['webcams'] or [])
+                else :
+                    webcams_load.set_exception(LookupError(f"Webcam list not retrieved: {ret.get('error')}"))
+
+        if "printer.objects.query" in responses:
+            ret = responses["printer.objects.query"]
+            objects = ret['result']['status'] if 'result' in ret else {}
+        else :
+            objects = self.printer_state.objects
+        filament = responses.get("access.spoolman.info", self.printer_state.filament)
+        if "access.spoolman.info" in responses and 'result' in filament:
+            self.printer_state.filament = filament
+        return {obj : objects.get(obj, {}) for obj in STATUS_OBJECTS}, filament
+
+    async def subscribe_printer_objects(self) -> None:
+        '''
+        Subscribe to the printer objects, Moonraker then pushes their changes with notify_status_update
+        '''
+        self.printer_state.begin_sync()
+        ret = await self.rpc.call("printer.objects.subscribe", {'objects' : dict(STATUS_OBJECTS)})
+        if ret and 'result' in ret:
+            self.printer_state.load(ret['result']['status'], ret['result'].get('eventtime', 0.))
+            self.logger.info("Subscribed to printer objects")
+        else :
+            # klippy is probably not ready, notify_klippy_ready triggers a new subscription
+            self.printer_state.reset()
+            self.logger.warning(f"Printer objects subscription failed: {ret}")
+
+    async def get_snapshots(self) -> Dict[str, Optional[bytes]]:
+        '''
+        Get the snapshot from every camera of the printer.
+        Cameras are captured concurrently, each one within SNAPSHOT_TIMEOUT seconds.
+        @return: Snapshot of each camera id (None if it could not be retrieved)
+        '''
+        if not self.camera_settings :
+            return {}
+        start = time.monotonic()
+        ids = list(self.camera_settings)
+        snapshots = await asyncio.gather(*[self._capture_snapshot(id) for id in ids])
+        self.logger.debug(f"Snapshots captured in {time.monotonic() - start:.3f}s")
+        return dict(zip(ids, snapshots))
+
+    async def _capture_snapshot(self, id) -> Optional[bytes]:
+        '''
+        Capture the snapshot of a single camera.
+        Recent snapshots are served from the snapshot cache and concurrent captures share one fetch.
+        @param id: Camera id
+        @return: Snapshot data, None if the camera is slow or unreachable
+        '''
+        timings : Dict[str, float] = {}
+        start = time.monotonic()
+        data = None
+        try :
+            data = await asyncio.wait_for(
+                self.snapshot_cache.get(id, lambda: asyncio.wait_for(self._download_snapshot(id, timings), SNAPSHOT_TIMEOUT)),
+                SNAPSHOT_TIMEOUT
+            )
+        except asyncio.CancelledError:
+            raise
+        except Exception as e :
+            if isinstance(e, asyncio.TimeoutError):
+                self.logger.warning(f"Snapshot (camera {id}) timed out after {SNAPSHOT_TIMEOUT}s")
             else :
-                snapchot_url = f'http://{self.hostname}'+url
-                # download image file from snaphot_url and embed into message
-                self.logger.info(f"Downloading snapshot from {snapchot_url}")
-                res = requests.get(snapchot_url, stream = True)
-                self.logger.debug(f"Response: {res}")
-                if res.status_code == 200:
-                    if not os.path.exists(os.path.join(this_dir, '..', 'tmp')):
-                        os.makedirs(os.path.join(this_dir, '..', 'tmp'))
-                    with open(os.path.join(this_dir, '..', 'tmp', f'snapshot_{id}.jpeg'),'wb') as f:
-                        shutil.copyfileobj(res.raw, f)
-
-                    if self.camera_settings :
-                        if 'rotate' in self.camera_settings[id] :
-                            shutil.copyfileobj(res.raw, f)
-                            img = Image.open(os.path.join(this_dir, '..', 'tmp', f'snapshot_{id}.jpeg'))
-                            img = img.rotate(int(self.camera_settings[id]['rotate']))
-                            img.save(os.path.join(this_dir, '..', 'tmp', f'snapshot_{id}.jpeg'))
-                    self.logger.info('Image sucessfully Downloaded: snapshot.jpeg')
-                else:
-                    self.logger.info('Image Couldn\'t be retrieved')
-                    shutil.copyfile(os.path.join(this_dir, '..', 'common', 'no_image.png'), os.path.join(this_dir, '..', 'tmp', f'snapshot_{id}.jpeg'))
+                self.logger.warning(f"Snapshot (camera {id}) failed: {e!r}")
+            self.logger.info('Image Couldn\'t be retrieved')
+        timings['total'] = time.monotonic() - start
+        SNAPSHOT_DURATION.labels(printer=self.name, camera=id).observe(timings['total'])
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug(
+                f"Snapshot (camera {id}) timings: " + ", ".join(f"{k}={v:.3f}s" for k, v in timings.items()),
+                extra={'printer' : self.name, 'camera' : id, 'latency' : round(timings['total'], 3)}
+            )
+        return data
 
-    async def get_snapchot_url(self, id) -> str:
+    async def _download_snapshot(self, id, timings : Dict[str, float]) -> bytes:
         '''
-        Get the snapshot url from Moonraker
-        @return: Response from Moonraker
+        Download and post-process the snapshot of a single camera
+        @param id: Camera id
+        @param timings: Filled with the duration of each step
+        @return: Snapshot data
+        '''
+        step = time.monotonic()
+        self.logger.info(f"Fetching url for snapshot (camera {id})")
+        url = await self.get_snapchot_url(id)
+        timings['url'] = time.monotonic() - step
+        if not url :
+            raise LookupError(f"Snapshot (camera {id}) url not found")
+        snapchot_url = f'http://{self.http_host}'+url
+        # download image file from snaphot_url and embed into message
+        self.logger.info(f"Downloading snapshot from {snapchot_url}")
+        step = time.monotonic()
+        res = await self.http.get(snapchot_url, timeout=SNAPSHOT_TIMEOUT)
+        timings['download'] = time.monotonic() - step
+        self.logger.debug("Response: %s", res)
+        if res.status != 200:
+            raise RuntimeError(f"HTTP status {res.status}")
+        step = time.monotonic()
+        rotate = int(self.camera_settings[id].get('rotate', 0))
+        max_size = self.camera_settings[id].get('max_size')
+        data = res.body
+        if needs_processing(rotate, max_size):
+            # rotation/downscaling/encoding is CPU bound, keep it off the event loop
+            data = await self._loop.run_in_executor(self._image_pool, process_snapshot, data, rotate, max_size)
+        timings['process'] = time.monotonic() - step
+        self.logger.info(f'Image sucessfully Downloaded (camera {id})')
+        return data
+
+    async def get_thumbnail(self, job : Dict[str, Any]) -> Optional[bytes]:
+        '''
+        Get the gcode thumbnail of a job, only the variant that is sent is downloaded
+        @param job: Job from the notify_history_changed notification
+        @return: Thumbnail data (None if the gcode has none or it could not be retrieved)
         '''
-        self.manual_entry = {
-                    "method": "server.webcams.list",
-                    "params": {}
-                }
-        self.logger.debug(f"Sending : {self.manual_entry}")
-        ret = await self._send_manual_request()
-        self.logger.debug(f"Response: {ret}")
-        if ret['result']['webcams'] :
+        metadata = job.get('metadata') or {}
+        thumbnail = select_thumbnail(metadata.get('thumbnails') or [])
+        if thumbnail is None :
+            return None
+        url = f'http://{self.http_host}/server/files/gcodes/{thumbnail["relative_path"]}'
+
+        async def download() -> Optional[bytes]:
+            self.logger.debug(f"Downloading thumbnail from {url}")
             try :
-                snapchot_url = ret['result']['webcams'][int(id)-1]['snapshot_url']
-            except IndexError :
-                snapchot_url = None
-                logging.error(f"Camera {id} not found")
-        else :
-            snapchot_url = None
-        self.manual_entry = {}
-        return snapchot_url
+                res = await self.http.get(url)
+            except Exception as e :
+                self.logger.warning(f"Thumbnail download failed: {e!r}")
+                return None
+            if res.status != 200:
+                self.logger.info(f'Thumbnail Couldn\'t be retrieved (HTTP status {res.status})')
+                return None
+            return res.body
+
+        return await self.thumbnails.get(thumbnail_key(job.get('filename', ''), metadata, thumbnail), download)
+
+    async def get_snapchot_url(self, id) -> str:
+        '''
+        Get the snapshot url of a camera from the cached webcam list
+        @return: Snapshot url or None if the camera is unknown
+        '''
+        return await self.webcams.get_snapshot_url(id)
+
+    async def _load_webcams(self) -> List[Dict[str, Any]]:
+        '''
+        Fetch the webcam list from Moonraker
+        @return: List of webcam configurations
+        '''
+        ret = await self.rpc.call("server.webcams.list")
+        self.logger.debug("Response: %s", ret)
+        return ret['result']['webcams'] or []
 
     async def close(self):
         '''
-        Close the connection to Moonraker
+        Close the connection to Moonraker, run_moonraker() then reconnects
         '''
         if not self.connected:
             return
         self.connected = False
+        self.rpc.detach()
+        self.printer_state.reset()
         self.writer.close()
-        await self.writer.wait_closed()
-        # exit script as the service will be relaunched automatically
-        sys.exit(0)
+        try:
+            await self.writer.wait_closed()
+        except Exception:
+            pass
 
     def run(self):
         '''
         Main loop of the bot. It starts the keybase bot and the moonraker connection.
         '''
         self._loop = asyncio.get_event_loop()
+        self._loop.create_task(serve_metrics(self.service_config.metrics_listen, logger=self.logger))
+        CONFIG.watch()
         self._loop.create_task(self.run_bot())
         self._loop.create_task(self.run_moonraker())
-        self._loop.run_forever()
\ No newline at end of file
+        # systemd stops the service with SIGTERM, let the loop return so that the files are removed
+        self._loop.add_signal_handler(signal.SIGTERM, self._loop.stop)
+        try:
+            self._loop.run_forever()
+        finally:
+            self.shutdown()
+
+    def shutdown(self) -> None:
+        '''
+        Remove the files of the bot that live in memory (attachments) and close the pooled HTTP connections,
+        once the event loop has stopped
+        '''
+        self.attachments.cleanup()
+        self.http.close()
\ No newline at end of file
@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+'''
+###############################################################################
+##
+## 88        88 88
+## 88        88 88
+## 88        88 88
+## 88        88 88,dPPYba,   ,adPPYba,   ,adPPYba,
+## 88        88 88P'    "8a a8"     "8a a8P_____88
+## 88        88 88       d8 8b       d8 8PP"""""""
+## Y8a.    .a8P 88b,   ,a8" "8a,   ,a8" "8b,   ,aa
+##  `"Y8888Y"'  `"8Ybbd8"'   `"YbbdP"'   `"Ybbd8"'
+##
+###############################################################################
+Minimal asyncio HTTP/1.1 client used to download webcam snapshots and gcode
+thumbnails without blocking the event loop.
+Connections are kept alive and pooled per host, every request has a timeout and
+the number of requests in flight is bounded. Redirects are followed, up to
+MAX_REDIRECTS per request.
+'''
+from __future__ import annotations
+import asyncio
+import ssl
+import time
+import logging
+from urllib.parse import urljoin, urlsplit
+
+from typing import Dict, List, Optional, Tuple
+
+MAX_BODY_SIZE = 20 * 1024 * 1024
+USER_AGENT = "uboe_keybase_bot"
+MAX_REDIRECTS = 5
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+
+_PoolKey = Tuple[str, str, int]
+
+
+class HttpError(Exception):
+    '''Raised when a response cannot be read or is malformed.'''
+
+
+class HttpResponse:
+    def __init__(self, url: str, status: int, headers: Dict[str, str], body: bytes) -> None:
+        '''
+        Fully read HTTP response
+        @param url: Requested url
+        @param status: HTTP status code
+        @param headers: Response headers (lower-cased names)
+        @param body: Response body
+        '''
+        self.url = url
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+    def __repr__(self) -> str:
+        return f"<HttpResponse [{self.status}] {len(self.body)} bytes>"
+
+
+class _Connection:
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self.reader = reader
+        self.writer = writer
+        self.last_used = time.monotonic()
+
+    def close(self) -> None:
+        try:
+            self.writer.close()
+        except Exception:
+            pass
+
+
+class AsyncHttpClient:
+    def __init__(
+        self,
+        timeout: float = 10.,
+        max_concurrency: int = 8,
+        max_idle_per_host: int = 4,
+        idle_timeout: float = 30.,
+        logger: Optional[logging.Logger] = None
+    ) -> None:
+        '''
+        Keep-alive HTTP client with a shared connection pool.
+        @param timeout: Default timeout (in seconds) for a whole request
+        @param max_concurrency: Maximum number of requests in flight
+        @param max_idle_per_host: Maximum number of idle connections kept per host
+        @param idle_timeout: Idle connections older than this are dropped
+        @param logger: Logger instance
+        '''
+        self.timeout = timeout
+        self.max_concurrency = max_concurrency
+        self.max_idle_per_host = max_idle_per_host
+        self.idle_timeout = idle_timeout
+        self.logger = logger or logging.getLogger(__name__)
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._pool: Dict[_PoolKey, List[_Connection]] = {}
+        self._ssl_context: Optional[ssl.SSLContext] = None
+
+    async def get(self, url: str, timeout: Optional[float] = None) -> HttpResponse:
+        '''
+        Send a GET request and read the whole response, following redirects
+        @param url: Url to download
+        @param timeout: Timeout in seconds for the request and its redirects, defaults to the client timeout
+        @return: The response of the last url (see HttpResponse.url)
+        Raises asyncio.TimeoutError, OSError or HttpError on failure.
+        '''
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        async with self._semaphore:
+            return await asyncio.wait_for(
+                self._follow("GET", url),
+                timeout if timeout is not None else self.timeout
+            )
+
+    def close(self) -> None:
+        '''
+        Close every pooled connection
+        '''
+        for conns in self._pool.values():
+            for conn in conns:
+                conn.close()
+        self._pool.clear()
+
+    async def _follow(self, method: str, url: str) -> HttpResponse:
+        for _ in range(MAX_REDIRECTS + 1):
+            response = await self._request(method, url)
+            location = response.headers.get("location")
+            if response.status not in REDIRECT_STATUSES or not location:
+                return response
+            self.logger.debug(f"{url} redirected ({response.status}) to {location}")
+            url = urljoin(url, location)
+        raise HttpError(f"Too many redirects (more than {MAX_REDIRECTS}), last url {url}")
+
+    async def _request(self, method: str, url: str) -> HttpResponse:
+        parts = urlsplit(url)
+        if parts.scheme not in ("http", "https") or not parts.hostname:
+            raise HttpError(f"Unsupported url {url}")
+        port = parts.port or (443 if parts.scheme == "https" else 80)
+        key: _PoolKey = (parts.scheme, parts.hostname, port)
+        target = parts.path or "/"
+        if parts.query:
+            target += "?" + parts.query
+        host = parts.hostname if parts.port is None else f"{parts.hostname}:{parts.port}"
+        request = (
+            f"{method} {target} HTTP/1.1\r\n"
+            f"Host: {host}\r\n"
+            f"User-Agent: {USER_AGENT}\r\n"
+            "Accept: */*\r\n"
+            "Connection: keep-alive\r\n"
+            "\r\n"
+        ).encode("latin-1")
+
+        # a pooled connection may have been closed by the server in the
+        # meantime, in that case retry once on a fresh connection
+        for attempt in range(2):
+            conn, reused = await self._acquire(key)
+            try:
+                conn.writer.write(request)
+                await conn.writer.drain()
+                status, headers, body, keep_alive = await self._read_response(conn.reader, method)
+            except asyncio.CancelledError:
+                conn.close()
+                raise
+            except (ConnectionError, asyncio.IncompleteReadError, HttpError) as e:
+                conn.close()
+                if reused and attempt == 0:
+                    self.logger.debug(f"Stale pooled connection to {key[1]}:{key[2]} ({e}), retrying")
+                    continue
+                if isinstance(e, HttpError):
+                    raise
+                raise HttpError(f"Connection error on {url}: {e}") from e
+            except Exception:
+                conn.close()
+                raise
+            if keep_alive:
+                self._release(key, conn)
+            else:
+                conn.close()
+            return HttpResponse(url, status, headers, body)
+        raise HttpError(f"Could not complete request to {url}")
+
+    async def _acquire(self, key: _PoolKey) -> Tuple[_Connection, bool]:
+        conns = self._pool.get(key, [])
+        now = time.monotonic()
+        while conns:
+            conn = conns.pop()
+            if now - conn.last_used > self.idle_timeout or conn.reader.at_eof():
+                conn.close()
+                continue
+            return conn, True
+        scheme, hostname, port = key
+        ssl_ctx = None
+        if scheme == "https":
+            if self._ssl_context is None:
+                self._ssl_context = ssl.create_default_context()
+            ssl_ctx = self._ssl_context
+        reader, writer = await asyncio.open_connection(hostname, port, ssl=ssl_ctx)
+        return _Connection(reader, writer), False
+
+    def _release(self, key: _PoolKey, conn: _Connection) -> None:
+        conns = self._pool.setdefault(key, [])
+        if len(conns) >= self.max_idle_per_host:
+            conn.close()
+            return
+        conn.last_used = time.monotonic()
+        conns.append(conn)
+
+    async def _read_response(
+        self, reader: asyncio.StreamReader, method: str
+    ) -> Tuple[int, Dict[str, str], bytes, bool]:
+        head = await reader.readuntil(b"\r\n\r\n")
+        lines = head[:-4].decode("latin-1").split("\r\n")
+        status_line = lines[0].split(" ", 2)
+        if len(status_line) < 2 or not status_line[0].startswith("HTTP/"):
+            raise HttpError(f"Malformed status line: {lines[0]!r}")
+        try:
+            status = int(status_line[1])
+        except ValueError:
+            raise HttpError(f"Malformed status line: {lines[0]!r}")
+        headers: Dict[str, str] = {}
+        for line in lines[1:]:
+            name, sep, value = line.partition(":")
+            if sep:
+                headers[name.strip().lower()] = value.strip()
+
+        keep_alive = status_line[0] == "HTTP/1.1"
+        connection = headers.get("connection", "").lower()
+        if connection == "close":
+            keep_alive = False
+        elif connection == "keep-alive":
+            keep_alive = True
+
+        if method == "HEAD" or status in (204, 304) or 100 <= status < 200:
+            body = b""
+        elif "chunked" in headers.get("transfer-encoding", "").lower():
+            body = await self._read_chunked(reader)
+        elif "content-length" in headers:
+            try:
+                length = int(headers["content-length"])
+                if length < 0:
+                    raise ValueError(length)
+            except ValueError:
+                raise HttpError(f"Malformed Content-Length: {headers['content-length']!r}")
+            if length > MAX_BODY_SIZE:
+                raise HttpError(f"Response too large ({length} bytes)")
+            body = await reader.readexactly(length)
+        else:
+            # body delimited by the end of the connection
+            body = await reader.read(MAX_BODY_SIZE + 1)
+            chunks = [body]
+            size = len(body)
+            while body and size <= MAX_BODY_SIZE:
+                body = await reader.read(MAX_BODY_SIZE + 1 - size)
+                chunks.append(body)
+                size += len(body)
+            if size > MAX_BODY_SIZE:
+                raise HttpError("Response too large")
+            body = b"".join(chunks)
+            keep_alive = False
+        return status, headers, body, keep_alive
+
+    async def _read_chunked(self, reader: asyncio.StreamReader) -> bytes:
+        chunks: List[bytes] = []
+        size = 0
+        while True:
+            line = await reader.readuntil(b"\r\n")
+            try:
+                chunk_len = int(line.split(b";", 1)[0].strip(), 16)
+            except ValueError:
+                raise HttpError(f"Malformed chunk header: {line!r}")
+            if chunk_len == 0:
+                # skip trailers
+                while (await reader.readuntil(b"\r\n")) != b"\r\n":
+                    pass
+                return b"".join(chunks)
+            size += chunk_len
+            if size > MAX_BODY_SIZE:
+                raise HttpError("Response too large")
+            chunks.append(await reader.readexactly(chunk_len))
+            await reader.readexactly(2)
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+'''
+###############################################################################
+##
+## 88        88 88
+## 88        88 88
+## 88        88 88
+## 88        88 88,dPPYba,   ,adPPYba,   ,adPPYba,
+## 88        88 88P'    "8a a8"     "8a a8P_____88
+## 88        88 88       d8 8b       d8 8PP"""""""
+## Y8a.    .a8P 88b,   ,a8" "8a,   ,a8" "8b,   ,aa
+##  `"Y8888Y"'  `"8Ybbd8"'   `"YbbdP"'   `"Ybbd8"'
+##
+###############################################################################
+Files handed to `bot.chat.attach` (the keybase CLI only uploads from a path).
+Every attachment gets its own file, on a memory backed filesystem when one is
+available, so concurrent messages never overwrite each other's images. Files
+are reference counted and removed once the last upload using them is done.
+Each printer has a fixed directory, emptied when the store is created so that
+files left by a run that did not shut down cleanly do not pile up in memory,
+and removed by cleanup() on shutdown.
+'''
+from __future__ import annotations
+import itertools
+import os
+import shutil
+import tempfile
+import logging
+
+from typing import Dict, Optional
+
+# memory backed locations tried in order, the first writable one is used
+TMPFS_DIRS = ['/dev/shm', os.environ.get('XDG_RUNTIME_DIR', '')]
+
+
+class Attachment:
+    def __init__(self, store: Optional[AttachmentStore], path: str, key: Optional[int] = None) -> None:
+        '''
+        @param store: Owning store, None for static files that are never deleted
+        @param path: File path
+        @param key: Key of the attachment in its store
+        '''
+        self.store = store
+        self.path = path
+        self.key = key
+        self.refs = 1
+
+    def acquire(self) -> Attachment:
+        '''
+        Take an extra reference (e.g. to send the file to a second channel)
+        '''
+        self.refs += 1
+        return self
+
+    def release(self) -> None:
+        '''
+        Drop a reference, the file is removed with the last one
+        '''
+        self.refs -= 1
+        if self.refs <= 0 and self.store is not None:
+            self.store._remove(self)
+
+    def __enter__(self) -> str:
+        return self.path
+
+    def __exit__(self, *exc) -> None:
+        self.release()
+
+
+def attachment_dir(fallback_dir: str, name: str) -> str:
+    '''
+    @param fallback_dir: Directory used when no memory backed filesystem is writable
+    @param name: Printer name
+    @return: Directory of the attachments of a printer
+    '''
+    root = fallback_dir
+    for candidate in TMPFS_DIRS:
+        if candidate and os.path.isdir(candidate) and os.access(candidate, os.W_OK):
+            root = candidate
+            break
+    return os.path.join(root, f'keybase_bot-{os.getuid()}-{name}')
+
+
+class AttachmentStore:
+    def __init__(self, fallback_dir: str, name: str = 'bot', logger: Optional[logging.Logger] = None) -> None:
+        '''
+        @param fallback_dir: Directory used when no memory backed filesystem is writable
+        @param name: Printer name, the files are kept in a directory of their own
+        @param logger: Logger instance
+        '''
+        self.logger = logger or logging.getLogger(__name__)
+        self.dir = attachment_dir(fallback_dir, name)
+        root = os.path.dirname(self.dir)
+        os.makedirs(root, exist_ok=True)
+        # files of a previous run of this printer
+        shutil.rmtree(self.dir, ignore_errors=True)
+        try:
+            os.mkdir(self.dir, 0o700)
+        except FileExistsError:
+            # left by another user, which we cannot remove
+            self.dir = tempfile.mkdtemp(prefix=f'keybase_bot-{name}-', dir=root)
+        self._ids = itertools.count()
+        # attachments alive, keyed by the id() of the data they were written from
+        self._live: Dict[int, Attachment] = {}
+        self._data: Dict[int, bytes] = {}
+
+    def create(self, data: bytes, suffix: str = '') -> Attachment:
+        '''
+        Get a file holding data. Callers passing the same bytes object while a
+        previous attachment is still alive share its file.
+        @param data: File content
+        @param suffix: File extension (e.g. .jpeg)
+        @return: Attachment, to be released once the upload is done
+        '''
+        key = id(data)
+        attachment = self._live.get(key)
+        if attachment is not None and self._data[key] is data:
+            return attachment.acquire()
+        path = os.path.join(self.dir, f'{next(self._ids)}{suffix}')
+        with open(path, 'wb') as f:
+            f.write(data)
+        attachment = Attachment(self, path, key)
+        self._live[key] = attachment
+        # keep the data alive so that its id() cannot be reused while the file exists
+        self._data[key] = data
+        return attachment
+
+    @staticmethod
+    def static(path: str) -> Attachment:
+        '''
+        Wrap a file that must not be deleted (e.g. common/no_image.png)
+        '''
+        return Attachment(None, path)
+
+    def cleanup(self) -> None:
+        '''
+        Remove every file of the store and its directory, on shutdown
+        '''
+        self._live.clear()
+        self._data.clear()
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def _remove(self, attachment: Attachment) -> None:
+        if self._live.get(attachment.key) is attachment:
+            del self._live[attachment.key]
+            del self._data[attachment.key]
+        try:
+            os.unlink(attachment.path)
+        except OSError as e:
+            self.logger.debug(f"Could not remove attachment {attachment.path}: {e}")
+
+    def __len__(self) -> int:
+        return len(self._live)
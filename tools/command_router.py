@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+'''
+###############################################################################
+##
+## 88        88 88
+## 88        88 88
+## 88        88 88
+## 88        88 88,dPPYba,   ,adPPYba,   ,adPPYba,
+## 88        88 88P'    "8a a8"     "8a a8P_____88
+## 88        88 88       d8 8b       d8 8PP"""""""
+## Y8a.    .a8P 88b,   ,a8" "8a,   ,a8" "8b,   ,aa
+##  `"Y8888Y"'  `"8Ybbd8"'   `"YbbdP"'   `"Ybbd8"'
+##
+###############################################################################
+Declarative registry of the chat commands.
+Commands are registered with a decorator giving their verb, typed arguments,
+permission and help line. Messages that do not start with the prefix are
+rejected with a single startswith(), commands are looked up by verb in a dict
+and their arguments are matched against a grammar compiled at registration.
+'''
+from __future__ import annotations
+import re
+
+from typing import Any, Callable, Collection, Dict, List, NamedTuple, Optional, Tuple
+
+NOT_RECOGNIZED = "Command not recognized. Try `{prefix} help`"
+NO_COMMAND = "Not command received. Try `{prefix} help`"
+DEBUG_DENIED = "You are not allowed to enable debug mode"
+
+# argument types: (regex of a value, converter)
+_TYPES: Dict[type, Tuple[str, Callable[[str], Any]]] = {
+    int : (r'-?\d+', int),
+    str : (r'\S+', str),
+    bool : (r'(?i:true|false)', lambda v: v.lower() == 'true'),
+}
+
+
+class Arg(NamedTuple):
+    '''
+    Command argument, written name=<value> when keyword is True, <value> otherwise
+    '''
+    name: str
+    type: type = str
+    keyword: bool = False
+    optional: bool = False
+
+    def usage(self) -> str:
+        text = f'{self.name}=<{self.type.__name__}>' if self.keyword else f'<{self.name}>'
+        return f'[{text}]' if self.optional else text
+
+
+class Command:
+    def __init__(
+        self, verb: str, handler: Callable, args: List[Arg], help: str = '',
+        restricted: Optional[str] = None, debug: bool = False, concurrency: Optional[int] = None,
+        coalesce: bool = False
+    ) -> None:
+        '''
+        @param verb: Command name, may be two words (e.g. "config set")
+        @param handler: Coroutine function called with the parsed arguments as keywords
+        @param args: Arguments, in the order they are written
+        @param help: Help line
+        @param restricted: Message sent to users outside of the allowed users, None if anybody can run it
+        @param debug: Only available after the debug keyword
+        @param concurrency: Maximum number of handlers of the command running at once, None for no limit
+        @param coalesce: Identical pending requests from the same channel share one execution
+        '''
+        self.verb = verb
+        self.handler = handler
+        self.args = args
+        self.help = help
+        self.restricted = restricted
+        self.debug = debug
+        self.concurrency = concurrency
+        self.coalesce = coalesce
+        self.usage = ' '.join([verb] + [a.usage() for a in args])
+        self.grammar = re.compile(self._grammar(args))
+        self._converters = {a.name : _TYPES[a.type][1] for a in args}
+
+    @staticmethod
+    def _grammar(args: List[Arg]) -> str:
+        pattern = ''
+        for i, arg in enumerate(args):
+            value = f'(?P<{arg.name}>{_TYPES[arg.type][0]})'
+            piece = (r'\s+' if i else '') + (f'{arg.name}={value}' if arg.keyword else value)
+            pattern += f'(?:{piece})?' if arg.optional else piece
+        return f'^{pattern}$'
+
+    def parse(self, text: str) -> Optional[Dict[str, Any]]:
+        '''
+        @param text: Arguments written after the verb
+        @return: Converted arguments (None for absent optional ones), None if the text does not match
+        '''
+        match = self.grammar.match(text)
+        if match is None:
+            return None
+        return {
+            name : self._converters[name](value) if value is not None else None
+            for name, value in match.groupdict().items()
+        }
+
+
+class Route(NamedTuple):
+    '''
+    Outcome of CommandRouter.resolve: either a command with its arguments or an error message
+    '''
+    command: Optional[Command]
+    kwargs: Dict[str, Any]
+    error: Optional[str]
+
+
+class CommandRouter:
+    def __init__(self, prefix: str) -> None:
+        '''
+        @param prefix: Leading word of every command (e.g. /uboe_bot)
+        '''
+        self.prefix = prefix
+        self.commands: Dict[Tuple[bool, str], Command] = {}
+        # first words of the two word verbs
+        self._groups: set = set()
+
+    def command(
+        self, verb: str, *args: Arg, help: str = '', restricted: Optional[str] = None, debug: bool = False,
+        concurrency: Optional[int] = None, coalesce: bool = False
+    ) -> Callable[[Callable], Callable]:
+        '''
+        Decorator registering a command handler
+        @param verb: Command name, may be two words (e.g. "config set")
+        @param args: Arguments, in the order they are written
+        @param help: Help line
+        @param restricted: Message sent to users outside of the allowed users, None if anybody can run it
+        @param debug: Only available after the debug keyword
+        @param concurrency: Maximum number of handlers of the command running at once, None for no limit
+        @param coalesce: Identical pending requests from the same channel share one execution
+        '''
+        def register(handler: Callable) -> Callable:
+            key = (debug, verb)
+            if key in self.commands:
+                raise ValueError(f"Command {verb} registered twice")
+            self.commands[key] = Command(verb, handler, list(args), help, restricted, debug, concurrency, coalesce)
+            if ' ' in verb:
+                self._groups.add(verb.split(' ', 1)[0])
+            return handler
+        return register
+
+    def resolve(self, text: str, sender: str, allowed_users: Collection[str]) -> Optional[Route]:
+        '''
+        Find the command of a chat message
+        @param text: Message body
+        @param sender: Username of the sender
+        @param allowed_users: Users allowed to run the restricted and debug commands
+        @return: None if the message is not addressed to the bot
+        '''
+        if not text.startswith(self.prefix):
+            return None
+        body = text[len(self.prefix):]
+        if body[:1].strip():
+            # another word starting with the prefix
+            return None
+        words = body.split(None, 1)
+        if not words:
+            return Route(None, {}, NO_COMMAND.format(prefix=self.prefix))
+        debug = words[0] == 'debug'
+        if debug:
+            if sender not in allowed_users:
+                return Route(None, {}, DEBUG_DENIED)
+            words = words[1].split(None, 1) if len(words) > 1 else []
+            if not words:
+                return Route(None, {}, NO_COMMAND.format(prefix=self.prefix))
+        verb, rest = words[0], words[1] if len(words) > 1 else ''
+        command = None
+        if verb in self._groups and rest:
+            sub = rest.split(None, 1)
+            command = self._lookup(debug, f'{verb} {sub[0]}')
+            if command is not None:
+                rest = sub[1] if len(sub) > 1 else ''
+        if command is None:
+            command = self._lookup(debug, verb)
+        if command is None:
+            return Route(None, {}, NOT_RECOGNIZED.format(prefix=self.prefix))
+        if command.restricted is not None and sender not in allowed_users:
+            return Route(command, {}, command.restricted)
+        kwargs = command.parse(rest.strip())
+        if kwargs is None:
+            return Route(command, {}, f"Malformed command received. Usage: `{self.prefix} {command.usage}`")
+        return Route(command, kwargs, None)
+
+    def help(self, debug: bool = False) -> str:
+        '''
+        @param debug: List the debug commands instead of the regular ones
+        @return: One line per command with a help line, in registration order
+        '''
+        return '\n'.join(
+            f'`{c.usage}` - {c.help}' for c in self.commands.values() if c.debug == debug and c.help
+        )
+
+    def _lookup(self, debug: bool, verb: str) -> Optional[Command]:
+        command = self.commands.get((False, verb))
+        if debug and command is None:
+            command = self.commands.get((True, verb))
+        return command
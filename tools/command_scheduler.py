@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+'''
+###############################################################################
+##
+## 88        88 88
+## 88        88 88
+## 88        88 88
+## 88        88 88,dPPYba,   ,adPPYba,   ,adPPYba,
+## 88        88 88P'    "8a a8"     "8a a8P_____88
+## 88        88 88       d8 8b       d8 8PP"""""""
+## Y8a.    .a8P 88b,   ,a8" "8a,   ,a8" "8b,   ,aa
+##  `"Y8888Y"'  `"8Ybbd8"'   `"YbbdP"'   `"Ybbd8"'
+##
+###############################################################################
+Scheduler running the chat command handlers.
+Each command may cap how many of its handlers run at once, the extra requests
+wait in a queue shared by all commands whose size is bounded: once it is full
+new requests are refused with SchedulerBusyError. Identical requests arriving
+while one is pending are coalesced, they all get the result of one execution.
+'''
+from __future__ import annotations
+import asyncio
+from collections import deque
+
+from typing import Any, Awaitable, Callable, Deque, Dict, Hashable, Optional
+
+MAX_QUEUED = 8
+
+
+class SchedulerBusyError(Exception):
+    '''Raised when a request would have to wait while the queue is full.'''
+
+
+class _Slots:
+    def __init__(self, limit: int) -> None:
+        self.limit = limit
+        self.active = 0
+        self.waiters: Deque[asyncio.Future] = deque()
+
+
+class CommandScheduler:
+    def __init__(self, max_queued: int = MAX_QUEUED) -> None:
+        '''
+        @param max_queued: Maximum number of requests waiting for a slot, over all commands
+        '''
+        self.max_queued = max_queued
+        self.queued = 0
+        self._slots: Dict[str, _Slots] = {}
+        # pending executions that identical requests can join: key -> [future, number of requests]
+        self._pending: Dict[Hashable, list] = {}
+        self.executed = 0
+        self.coalesced = 0
+        self.rejected = 0
+
+    async def run(
+        self, name: str, limit: Optional[int], key: Optional[Hashable], factory: Callable[[], Awaitable[Any]],
+        share: Optional[Callable[[Any], None]] = None
+    ) -> Any:
+        '''
+        Run a command handler
+        @param name: Command name, the concurrency limit applies per name
+        @param limit: Maximum number of concurrent executions of the command, None for no limit
+        @param key: Requests with the same key share a pending execution, None to never coalesce
+        @param factory: Coroutine function running the handler
+        @param share: Called with the result once per extra request it is handed to (e.g. to take a reference)
+        @return: Result of the handler
+        Raises SchedulerBusyError when the request cannot be queued.
+        '''
+        pending = self._pending.get(key) if key is not None else None
+        if pending is not None:
+            pending[1] += 1
+            self.coalesced += 1
+            return await asyncio.shield(pending[0])
+        waiter = self._acquire(name, limit)
+        fut = asyncio.ensure_future(self._execute(name, limit, key, waiter, factory, share))
+        # the error is retrieved here in case every caller gave up already
+        fut.add_done_callback(lambda f: f.cancelled() or f.exception())
+        if key is not None:
+            self._pending[key] = [fut, 1]
+        # a caller giving up must not cancel the execution shared with the others
+        return await asyncio.shield(fut)
+
+    def stats(self) -> Dict[str, Any]:
+        '''
+        @return: Scheduler counters
+        '''
+        return {
+            'executed' : self.executed,
+            'coalesced' : self.coalesced,
+            'rejected' : self.rejected,
+            'queued' : self.queued,
+            'running' : {name : slots.active for name, slots in self._slots.items() if slots.active},
+        }
+
+    def _acquire(self, name: str, limit: Optional[int]) -> Optional[asyncio.Future]:
+        '''
+        Take a slot of the command, or a place in the queue
+        @return: None if a slot was taken, a future resolved when a slot is handed over otherwise
+        '''
+        if limit is None:
+            return None
+        slots = self._slots.get(name)
+        if slots is None:
+            slots = self._slots[name] = _Slots(limit)
+        if slots.active < slots.limit:
+            slots.active += 1
+            return None
+        if self.queued >= self.max_queued:
+            self.rejected += 1
+            raise SchedulerBusyError(f"{self.queued} commands already waiting")
+        waiter = asyncio.get_event_loop().create_future()
+        slots.waiters.append(waiter)
+        self.queued += 1
+        return waiter
+
+    def _release(self, name: str) -> None:
+        slots = self._slots.get(name)
+        if slots is None:
+            return
+        while slots.waiters:
+            waiter = slots.waiters.popleft()
+            self.queued -= 1
+            if not waiter.done():
+                # the slot goes straight to the next request
+                waiter.set_result(None)
+                return
+        slots.active -= 1
+
+    async def _execute(
+        self, name: str, limit: Optional[int], key: Optional[Hashable], waiter: Optional[asyncio.Future],
+        factory: Callable[[], Awaitable[Any]], share: Optional[Callable[[Any], None]]
+    ) -> Any:
+        try:
+            if waiter is not None:
+                await waiter
+            self.executed += 1
+            result = await factory()
+        finally:
+            pending = self._pending.pop(key, None) if key is not None else None
+            # a request cancelled while queued never got its slot
+            if limit is not None and (waiter is None or (waiter.done() and not waiter.cancelled())):
+                self._release(name)
+        if pending is not None and share is not None:
+            # runs before any of the requests resumes
+            for _ in range(pending[1] - 1):
+                share(result)
+        return result
@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+'''
+###############################################################################
+##
+## 88        88 88
+## 88        88 88
+## 88        88 88
+## 88        88 88,dPPYba,   ,adPPYba,   ,adPPYba,
+## 88        88 88P'    "8a a8"     "8a a8P_____88
+## 88        88 88       d8 8b       d8 8PP"""""""
+## Y8a.    .a8P 88b,   ,a8" "8a,   ,a8" "8b,   ,aa
+##  `"Y8888Y"'  `"8Ybbd8"'   `"YbbdP"'   `"Ybbd8"'
+##
+###############################################################################
+Configuration store of the bot.
+Every JSON configuration file (service settings, cameras, allowed users) is a
+ConfigFile of the store: its content is validated when it is loaded or
+changed, saves are atomic (temporary file then rename) and run in a thread,
+and the store polls the modification time of the files, from a thread too, to
+reload the ones edited on disk without a restart. An invalid file is reported
+and ignored: the bot starts with the default content, or keeps the current one. Subscribers are called with the old and new
+content of a file whenever it changes. A file is opened once per process, so
+printers sharing a file share its ConfigFile.
+'''
+from __future__ import annotations
+import asyncio
+import json
+import logging
+import os
+import tempfile
+
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+# interval (in seconds) at which the files are checked for changes
+RELOAD_INTERVAL = 2.
+
+
+class ConfigError(ValueError):
+    '''Raised when a configuration does not match its schema.'''
+
+
+def check_type(key: str, value: Any, expected: type) -> Any:
+    '''
+    Validate a setting against the type of its default value
+    @param key: Setting name, used in the error message
+    @param value: Value to check
+    @param expected: Expected type, an int is accepted for a float
+    @return: The value, converted to float if a float is expected
+    Raises ConfigError.
+    '''
+    if expected is float and isinstance(value, int) and not isinstance(value, bool):
+        return float(value)
+    if isinstance(value, bool) and expected is not bool:
+        raise ConfigError(f"`{key}` must be of type {expected.__name__}, not a boolean")
+    if not isinstance(value, expected):
+        raise ConfigError(f"`{key}` must be of type {expected.__name__}, got {value!r}")
+    return value
+
+
+def atomic_write_json(path: str, data: Any) -> None:
+    '''
+    Write a JSON file so that readers see either the old or the new content, never a partial one
+    '''
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(prefix='.' + os.path.basename(path), suffix='.part', dir=directory)
+    try:
+        with os.fdopen(fd, 'w') as file:
+            json.dump(data, file, indent=4)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+
+
+class ConfigFile:
+    def __init__(
+        self, path: str, default: Any, validate: Optional[Callable[[Any], Any]] = None,
+        logger: Optional[logging.Logger] = None
+    ) -> None:
+        '''
+        @param path: JSON file, created with the default content if absent
+        @param default: Content used when the file is absent or invalid
+        @param validate: Called with the loaded content, returns it normalized or raises ConfigError
+        @param logger: Logger instance
+        '''
+        self.path = path
+        self.default = default
+        self.validate = validate or (lambda data: data)
+        self.logger = logger or logging.getLogger(__name__)
+        self._subscribers: List[Callable[[Any, Any], None]] = []
+        self._stamp: Optional[Tuple[float, int]] = None
+        self._lock: Optional[asyncio.Lock] = None
+        self.reloads = 0
+        self.errors = 0
+        if os.path.exists(path):
+            try:
+                self.data = self.validate(self._read())
+            except (OSError, ValueError) as e:
+                # the file is kept for the user to fix it, check() loads it once it is valid
+                self.errors += 1
+                self.logger.error(f"Invalid configuration {self.path}, using the defaults: {e}")
+                self.data = self.validate(default)
+        else:
+            self.data = self.validate(default)
+            atomic_write_json(path, self.data)
+            self._stamp = self._stat()
+
+    def subscribe(self, callback: Callable[[Any, Any], None]) -> None:
+        '''
+        @param callback: Called with the old and the new content after each change
+        '''
+        self._subscribers.append(callback)
+
+    async def save(self, data: Any) -> None:
+        '''
+        Validate and apply a new content, then write it to disk off the event loop
+        @param data: New content
+        Raises ConfigError, the current content is kept.
+        '''
+        data = self.validate(data)
+        self._set(data)
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            # concurrent saves write the latest content, in order
+            await asyncio.get_event_loop().run_in_executor(None, atomic_write_json, self.path, self.data)
+            self._stamp = self._stat()
+
+    async def check(self) -> bool:
+        '''
+        Reload the file if it changed on disk since it was last read or written, the file
+        is read off the event loop. An invalid file is reported and ignored, the current content is kept.
+        @return: True if the content changed
+        '''
+        loop = asyncio.get_event_loop()
+        stamp = await loop.run_in_executor(None, self._stat)
+        if stamp == self._stamp:
+            return False
+        try:
+            data = self.validate(await loop.run_in_executor(None, self._read))
+        except (OSError, ValueError) as e:
+            self.errors += 1
+            self.logger.error(f"Ignoring invalid configuration {self.path}: {e}")
+            return False
+        if data == self.data:
+            return False
+        self.reloads += 1
+        self.logger.info(f"Configuration {self.path} reloaded")
+        self._set(data)
+        return True
+
+    def _set(self, data: Any) -> None:
+        old, self.data = self.data, data
+        for callback in self._subscribers:
+            try:
+                callback(old, data)
+            except Exception as e:
+                self.logger.error(f"Configuration subscriber of {self.path} failed: {e!r}")
+
+    def _read(self) -> Any:
+        # the stamp is taken first: a write racing with the read is picked up by the next check
+        self._stamp = self._stat()
+        with open(self.path, 'r') as file:
+            return json.load(file)
+
+    def _stat(self) -> Optional[Tuple[float, int]]:
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return st.st_mtime, st.st_size
+
+
+class ConfigStore:
+    def __init__(self, interval: float = RELOAD_INTERVAL, logger: Optional[logging.Logger] = None) -> None:
+        '''
+        @param interval: Time (in seconds) between two checks of the files
+        @param logger: Logger instance
+        '''
+        self.interval = interval
+        self.logger = logger or logging.getLogger(__name__)
+        self.files: Dict[str, ConfigFile] = {}
+        self._watcher: Optional[asyncio.Future] = None
+
+    def open(self, path: str, default: Any, validate: Optional[Callable[[Any], Any]] = None) -> ConfigFile:
+        '''
+        @return: The ConfigFile of path, loaded on the first call
+        A file that does not match its schema is reported, and its default content is used.
+        '''
+        key = os.path.abspath(path)
+        config = self.files.get(key)
+        if config is None:
+            config = self.files[key] = ConfigFile(path, default, validate, self.logger)
+        return config
+
+    def watch(self) -> None:
+        '''
+        Start checking the files for changes, once per process
+        '''
+        if self._watcher is None or self._watcher.done():
+            self._watcher = asyncio.ensure_future(self._watch())
+
+    async def _watch(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            for config in list(self.files.values()):
+                await config.check()
+
+
+CONFIG = ConfigStore()
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+'''
+###############################################################################
+##
+## 88        88 88
+## 88        88 88
+## 88        88 88
+## 88        88 88,dPPYba,   ,adPPYba,   ,adPPYba,
+## 88        88 88P'    "8a a8"     "8a a8P_____88
+## 88        88 88       d8 8b       d8 8PP"""""""
+## Y8a.    .a8P 88b,   ,a8" "8a,   ,a8" "8b,   ,aa
+##  `"Y8888Y"'  `"8Ybbd8"'   `"YbbdP"'   `"Ybbd8"'
+##
+###############################################################################
+Logging setup of the bot.
+Records are handed to a queue by the logging calls, a listener thread formats
+them and writes them to the console and to the log file, so the event loop
+never waits on the disk. The log file is appended to and rotated by size and
+by time, the rotated files keep the history across restarts. The file can be
+written as JSON lines, with the event fields given through `extra` (method,
+job_id, latency...) as members.
+'''
+from __future__ import annotations
+import datetime
+import json
+import logging
+import os
+import queue
+import time
+from logging.handlers import QueueHandler, QueueListener, TimedRotatingFileHandler
+
+from typing import Any, Dict, List, Optional
+
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+# record attributes written as JSON members when a logging call gives them in extra
+EVENT_FIELDS = ('printer', 'method', 'job_id', 'status', 'camera', 'channel', 'latency', 'attempt')
+MAX_BYTES = 10 * 1024 * 1024
+BACKUP_COUNT = 7
+
+
+class JsonFormatter(logging.Formatter):
+    '''
+    One JSON object per line: ts, level, logger, message, the event fields and the exception if any
+    '''
+    def format(self, record: logging.LogRecord) -> str:
+        entry: Dict[str, Any] = {
+            'ts' : datetime.datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level' : record.levelname,
+            'logger' : record.name,
+            'message' : record.getMessage(),
+        }
+        for field in EVENT_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class RotatingFileHandler(TimedRotatingFileHandler):
+    '''
+    Log file rotated at the given time interval or once it grows over max_bytes, whichever comes first
+    '''
+    def __init__(
+        self, filename: str, max_bytes: int = MAX_BYTES, when: str = 'midnight', backup_count: int = BACKUP_COUNT
+    ) -> None:
+        '''
+        @param filename: Path of the log file, appended to
+        @param max_bytes: Size (in bytes) triggering a rotation, 0 only rotates by time
+        @param when: Rotation interval (see TimedRotatingFileHandler: S, M, H, D, midnight, W0-W6)
+        @param backup_count: Rotated files kept
+        '''
+        super().__init__(filename, when=when, backupCount=backup_count, delay=True)
+        self.max_bytes = max_bytes
+
+    def shouldRollover(self, record: logging.LogRecord) -> int:
+        if super().shouldRollover(record):
+            return 1
+        if self.max_bytes <= 0:
+            return 0
+        if self.stream is None:
+            self.stream = self._open()
+        return int(self.stream.tell() >= self.max_bytes)
+
+    def doRollover(self) -> None:
+        # named after the rotation time, a size rotation may happen several times in one interval
+        if self.stream:
+            self.stream.close()
+            self.stream = None
+        target = f"{self.baseFilename}.{datetime.datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}"
+        rotated, n = target, 1
+        while os.path.exists(rotated):
+            rotated, n = f'{target}.{n}', n + 1
+        if os.path.exists(self.baseFilename):
+            os.rename(self.baseFilename, rotated)
+        for old in self.getFilesToDelete():
+            os.remove(old)
+        self.rolloverAt = self.computeRollover(int(time.time()))
+
+    def getFilesToDelete(self) -> List[str]:
+        directory, base = os.path.split(self.baseFilename)
+        rotated = sorted(f for f in os.listdir(directory) if f.startswith(base + '.'))
+        if len(rotated) <= self.backupCount:
+            return []
+        return [os.path.join(directory, f) for f in rotated[:len(rotated) - self.backupCount]]
+
+
+class _QueueHandler(QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # the message is formatted here, only for the records passing the level: the arguments of
+        # a disabled debug call are never turned into text
+        record = super().prepare(record)
+        # the traceback is part of the message now, the file formatter must not append it again
+        record.exc_text = None
+        return record
+
+
+def setup_logging(
+    level: int, path: Optional[str] = None, json_lines: bool = False, max_bytes: int = MAX_BYTES,
+    when: str = 'midnight', backup_count: int = BACKUP_COUNT, console: Optional[logging.Formatter] = None
+) -> QueueListener:
+    '''
+    Route every log record through a queue to the console and the log file
+    @param level: Log level of the root logger
+    @param path: Log file, None to only log to the console
+    @param json_lines: Write the log file as JSON lines
+    @param max_bytes: Size (in bytes) triggering a rotation of the log file
+    @param when: Time interval of the rotation of the log file
+    @param backup_count: Rotated log files kept
+    @param console: Formatter of the console output (e.g. a coloredlogs.ColoredFormatter)
+    @return: The started listener, stop it before exiting to flush the queue
+    '''
+    handlers: List[logging.Handler] = []
+    stream = logging.StreamHandler()
+    stream.setFormatter(console or logging.Formatter(LOG_FORMAT))
+    handlers.append(stream)
+    if path is not None:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        file_handler = RotatingFileHandler(path, max_bytes=max_bytes, when=when, backup_count=backup_count)
+        file_handler.setFormatter(JsonFormatter() if json_lines else logging.Formatter(LOG_FORMAT))
+        handlers.append(file_handler)
+    records: queue.Queue = queue.Queue(-1)
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(_QueueHandler(records))
+    root.setLevel(level)
+    listener = QueueListener(records, *handlers, respect_handler_level=True)
+    listener.start()
+    return listener
@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+'''
+###############################################################################
+##
+## 88        88 88
+## 88        88 88
+## 88        88 88
+## 88        88 88,dPPYba,   ,adPPYba,   ,adPPYba,
+## 88        88 88P'    "8a a8"     "8a a8P_____88
+## 88        88 88       d8 8b       d8 8PP"""""""
+## Y8a.    .a8P 88b,   ,a8" "8a,   ,a8" "8b,   ,aa
+##  `"Y8888Y"'  `"8Ybbd8"'   `"YbbdP"'   `"Ybbd8"'
+##
+###############################################################################
+Lightweight metrics in the Prometheus text format.
+Counters, gauges and histograms live in a process wide registry (REGISTRY) and
+are served on GET /metrics by a small HTTP server listening on a local TCP port
+or a Unix socket. Labelled children are created once and cached, so recording
+a value costs a few additions.
+'''
+from __future__ import annotations
+import asyncio
+import bisect
+import logging
+import os
+
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+DEFAULT_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1., 2.5, 5., 10.)
+# interval (in seconds) of the event loop lag probe
+LAG_INTERVAL = 0.5
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _CounterChild:
+    def __init__(self) -> None:
+        self.value = 0.
+
+    def inc(self, amount: float = 1.) -> None:
+        self.value += amount
+
+
+class _GaugeChild:
+    def __init__(self) -> None:
+        self.value = 0.
+        self.function: Optional[Callable[[], float]] = None
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+    def set_function(self, function: Callable[[], float]) -> None:
+        '''
+        Read the value from function at every scrape
+        '''
+        self.function = function
+
+    def get(self) -> float:
+        return self.function() if self.function is not None else self.value
+
+
+class _HistogramChild:
+    def __init__(self, buckets: Sequence[float]) -> None:
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        idx = bisect.bisect_left(self.buckets, value)
+        if idx < len(self.counts):
+            self.counts[idx] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metric:
+    kind = ''
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()) -> None:
+        '''
+        @param name: Metric name
+        @param help: Description
+        @param labelnames: Names of the labels
+        '''
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Tuple[str, ...], object] = {}
+
+    def labels(self, **labels: object):
+        '''
+        @return: The child of the given label values (created on first use)
+        '''
+        key = tuple(str(labels[n]) for n in self.labelnames)
+        child = self._children.get(key)
+        if child is None:
+            child = self._children[key] = self._new_child()
+        return child
+
+    def _new_child(self) -> object:
+        raise NotImplementedError
+
+    def _label_str(self, key: Tuple[str, ...], extra: str = '') -> str:
+        pairs = [f'{n}="{_escape(v)}"' for n, v in zip(self.labelnames, key)]
+        if extra:
+            pairs.append(extra)
+        return '{' + ','.join(pairs) + '}' if pairs else ''
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        for key, child in list(self._children.items()):
+            lines.extend(self._render_child(key, child))
+        return lines
+
+    def _render_child(self, key: Tuple[str, ...], child) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def _new_child(self) -> _CounterChild:
+        return _CounterChild()
+
+    def _render_child(self, key: Tuple[str, ...], child: _CounterChild) -> List[str]:
+        return [f'{self.name}{self._label_str(key)} {_format(child.value)}']
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def _new_child(self) -> _GaugeChild:
+        return _GaugeChild()
+
+    def _render_child(self, key: Tuple[str, ...], child: _GaugeChild) -> List[str]:
+        try:
+            value = child.get()
+        except Exception:
+            return []
+        return [f'{self.name}{self._label_str(key)} {_format(value)}']
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(
+        self, name: str, help: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS
+    ) -> None:
+        '''
+        @param buckets: Upper bounds of the buckets, in increasing order
+        '''
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+
+    def _new_child(self) -> _HistogramChild:
+        return _HistogramChild(self.buckets)
+
+    def _render_child(self, key: Tuple[str, ...], child: _HistogramChild) -> List[str]:
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, child.counts):
+            cumulative += count
+            labels = self._label_str(key, 'le="' + _format(bound) + '"')
+            lines.append(f'{self.name}_bucket{labels} {cumulative}')
+        labels = self._label_str(key, 'le="+Inf"')
+        lines.append(f'{self.name}_bucket{labels} {child.count}')
+        lines.append(f'{self.name}_sum{self._label_str(key)} {_format(child.sum)}')
+        lines.append(f'{self.name}_count{self._label_str(key)} {child.count}')
+        return lines
+
+
+class Registry:
+    def __init__(self) -> None:
+        self._metrics: Dict[str, Metric] = {}
+
+    def counter(self, name: str, help: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._get(Counter, name, help, labelnames)
+
+    def gauge(self, name: str, help: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self._get(Gauge, name, help, labelnames)
+
+    def histogram(
+        self, name: str, help: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS
+    ) -> Histogram:
+        metric = self._metrics.get(name)
+        if metric is None:
+            metric = self._metrics[name] = Histogram(name, help, labelnames, buckets)
+        return metric
+
+    def render(self) -> str:
+        '''
+        @return: Every metric in the Prometheus text exposition format
+        '''
+        lines: List[str] = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+    def _get(self, cls: type, name: str, help: str, labelnames: Sequence[str]) -> Metric:
+        metric = self._metrics.get(name)
+        if metric is None:
+            metric = self._metrics[name] = cls(name, help, labelnames)
+        return metric
+
+
+REGISTRY = Registry()
+
+LOOP_LAG = REGISTRY.histogram(
+    'keybase_bot_event_loop_lag_seconds', 'Delay of the event loop in running a timer',
+    buckets=(.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1.)
+)
+
+
+async def watch_loop_lag(interval: float = LAG_INTERVAL) -> None:
+    '''
+    Measure how late the event loop wakes a sleeping task up, for ever
+    '''
+    loop = asyncio.get_event_loop()
+    lag = LOOP_LAG.labels()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        lag.observe(max(0., loop.time() - start - interval))
+
+
+async def serve_metrics(
+    listen: str, registry: Registry = REGISTRY, logger: Optional[logging.Logger] = None
+) -> Optional[asyncio.AbstractServer]:
+    '''
+    Serve the metrics on GET /metrics and start the event loop lag probe
+    @param listen: host:port, or the path of a Unix socket (starting with /), empty to disable
+    @param registry: Metrics to serve
+    @param logger: Logger instance
+    @return: The server, None if disabled or if it could not listen
+    '''
+    logger = logger or logging.getLogger(__name__)
+    if not listen:
+        return None
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            request = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), 5.)
+            parts = request.split(b'\r\n', 1)[0].split()
+            if len(parts) >= 2 and parts[0] == b'GET' and parts[1].split(b'?')[0] in (b'/', b'/metrics'):
+                status, body = '200 OK', registry.render().encode()
+            else:
+                status, body = '404 Not Found', b'Not Found\n'
+            writer.write(
+                f'HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode() + body
+            )
+            await writer.drain()
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    try:
+        if listen.startswith('/'):
+            if os.path.exists(listen):
+                os.unlink(listen)
+            server = await asyncio.start_unix_server(handle, listen)
+        else:
+            host, _, port = listen.rpartition(':')
+            server = await asyncio.start_server(handle, host or '127.0.0.1', int(port))
+    except (OSError, ValueError) as e:
+        logger.warning(f"Metrics endpoint disabled, cannot listen on {listen}: {e}")
+        return None
+    asyncio.ensure_future(watch_loop_lag())
+    logger.info(f"Serving metrics on {listen}")
+    return server
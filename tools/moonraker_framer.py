@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+'''
+###############################################################################
+##
+## 88        88 88
+## 88        88 88
+## 88        88 88
+## 88        88 88,dPPYba,   ,adPPYba,   ,adPPYba,
+## 88        88 88P'    "8a a8"     "8a a8P_____88
+## 88        88 88       d8 8b       d8 8PP"""""""
+## Y8a.    .a8P 88b,   ,a8" "8a,   ,a8" "8b,   ,aa
+##  `"Y8888Y"'  `"8Ybbd8"'   `"YbbdP"'   `"Ybbd8"'
+##
+###############################################################################
+Incremental framer for the Moonraker Unix socket stream.
+Moonraker terminates every JSON-RPC frame with an ETX (0x03) byte. Received data
+is appended to a single bytearray and frames are handed out as memoryview
+slices of it, so no intermediate bytes/str copy is made before JSON decoding.
+A frame is released as soon as the iteration moves past it: a view left alive
+would pin the bytearray, and the next feed() would have to copy the buffer.
+orjson is used to decode frames when it is installed (it reads memoryviews
+directly), the standard json module otherwise.
+NotificationFilter drops the notifications nobody handles. With the standard
+json module it reads the method name straight from the raw frame, so they are
+not decoded. orjson decodes a whole frame faster than the regex reads the
+method, so with orjson the method is read from the decoded frame instead.
+'''
+from __future__ import annotations
+import json
+import re
+from collections import Counter
+
+from typing import Any, Dict, FrozenSet, Iterable, Iterator, Optional
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+ETX = 0x03
+SOCKET_LIMIT = 20 * 1024 * 1024
+READ_SIZE = 64 * 1024
+
+
+# Moonraker serializes notifications as {"jsonrpc": "2.0", "method": ..., "params": ...}
+_NOTIFICATION_RE = re.compile(rb'\{\s*(?:"jsonrpc"\s*:\s*"2\.0"\s*,\s*)?"method"\s*:\s*"([^"\\]+)"')
+
+
+class FrameTooLargeError(ValueError):
+    '''Raised when more than max_frame bytes are buffered without an ETX.'''
+
+
+def json_backend() -> str:
+    '''
+    @return: Name of the JSON backend used by decode_frame
+    '''
+    return "orjson" if orjson is not None else "json"
+
+
+def decode_frame(frame: memoryview, use_orjson: bool = True) -> Any:
+    '''
+    Decode a JSON frame
+    @param frame: Frame content without the ETX byte
+    @param use_orjson: Use orjson when it is installed
+    @return: Decoded JSON object
+    '''
+    if use_orjson and orjson is not None:
+        return orjson.loads(frame)
+    # json.loads() does not take memoryviews, this is the only copy made
+    return json.loads(frame.tobytes())
+
+
+class EtxFramer:
+    def __init__(self, max_frame: int = SOCKET_LIMIT, use_orjson: bool = True) -> None:
+        '''
+        @param max_frame: Maximum size of a single frame
+        @param use_orjson: Decode frames with orjson when it is installed
+        '''
+        self.max_frame = max_frame
+        self.use_orjson = use_orjson
+        self._buf = bytearray()
+        # start of the first frame not handed out yet
+        self._start = 0
+        # position from which to look for the next ETX
+        self._scan = 0
+        self._view: Optional[memoryview] = None
+        # times feed() had to copy the buffer because a frame was still referenced
+        self.copies = 0
+
+    def __len__(self) -> int:
+        '''
+        @return: Number of buffered bytes not handed out yet
+        '''
+        return len(self._buf) - self._start
+
+    def feed(self, data: bytes) -> None:
+        '''
+        Append received data to the buffer.
+        @param data: Bytes read from the socket
+        '''
+        self._release()
+        if self._start:
+            try:
+                # front deletion is amortized O(1) for bytearrays
+                del self._buf[:self._start]
+            except BufferError:
+                # a consumer still holds a view of a frame, leave it the old buffer
+                self.copies += 1
+                self._buf = bytearray(self._buf[self._start:])
+            self._scan -= self._start
+            self._start = 0
+        self._buf += data
+        if self._buf.find(ETX, self._scan) < 0 and len(self._buf) > self.max_frame:
+            self._buf = bytearray()
+            self._scan = 0
+            raise FrameTooLargeError(f"Frame larger than {self.max_frame} bytes")
+
+    def __iter__(self) -> Iterator[memoryview]:
+        '''
+        Iterate over the complete frames currently buffered
+        @return: memoryview slices (without the ETX byte), released when the next frame is requested
+        '''
+        buf = self._buf
+        while True:
+            idx = buf.find(ETX, self._scan)
+            if idx < 0:
+                self._scan = len(buf)
+                return
+            if self._view is None:
+                self._view = memoryview(buf)
+            frame = self._view[self._start:idx]
+            self._start = self._scan = idx + 1
+            try:
+                yield frame
+            finally:
+                frame.release()
+
+    def decode(self, frame: memoryview) -> Any:
+        '''
+        Decode a frame returned by the iterator
+        @param frame: Frame content
+        @return: Decoded JSON object
+        '''
+        return decode_frame(frame, self.use_orjson)
+
+    def _release(self) -> None:
+        if self._view is not None:
+            self._view.release()
+            self._view = None
+
+
+class NotificationFilter:
+    def __init__(self, allowlist: Iterable[str], prefilter: Optional[bool] = None) -> None:
+        '''
+        @param allowlist: Notification methods that must be handled
+        @param prefilter: Check the raw frames with accept() rather than the decoded ones with
+            accept_item(), defaults to True when orjson is not installed
+        '''
+        self.allowlist = allowlist
+        self.prefilter = orjson is None if prefilter is None else prefilter
+        # frames per method, responses are counted as "response"
+        self.handled: Counter = Counter()
+        self.dropped: Counter = Counter()
+
+    @property
+    def allowlist(self) -> FrozenSet[str]:
+        return self._methods
+
+    @allowlist.setter
+    def allowlist(self, methods: Iterable[str]) -> None:
+        self._methods = frozenset(methods)
+        self._raw_methods = frozenset(m.encode() for m in self._methods)
+
+    def accept(self, frame: memoryview) -> bool:
+        '''
+        Check a raw frame before decoding it, when prefiltering.
+        Responses and frames that cannot be recognized are always accepted.
+        @param frame: Frame content
+        @return: False if the frame is a notification outside of the allowlist
+        '''
+        if not self.prefilter:
+            return True
+        match = _NOTIFICATION_RE.match(frame)
+        if match is None:
+            self.handled["response"] += 1
+            return True
+        method = match.group(1)
+        if method in self._raw_methods:
+            self.handled[method.decode()] += 1
+            return True
+        self.dropped[method.decode()] += 1
+        return False
+
+    def accept_item(self, item: Any) -> bool:
+        '''
+        Check a decoded frame, when not prefiltering.
+        @param item: Decoded frame
+        @return: False if the frame is a notification outside of the allowlist
+        '''
+        if self.prefilter:
+            return True
+        method = item.get("method") if isinstance(item, dict) else None
+        if method is None:
+            self.handled["response"] += 1
+            return True
+        if method in self._methods:
+            self.handled[method] += 1
+            return True
+        self.dropped[str(method)] += 1
+        return False
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        '''
+        @return: Number of handled and dropped frames per method
+        '''
+        return {'handled' : dict(self.handled), 'dropped' : dict(self.dropped)}
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+'''
+###############################################################################
+##
+## 88        88 88
+## 88        88 88
+## 88        88 88
+## 88        88 88,dPPYba,   ,adPPYba,   ,adPPYba,
+## 88        88 88P'    "8a a8"     "8a a8P_____88
+## 88        88 88       d8 8b       d8 8PP"""""""
+## Y8a.    .a8P 88b,   ,a8" "8a,   ,a8" "8b,   ,aa
+##  `"Y8888Y"'  `"8Ybbd8"'   `"YbbdP"'   `"Ybbd8"'
+##
+###############################################################################
+JSON-RPC client side of the Moonraker Unix socket.
+Every call gets its own request object and a monotonic id, so any number of
+coroutines can use the connection at the same time.
+'''
+from __future__ import annotations
+import asyncio
+import itertools
+import json
+import logging
+import time
+
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+DEFAULT_TIMEOUT = 10.
+
+
+class RpcError(Exception):
+    '''Base class of the RPC transport errors.'''
+
+
+class ConnectionLostError(RpcError):
+    '''Raised when the Moonraker connection is missing or dropped during a call.'''
+
+
+class MoonrakerRpc:
+    def __init__(
+        self, default_timeout: float = DEFAULT_TIMEOUT, logger: Optional[logging.Logger] = None
+    ) -> None:
+        '''
+        @param default_timeout: Timeout (in seconds) applied when a call does not give one
+        @param logger: Logger instance
+        '''
+        self.default_timeout = default_timeout
+        self.logger = logger or logging.getLogger(__name__)
+        self.writer: Optional[asyncio.StreamWriter] = None
+        self.pending_reqs: Dict[int, asyncio.Future] = {}
+        self._ids = itertools.count(1)
+        self._drain_lock: Optional[asyncio.Lock] = None
+        # called with (method, seconds) when a response arrives, to record the latencies
+        self.observe: Optional[Callable[[str, float], None]] = None
+
+    @property
+    def connected(self) -> bool:
+        return self.writer is not None
+
+    def attach(self, writer: asyncio.StreamWriter) -> None:
+        '''
+        Use a freshly opened connection
+        @param writer: Stream writer of the Unix socket
+        '''
+        self.writer = writer
+        self._drain_lock = asyncio.Lock()
+
+    def detach(self, exc: Optional[BaseException] = None) -> None:
+        '''
+        Forget the connection and fail every call still waiting for a response
+        @param exc: Exception given to the pending calls
+        '''
+        self.writer = None
+        pending, self.pending_reqs = self.pending_reqs, {}
+        for fut in pending.values():
+            if not fut.done():
+                fut.set_exception(exc or ConnectionLostError("Moonraker connection lost"))
+
+    def resolve(self, item: Dict[str, Any]) -> bool:
+        '''
+        Hand a response received on the socket to the matching call
+        @param item: Decoded JSON-RPC response
+        @return: True if a pending call was waiting for it
+        '''
+        fut = self.pending_reqs.pop(item.get("id"), None)
+        if fut is None or fut.done():
+            return False
+        fut.set_result(item)
+        return True
+
+    async def call(
+        self, method: str, params: Optional[Dict[str, Any]] = None, timeout: Optional[float] = None
+    ) -> Dict[str, Any]:
+        '''
+        Send a request to Moonraker and wait for its response
+        @param method: JSON-RPC method
+        @param params: Method parameters
+        @param timeout: Timeout in seconds, defaults to default_timeout
+        @return: The JSON-RPC response (with either a "result" or an "error" member)
+        Raises ConnectionLostError or asyncio.TimeoutError.
+        '''
+        return (await self.call_batch([(method, params)], timeout))[0]
+
+    async def call_batch(
+        self, calls: List[Tuple[str, Optional[Dict[str, Any]]]], timeout: Optional[float] = None
+    ) -> List[Dict[str, Any]]:
+        '''
+        Send several requests in a single write and wait for all their responses,
+        the whole batch costs one socket round trip.
+        @param calls: List of (method, params) tuples
+        @param timeout: Timeout in seconds for the whole batch, defaults to default_timeout
+        @return: The JSON-RPC responses, in the order of the calls
+        Raises ConnectionLostError or asyncio.TimeoutError.
+        '''
+        if self.writer is None:
+            raise ConnectionLostError("Moonraker is not connected")
+        loop = asyncio.get_event_loop()
+        observe = self.observe
+        started = time.monotonic()
+        ids: List[int] = []
+        futs: List[asyncio.Future] = []
+        frames: List[bytes] = []
+        for method, params in calls:
+            msg: Dict[str, Any] = {"jsonrpc": "2.0", "method": method, "id": next(self._ids)}
+            if params:
+                msg["params"] = params
+            fut = loop.create_future()
+            if observe is not None:
+                fut.add_done_callback(
+                    lambda f, m=method: f.cancelled() or f.exception() or observe(m, time.monotonic() - started)
+                )
+            self.pending_reqs[msg["id"]] = fut
+            ids.append(msg["id"])
+            futs.append(fut)
+            frames.append(json.dumps(msg).encode() + b"\x03")
+            self.logger.debug("Sending : %s", msg)
+        try:
+            await self._write(b"".join(frames))
+            return await asyncio.wait_for(
+                asyncio.gather(*futs), timeout if timeout is not None else self.default_timeout
+            )
+        finally:
+            for uid in ids:
+                self.pending_reqs.pop(uid, None)
+
+    @staticmethod
+    def prebuild(method: str, params: Optional[Dict[str, Any]] = None) -> bytes:
+        '''
+        Serialize a request once, ahead of time, for call_prebuilt()
+        @param method: JSON-RPC method
+        @param params: Method parameters
+        @return: The request frame up to its id
+        '''
+        msg: Dict[str, Any] = {"jsonrpc": "2.0", "method": method}
+        if params:
+            msg["params"] = params
+        return json.dumps(msg).encode()[:-1] + b', "id": '
+
+    async def call_prebuilt(self, prefix: bytes, timeout: Optional[float] = None) -> Tuple[Dict[str, Any], float]:
+        '''
+        Priority path: write a prebuilt request to the socket before yielding to the event loop.
+        The frame is queued on the transport right away, without waiting for the drain of
+        other writes in progress.
+        @param prefix: Frame returned by prebuild()
+        @param timeout: Timeout in seconds for the response, defaults to default_timeout
+        @return: The JSON-RPC response and the time.monotonic() at which the request was written
+        Raises ConnectionLostError or asyncio.TimeoutError.
+        '''
+        writer = self.writer
+        if writer is None:
+            raise ConnectionLostError("Moonraker is not connected")
+        uid = next(self._ids)
+        fut = asyncio.get_event_loop().create_future()
+        self.pending_reqs[uid] = fut
+        try:
+            writer.write(prefix + str(uid).encode() + b"}\x03")
+        except Exception as e:
+            self.pending_reqs.pop(uid, None)
+            self.detach(ConnectionLostError(f"Moonraker write failed: {e}"))
+            raise ConnectionLostError(f"Moonraker write failed: {e}") from e
+        sent_at = time.monotonic()
+        try:
+            response = await asyncio.wait_for(fut, timeout if timeout is not None else self.default_timeout)
+        finally:
+            self.pending_reqs.pop(uid, None)
+        return response, sent_at
+
+    async def _write(self, data: bytes) -> None:
+        writer = self.writer
+        if writer is None:
+            raise ConnectionLostError("Moonraker is not connected")
+        try:
+            # write() queues the whole frame at once, only drain() must not run concurrently
+            writer.write(data)
+            async with self._drain_lock:
+                await writer.drain()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.detach(ConnectionLostError(f"Moonraker write failed: {e}"))
+            raise ConnectionLostError(f"Moonraker write failed: {e}") from e
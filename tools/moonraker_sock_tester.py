@@ -10,12 +10,18 @@ import sys
 import argparse
 import ast
 import asyncio
+import csv
+import itertools
 import pathlib
 import json
 import logging
+import time
 
 from typing import Any, Dict, List, Optional
 
+from metrics import Histogram
+from moonraker_framer import EtxFramer, FrameTooLargeError, READ_SIZE
+
 SOCKET_LIMIT = 20 * 1024 * 1024
 MENU = [
     "List API Request Presets",
@@ -23,6 +29,27 @@ MENU = [
     "Manual API Entry",
     "Start Notification View",
 ]
+# presets that stop, restart or move the printer, sent by the load test only
+# with --allow-unsafe
+UNSAFE_METHODS = (
+    "printer.emergency_stop",
+    "printer.restart",
+    "printer.firmware_restart",
+    "printer.gcode.script",
+    "printer.print.start",
+    "printer.print.pause",
+    "printer.print.resume",
+    "printer.print.cancel",
+    "machine.reboot",
+    "machine.shutdown",
+    "machine.services.restart",
+    "machine.services.stop",
+)
+# time allowed to the identification of a load test connection
+IDENTIFY_TIMEOUT = 10.
+LATENCY_BUCKETS = (
+    .0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1., 2.5, 5.
+)
 
 class MoonrakerConnection:
     def __init__(
@@ -207,27 +234,40 @@ class MoonrakerConnection:
         self, reader: asyncio.StreamReader
     ) -> None:
         errors_remaining: int = 10
+        framer = EtxFramer(max_frame=SOCKET_LIMIT)
         while not reader.at_eof():
             try:
-                data = await reader.readuntil(b'\x03')
-                decoded = data[:-1].decode(encoding="utf-8")
-                item: Dict[str, Any] = json.loads(decoded)
-            except (ConnectionError, asyncio.IncompleteReadError):
+                data = await reader.read(READ_SIZE)
+                if not data:
+                    break
+                framer.feed(data)
+            except ConnectionError:
                 break
             except asyncio.CancelledError:
                 raise
-            except Exception:
+            except FrameTooLargeError:
                 errors_remaining -= 1
                 if not errors_remaining or not self.connected:
                     break
                 continue
-            errors_remaining = 10
-            if "id" in item:
-                fut = self.pending_reqs.pop(item["id"], None)
-                if fut is not None:
-                    fut.set_result(item)
-            elif self.print_notifications:
-                self._loop.create_task(self.print(f"Notification: {item}\n"))
+            for frame in framer:
+                try:
+                    item: Dict[str, Any] = framer.decode(frame)
+                except Exception:
+                    errors_remaining -= 1
+                    if not errors_remaining or not self.connected:
+                        errors_remaining = 0
+                        break
+                    continue
+                errors_remaining = 10
+                if "id" in item:
+                    fut = self.pending_reqs.pop(item["id"], None)
+                    if fut is not None:
+                        fut.set_result(item)
+                elif self.print_notifications:
+                    self._loop.create_task(self.print(f"Notification: {item}\n"))
+            if not errors_remaining:
+                break
         await self.print("Unix Socket Disconnection from _process_stream()")
         await self.close()
 
@@ -322,6 +362,374 @@ class MoonrakerConnection:
         self.writer.close()
         await self.writer.wait_closed()
 
+class LoadConnection:
+    """
+    Socket of the load test, requests are pipelined: any number of them may
+    be waiting for their response.
+    """
+    def __init__(self, sockpath: pathlib.Path, timeout: float) -> None:
+        self.sockpath = sockpath
+        self.timeout = timeout
+        self.pending_reqs: Dict[int, asyncio.Future[Dict[str, Any]]] = {}
+        self.connected = False
+        # unlike id(msg), the ids are never reused while a request is pending
+        self._ids = itertools.count(1)
+
+    async def connect(self) -> None:
+        reader, self.writer = await asyncio.open_unix_connection(
+            self.sockpath, limit=SOCKET_LIMIT
+        )
+        self.connected = True
+        self._reader_task = asyncio.ensure_future(self._process_stream(reader))
+        await self.request("server.connection.identify", {
+            "client_name": "Unix Socket Load Test",
+            "version": "0.0.1",
+            "type": "other",
+            "url": "https://github.com/Arksine/moontest"
+        }, IDENTIFY_TIMEOUT)
+
+    async def request(
+        self, method: str, params: Optional[Dict[str, Any]] = None,
+        timeout: Optional[float] = None
+    ) -> Dict[str, Any]:
+        if not self.connected:
+            raise ConnectionError("Not connected to Moonraker")
+        message: Dict[str, Any] = {
+            "jsonrpc": "2.0", "method": method, "id": next(self._ids)
+        }
+        if params:
+            message["params"] = params
+        fut = asyncio.get_running_loop().create_future()
+        self.pending_reqs[message["id"]] = fut
+        self.writer.write(json.dumps(message).encode() + b"\x03")
+        try:
+            await self.writer.drain()
+            return await asyncio.wait_for(fut, timeout or self.timeout)
+        finally:
+            self.pending_reqs.pop(message["id"], None)
+
+    async def _process_stream(self, reader: asyncio.StreamReader) -> None:
+        framer = EtxFramer(max_frame=SOCKET_LIMIT)
+        try:
+            while True:
+                data = await reader.read(READ_SIZE)
+                if not data:
+                    break
+                try:
+                    framer.feed(data)
+                except FrameTooLargeError:
+                    continue
+                for frame in framer:
+                    try:
+                        item: Dict[str, Any] = framer.decode(frame)
+                    except Exception:
+                        continue
+                    fut = self.pending_reqs.pop(item.get("id"), None)
+                    if fut is not None and not fut.done():
+                        fut.set_result(item)
+        except ConnectionError:
+            pass
+        finally:
+            self.connected = False
+            for fut in self.pending_reqs.values():
+                if not fut.done():
+                    fut.set_exception(ConnectionError("Moonraker disconnected"))
+
+    async def close(self) -> None:
+        if self.connected:
+            self.connected = False
+            self.writer.close()
+            await self.writer.wait_closed()
+        self._reader_task.cancel()
+
+
+class MethodStats:
+    def __init__(self, histogram: Histogram, method: str) -> None:
+        self.latencies: List[float] = []
+        self.errors = 0
+        self.timeouts = 0
+        self.error_codes: Dict[str, int] = {}
+        self.histogram = histogram.labels(method=method)
+
+    @property
+    def requests(self) -> int:
+        return len(self.latencies) + self.timeouts
+
+    def add(self, latency: float, response: Optional[Dict[str, Any]]) -> None:
+        if response is None:
+            self.timeouts += 1
+            return
+        self.latencies.append(latency)
+        self.histogram.observe(latency)
+        if "error" in response:
+            self.errors += 1
+            code = str(response["error"].get("code", "unknown"))
+            self.error_codes[code] = self.error_codes.get(code, 0) + 1
+
+    def summary(self, elapsed: float) -> Dict[str, Any]:
+        latencies = sorted(self.latencies)
+        failed = self.errors + self.timeouts
+        ret: Dict[str, Any] = {
+            "requests": self.requests,
+            "errors": self.errors,
+            "timeouts": self.timeouts,
+            "error_rate": failed / self.requests if self.requests else 0.,
+            "throughput": self.requests / elapsed if elapsed else 0.,
+            "error_codes": self.error_codes,
+            "latency_ms": {},
+            "histogram": {},
+        }
+        if latencies:
+            def pct(q: float) -> float:
+                idx = min(len(latencies) - 1, int(len(latencies) * q))
+                return latencies[idx] * 1000.
+            ret["latency_ms"] = {
+                "min": latencies[0] * 1000.,
+                "mean": sum(latencies) / len(latencies) * 1000.,
+                "p50": pct(.5),
+                "p90": pct(.9),
+                "p99": pct(.99),
+                "max": latencies[-1] * 1000.,
+            }
+        # cumulative counts, as in the Prometheus exposition format
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS, self.histogram.counts):
+            cumulative += count
+            ret["histogram"][f"{bound * 1000.:g}ms"] = cumulative
+        ret["histogram"]["+Inf"] = len(latencies)
+        return ret
+
+
+class LoadGenerator:
+    """
+    Sends presets round robin over `concurrency` connections, with up to
+    `pipeline` requests in flight on each. With a rate, requests are
+    scheduled at fixed intervals whatever the response times, and latencies
+    are measured from the scheduled time so that requests delayed by a
+    saturated connection are accounted for.
+    """
+    def __init__(
+        self, sockpath: pathlib.Path, presets: List[Dict[str, Any]],
+        concurrency: int = 1, rate: float = 0., pipeline: int = 1,
+        requests: int = 0, duration: float = 10., timeout: float = 5.
+    ) -> None:
+        self.sockpath = sockpath
+        self.presets = presets
+        self.concurrency = concurrency
+        self.rate = rate
+        self.pipeline = pipeline
+        self.requests = requests
+        self.duration = duration
+        self.timeout = timeout
+        self.histogram = Histogram(
+            "moonraker_request_duration_seconds",
+            "Moonraker request latency", ("method",), LATENCY_BUCKETS
+        )
+        self.stats: Dict[str, MethodStats] = {}
+        self.total = MethodStats(self.histogram, "all")
+        self.sent = 0
+        self.disconnects = 0
+
+    async def run(self) -> Dict[str, Any]:
+        self._loop = asyncio.get_running_loop()
+        conns = [
+            LoadConnection(self.sockpath, self.timeout)
+            for _ in range(self.concurrency)
+        ]
+        await asyncio.gather(*[c.connect() for c in conns])
+        started = time.time()
+        self._start = self._next_slot = self._loop.time()
+        try:
+            await asyncio.gather(*[self._worker(c) for c in conns])
+        finally:
+            elapsed = self._loop.time() - self._start
+            await asyncio.gather(*[c.close() for c in conns])
+        return self.report(started, elapsed)
+
+    def report(self, started: float, elapsed: float) -> Dict[str, Any]:
+        ret = {
+            "socket": str(self.sockpath),
+            "started": time.strftime(
+                "%Y-%m-%dT%H:%M:%S%z", time.localtime(started)
+            ),
+            "concurrency": self.concurrency,
+            "pipeline": self.pipeline,
+            "rate": self.rate,
+            "elapsed": elapsed,
+            "disconnects": self.disconnects,
+            "methods": {
+                m: s.summary(elapsed) for m, s in sorted(self.stats.items())
+            },
+        }
+        ret.update(self.total.summary(elapsed))
+        return ret
+
+    def _claim(self) -> Optional[float]:
+        # returns the time at which the next request is due, None once done
+        now = self._loop.time()
+        if self.requests and self.sent >= self.requests:
+            return None
+        if not self.rate:
+            if not self.requests and now - self._start >= self.duration:
+                return None
+            return now
+        slot = self._next_slot
+        if not self.requests and slot - self._start >= self.duration:
+            return None
+        self._next_slot += 1. / self.rate
+        return slot
+
+    async def _worker(self, conn: LoadConnection) -> None:
+        window = asyncio.Semaphore(self.pipeline)
+        tasks: List[asyncio.Future] = []
+        while conn.connected:
+            await window.acquire()
+            due = self._claim()
+            if due is None:
+                window.release()
+                break
+            preset = self.presets[self.sent % len(self.presets)]
+            self.sent += 1
+            delay = due - self._loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.ensure_future(
+                self._send(conn, preset, due, window)
+            ))
+            tasks = [t for t in tasks if not t.done()]
+        else:
+            self.disconnects += 1
+        await asyncio.gather(*tasks)
+
+    async def _send(
+        self, conn: LoadConnection, preset: Dict[str, Any], due: float,
+        window: asyncio.Semaphore
+    ) -> None:
+        method: str = preset["method"]
+        params = preset.get("params")
+        response: Optional[Dict[str, Any]]
+        try:
+            response = await conn.request(
+                method, params if isinstance(params, dict) else None
+            )
+        except asyncio.TimeoutError:
+            response = None
+        except ConnectionError as e:
+            response = {"error": {"code": "disconnected", "message": str(e)}}
+        finally:
+            window.release()
+        latency = self._loop.time() - due
+        stats = self.stats.get(method)
+        if stats is None:
+            stats = self.stats[method] = MethodStats(self.histogram, method)
+        stats.add(latency, response)
+        self.total.add(latency, response)
+
+
+def select_presets(
+    presets: List[Dict[str, Any]], methods: Optional[List[str]],
+    allow_unsafe: bool
+) -> List[Dict[str, Any]]:
+    selected = [p for p in presets if "method" in p]
+    if methods:
+        unknown = set(methods) - set(p["method"] for p in selected)
+        if unknown:
+            raise ValueError(f"No preset for method(s) {', '.join(sorted(unknown))}")
+        selected = [p for p in selected if p["method"] in methods]
+    unsafe = [p["method"] for p in selected if p["method"] in UNSAFE_METHODS]
+    if unsafe and not allow_unsafe:
+        if methods:
+            raise ValueError(
+                f"Method(s) {', '.join(unsafe)} act on the printer, "
+                "pass --allow-unsafe to send them"
+            )
+        selected = [p for p in selected if p["method"] not in UNSAFE_METHODS]
+    if not selected:
+        raise ValueError("No preset to send")
+    return selected
+
+
+CSV_FIELDS = [
+    "method", "requests", "errors", "timeouts", "error_rate", "throughput",
+    "min_ms", "mean_ms", "p50_ms", "p90_ms", "p99_ms", "max_ms"
+]
+
+def write_csv(path: str, report: Dict[str, Any]) -> None:
+    rows = [dict(report["methods"][m], method=m) for m in report["methods"]]
+    rows.append(dict(report, method="all"))
+    buckets = list(rows[-1]["histogram"])
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(CSV_FIELDS + [f"le_{b}" for b in buckets])
+        for row in rows:
+            latency = row["latency_ms"]
+            writer.writerow(
+                [row[k] for k in CSV_FIELDS[:6]]
+                + [latency.get(k[:-3], "") for k in CSV_FIELDS[6:]]
+                + [row["histogram"].get(b, 0) for b in buckets]
+            )
+
+
+def print_report(report: Dict[str, Any]) -> None:
+    width = max([len(m) for m in report["methods"]] + [6])
+    rate = f"{report['rate']:g}/s" if report["rate"] else "unthrottled"
+    print(
+        f"{report['requests']} requests in {report['elapsed']:.2f}s over "
+        f"{report['concurrency']} connection(s), pipeline "
+        f"{report['pipeline']}, rate {rate}: "
+        f"{report['throughput']:.1f} req/s, "
+        f"{report['error_rate'] * 100:.2f}% errors, "
+        f"{report['disconnects']} disconnect(s)"
+    )
+    print(
+        f"{'Method':<{width}} {'count':>7} {'err%':>6} {'req/s':>8} "
+        f"{'p50':>8} {'p90':>8} {'p99':>8} {'max':>8}  (ms)"
+    )
+    rows = list(report["methods"].items()) + [("all", report)]
+    for method, row in rows:
+        latency = row["latency_ms"]
+        cols = "".join(
+            f" {latency[k]:>8.2f}" if k in latency else f" {'-':>8}"
+            for k in ("p50", "p90", "p99", "max")
+        )
+        print(
+            f"{method:<{width}} {row['requests']:>7} "
+            f"{row['error_rate'] * 100:>6.2f} {row['throughput']:>8.1f}{cols}"
+        )
+
+
+def run_load(
+    args: argparse.Namespace, sockpath: pathlib.Path,
+    presets: List[Dict[str, Any]]
+) -> int:
+    if args.concurrency < 1 or args.pipeline < 1:
+        print("Error: concurrency and pipeline must be at least 1")
+        return 1
+    try:
+        presets = select_presets(presets, args.method, args.allow_unsafe)
+    except ValueError as e:
+        print(f"Error: {e}")
+        return 1
+    generator = LoadGenerator(
+        sockpath, presets, concurrency=args.concurrency, rate=args.rate,
+        pipeline=args.pipeline, requests=args.requests,
+        duration=args.duration, timeout=args.timeout
+    )
+    print(f"Load test of Moonraker at {sockpath}")
+    try:
+        report = asyncio.run(generator.run())
+    except (OSError, asyncio.TimeoutError) as e:
+        print(f"Error: unable to connect to Moonraker: {e!r}")
+        return 1
+    print_report(report)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=4)
+    if args.csv:
+        write_csv(args.csv, report)
+    return 0
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
         description="Unix Socket Test Utility")
@@ -334,6 +742,54 @@ if __name__ == "__main__":
         "-p", "--presets", default=None, metavar='<presetfile>',
         help="Path to API Presets Json File"
     )
+    load = parser.add_argument_group(
+        "load test", "Send the presets without the interactive menu"
+    )
+    load.add_argument(
+        "--load", action="store_true",
+        help="Run a load test and report latencies, throughput and errors"
+    )
+    load.add_argument(
+        "-m", "--method", action="append", default=None, metavar='<method>',
+        help="Preset method to send, may be repeated (default: every preset "
+        "that does not act on the printer)"
+    )
+    load.add_argument(
+        "-c", "--concurrency", type=int, default=1, metavar='<count>',
+        help="Connections to Moonraker"
+    )
+    load.add_argument(
+        "-r", "--rate", type=float, default=0., metavar='<req/s>',
+        help="Requests per second over all connections (default: unthrottled)"
+    )
+    load.add_argument(
+        "--pipeline", type=int, default=1, metavar='<count>',
+        help="Requests in flight per connection"
+    )
+    load.add_argument(
+        "-n", "--requests", type=int, default=0, metavar='<count>',
+        help="Requests to send, overrides the duration"
+    )
+    load.add_argument(
+        "-d", "--duration", type=float, default=10., metavar='<seconds>',
+        help="Duration of the test"
+    )
+    load.add_argument(
+        "--timeout", type=float, default=5., metavar='<seconds>',
+        help="Time allowed to a response"
+    )
+    load.add_argument(
+        "--allow-unsafe", action="store_true",
+        help="Allow the presets that stop, restart or move the printer"
+    )
+    load.add_argument(
+        "--json", default=None, metavar='<file>',
+        help="Write the results to a JSON file"
+    )
+    load.add_argument(
+        "--csv", default=None, metavar='<file>',
+        help="Write the per method results to a CSV file"
+    )
     args = parser.parse_args()
     sockpath = pathlib.Path(args.socketfile).expanduser().resolve()
     pfile: Optional[str] = args.presets
@@ -352,6 +808,8 @@ if __name__ == "__main__":
             if not isinstance(presets, list):
                 print(f"Invalid JSON object in preset file {presetpath}")
                 presets = []
+    if args.load:
+        sys.exit(run_load(args, sockpath, presets))
     conn = MoonrakerConnection(sockpath, presets)
     try:
         asyncio.run(conn.run())
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+'''
+###############################################################################
+##
+## 88        88 88
+## 88        88 88
+## 88        88 88
+## 88        88 88,dPPYba,   ,adPPYba,   ,adPPYba,
+## 88        88 88P'    "8a a8"     "8a a8P_____88
+## 88        88 88       d8 8b       d8 8PP"""""""
+## Y8a.    .a8P 88b,   ,a8" "8a,   ,a8" "8b,   ,aa
+##  `"Y8888Y"'  `"8Ybbd8"'   `"YbbdP"'   `"Ybbd8"'
+##
+###############################################################################
+Policy deciding which notifications are sent, per event type:
+- debounce: an event following the previous one of its type by less than this
+  many seconds is held back. Once the type has been quiet for that long, the
+  last event held is released with settle(): a flapping sensor speaks when it
+  starts, then once more when it settles. The released event goes through the
+  other checks like any event, when they refuse it it is dropped.
+- rate_per_minute/burst: token bucket, burst events at most then
+  rate_per_minute on average
+- suppress: seconds during which the events of a type are suppressed after
+  one was sent
+Suppressed events are counted and the count is reported with the next event
+of the same type that gets through, or with the released one.
+'''
+from __future__ import annotations
+import time
+
+from typing import Any, Dict, Optional
+
+RULE_KEYS = ('debounce', 'rate_per_minute', 'burst', 'suppress')
+
+
+class _State:
+    def __init__(self, burst: float, now: float) -> None:
+        self.tokens = burst
+        self.refilled_at = now
+        self.last_event: Optional[float] = None
+        self.last_sent: Optional[float] = None
+        self.pending_suppressed = 0
+        # the last event was suppressed by the debounce and can be released by settle()
+        self.held = False
+        self.passed = 0
+        self.suppressed = 0
+        # held events never released because the other checks refused them
+        self.held_dropped = 0
+
+
+class NotificationPolicy:
+    def __init__(self, rules: Dict[str, Dict[str, float]]) -> None:
+        '''
+        @param rules: Rule of each event type, {type: {debounce, rate_per_minute, burst, suppress}},
+                      any missing setting (or 0) disables that check. Types without a rule always pass.
+        '''
+        for kind, rule in rules.items():
+            unknown = set(rule) - set(RULE_KEYS)
+            if unknown:
+                raise ValueError(f"Unknown notification policy settings for {kind}: {', '.join(sorted(unknown))}")
+        self.rules = rules
+        self._states: Dict[str, _State] = {}
+
+    def check(self, kind: str, now: Optional[float] = None) -> Optional[int]:
+        '''
+        Decide whether an event is sent
+        @param kind: Event type
+        @param now: time.monotonic() of the event
+        @return: None if the event is suppressed, otherwise the number of events of its type suppressed since the last one sent
+        '''
+        rule = self.rules.get(kind)
+        if not rule:
+            return 0
+        now = time.monotonic() if now is None else now
+        state = self._states.get(kind)
+        if state is None:
+            state = self._states[kind] = _State(float(rule.get('burst') or 1), now)
+        previous, state.last_event = state.last_event, now
+        debounce = rule.get('debounce') or 0
+        was_held = state.held
+        state.held = bool(debounce) and previous is not None and now - previous < debounce
+        if state.held or self._suppressed(rule, state, now):
+            if was_held and not state.held:
+                state.held_dropped += 1
+            state.pending_suppressed += 1
+            state.suppressed += 1
+            return None
+        state.last_sent = now
+        state.passed += 1
+        count, state.pending_suppressed = state.pending_suppressed, 0
+        return count
+
+    def held_for(self, kind: str, now: Optional[float] = None) -> Optional[float]:
+        '''
+        @param kind: Event type
+        @param now: time.monotonic()
+        @return: Seconds until the event held back by the debounce can be released (0 once it can),
+                 None if no event is held
+        '''
+        state = self._states.get(kind)
+        rule = self.rules.get(kind)
+        if state is None or not state.held or not rule:
+            return None
+        now = time.monotonic() if now is None else now
+        return max(0., state.last_event + (rule.get('debounce') or 0) - now)
+
+    def settle(self, kind: str, now: Optional[float] = None) -> Optional[int]:
+        '''
+        Release the event held back by the debounce once its type has been quiet long enough,
+        if the rate limit and the suppression window let it through
+        @param kind: Event type
+        @param now: time.monotonic()
+        @return: None if no event is released, otherwise the number of the other events
+                 of its type suppressed since the last one sent
+        '''
+        now = time.monotonic() if now is None else now
+        if self.held_for(kind, now) != 0:
+            return None
+        state = self._states[kind]
+        state.held = False
+        if self._suppressed(self.rules[kind], state, now):
+            state.held_dropped += 1
+            return None
+        state.last_sent = now
+        state.passed += 1
+        state.suppressed -= 1
+        count, state.pending_suppressed = state.pending_suppressed - 1, 0
+        return count
+
+    def stats(self) -> Dict[str, Any]:
+        '''
+        @return: Sent, suppressed and dropped held events per type
+        '''
+        return {
+            kind : {'passed' : s.passed, 'suppressed' : s.suppressed, 'held_dropped' : s.held_dropped}
+            for kind, s in self._states.items()
+        }
+
+    @staticmethod
+    def _suppressed(rule: Dict[str, float], state: _State, now: float) -> bool:
+        suppress = rule.get('suppress') or 0
+        if suppress and state.last_sent is not None and now - state.last_sent < suppress:
+            return True
+        rate = rule.get('rate_per_minute') or 0
+        if rate:
+            burst = float(rule.get('burst') or 1)
+            state.tokens = min(burst, state.tokens + (now - state.refilled_at) * rate / 60.)
+            state.refilled_at = now
+            if state.tokens < 1:
+                return True
+            state.tokens -= 1
+        return False
@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+'''
+###############################################################################
+##
+## 88        88 88
+## 88        88 88
+## 88        88 88
+## 88        88 88,dPPYba,   ,adPPYba,   ,adPPYba,
+## 88        88 88P'    "8a a8"     "8a a8P_____88
+## 88        88 88       d8 8b       d8 8PP"""""""
+## Y8a.    .a8P 88b,   ,a8" "8a,   ,a8" "8b,   ,aa
+##  `"Y8888Y"'  `"8Ybbd8"'   `"YbbdP"'   `"Ybbd8"'
+##
+###############################################################################
+Outbound queue of the Keybase notifications.
+Notifications are delivered in order by a single worker, delivery errors are
+logged instead of being lost in a bare task. The first event of a kind is sent
+right away, the events of the same kind that follow it within the digest
+window are collapsed into a single digest message sent when the window ends.
+'''
+from __future__ import annotations
+import asyncio
+import logging
+import random
+import time
+from collections import deque
+
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional
+
+MAX_PENDING = 32
+# lines of a digest message, the others are only counted
+DIGEST_LINES = 5
+
+
+class Notification:
+    def __init__(self, kind: str, message: str, context: Dict[str, Any]) -> None:
+        '''
+        @param kind: Event type, events of the same kind are collapsed together
+        @param message: Message text
+        @param context: Data needed to deliver the notification (channels, attachments...)
+        '''
+        self.kind = kind
+        self.messages: List[str] = [message]
+        self.context = context
+        self.count = 1
+        self.created_at = time.monotonic()
+
+    def merge(self, message: str, context: Dict[str, Any]) -> None:
+        '''
+        Add an event to the digest, its context replaces the previous one
+        '''
+        self.count += 1
+        if len(self.messages) < DIGEST_LINES:
+            self.messages.append(message)
+        self.context = context
+
+    @property
+    def text(self) -> str:
+        if self.count == 1:
+            return self.messages[0]
+        text = f"{self.count} `{self.kind}` events:\n" + "\n".join(self.messages)
+        if self.count > len(self.messages):
+            text += f"\n... and {self.count - len(self.messages)} more"
+        return text
+
+
+class _Window:
+    def __init__(self, end: float) -> None:
+        self.end = end
+        self.digest: Optional[Notification] = None
+
+
+class NotificationQueue:
+    def __init__(
+        self, deliver: Callable[[Notification], Awaitable[bool]], window: float = 0., max_pending: int = MAX_PENDING,
+        max_attempts: int = 4, retry_delay: float = 1., max_retry_delay: float = 30.,
+        logger: Optional[logging.Logger] = None
+    ) -> None:
+        '''
+        @param deliver: Coroutine function sending a notification, returns False if it could not be sent
+        @param window: Digest window in seconds, 0 sends every event on its own
+        @param max_pending: Maximum number of notifications waiting, the oldest one is dropped beyond it
+        @param max_attempts: Attempts of a send before giving up (see retry)
+        @param retry_delay: Delay before the first retry, doubled at each attempt
+        @param max_retry_delay: Maximum delay between two attempts
+        @param logger: Logger instance
+        '''
+        self.deliver = deliver
+        self.window = window
+        self.max_pending = max_pending
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.logger = logger or logging.getLogger(__name__)
+        self._queue: Deque[Notification] = deque()
+        self._windows: Dict[str, _Window] = {}
+        self._wakeup = asyncio.Event()
+        self._worker: Optional[asyncio.Future] = None
+        self._busy = False
+        self.stats_counters: Dict[str, Any] = {
+            'submitted' : 0, 'collapsed' : 0, 'delivered' : 0, 'failed' : 0, 'retries' : 0, 'dropped' : 0,
+            'last_latency' : 0., 'max_latency' : 0.,
+        }
+
+    def submit(self, kind: str, message: str, **context: Any) -> None:
+        '''
+        Queue a notification, or add it to the digest of its kind
+        @param kind: Event type
+        @param message: Message text
+        @param context: Data handed to deliver() with the notification
+        '''
+        self.stats_counters['submitted'] += 1
+        if self.window <= 0:
+            self._enqueue(Notification(kind, message, context))
+            return
+        now = time.monotonic()
+        window = self._windows.get(kind)
+        if window is None or now >= window.end:
+            # first event of a burst, sent right away
+            self._windows[kind] = _Window(now + self.window)
+            self._enqueue(Notification(kind, message, context))
+            return
+        self.stats_counters['collapsed'] += 1
+        if window.digest is None:
+            window.digest = Notification(kind, message, context)
+            asyncio.get_event_loop().call_later(window.end - now, self._close_window, kind)
+        else:
+            window.digest.merge(message, context)
+
+    async def retry(self, what: str, send: Callable[[], Awaitable[Any]]) -> bool:
+        '''
+        Run a send, retrying it with a jittered exponential backoff
+        @param what: Description used in the logs (e.g. the channel)
+        @param send: Coroutine function doing the send
+        @return: False if every attempt failed
+        '''
+        for attempt in range(self.max_attempts):
+            try:
+                await send()
+                return True
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                if attempt + 1 >= self.max_attempts:
+                    self.logger.error(f"Could not send {what} after {self.max_attempts} attempts: {e!r}")
+                    return False
+                delay = min(self.max_retry_delay, self.retry_delay * 2 ** attempt) * random.uniform(0.5, 1.)
+                self.stats_counters['retries'] += 1
+                self.logger.warning(f"Sending {what} failed ({e!r}), retrying in {delay:.1f}s")
+                await asyncio.sleep(delay)
+        return False
+
+    def stats(self) -> Dict[str, Any]:
+        '''
+        @return: Queue depth and delivery counters, latencies in seconds from submission to delivery
+        '''
+        stats = dict(self.stats_counters)
+        stats['depth'] = len(self._queue) + self._busy
+        stats['open_digests'] = sum(1 for w in self._windows.values() if w.digest is not None)
+        return stats
+
+    def _close_window(self, kind: str) -> None:
+        window = self._windows.get(kind)
+        if window is None or window.digest is None:
+            return
+        self._enqueue(window.digest)
+        # the burst may go on, keep collecting its events for another window
+        self._windows[kind] = _Window(time.monotonic() + self.window)
+
+    def _enqueue(self, notification: Notification) -> None:
+        if len(self._queue) >= self.max_pending:
+            dropped = self._queue.popleft()
+            self.stats_counters['dropped'] += 1
+            self.logger.warning(f"Notification queue full, dropping: {dropped.text}")
+        self._queue.append(notification)
+        self._wakeup.set()
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.ensure_future(self._run())
+
+    async def _run(self) -> None:
+        while True:
+            while not self._queue:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+            notification = self._queue.popleft()
+            self._busy = True
+            try:
+                delivered = await self.deliver(notification)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                delivered = False
+                self.logger.error(f"Could not deliver notification {notification.text!r}: {e!r}")
+            finally:
+                self._busy = False
+            if not delivered:
+                self.stats_counters['failed'] += 1
+            else:
+                self.stats_counters['delivered'] += 1
+                latency = time.monotonic() - notification.created_at
+                self.stats_counters['last_latency'] = round(latency, 3)
+                self.stats_counters['max_latency'] = round(max(self.stats_counters['max_latency'], latency), 3)
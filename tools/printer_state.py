@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+'''
+###############################################################################
+##
+## 88        88 88
+## 88        88 88
+## 88        88 88
+## 88        88 88,dPPYba,   ,adPPYba,   ,adPPYba,
+## 88        88 88P'    "8a a8"     "8a a8P_____88
+## 88        88 88       d8 8b       d8 8PP"""""""
+## Y8a.    .a8P 88b,   ,a8" "8a,   ,a8" "8b,   ,aa
+##  `"Y8888Y"'  `"8Ybbd8"'   `"YbbdP"'   `"Ybbd8"'
+##
+###############################################################################
+Local model of the printer state, kept up to date from the
+`printer.objects.subscribe` response and the `notify_status_update` deltas
+pushed by Moonraker.
+'''
+from __future__ import annotations
+import copy
+
+from typing import Any, Dict, List, Optional, Tuple
+
+# printer objects the bot subscribes to
+STATUS_OBJECTS: Dict[str, Any] = {'print_stats' : None, 'display_status' : None}
+
+
+def _merge(target: Dict[str, Any], delta: Dict[str, Any]) -> None:
+    '''
+    Recursively merge a status delta into the target dict
+    '''
+    for key, value in delta.items():
+        if isinstance(value, dict) and isinstance(target.get(key), dict):
+            _merge(target[key], value)
+        else:
+            target[key] = copy.deepcopy(value) if isinstance(value, (dict, list)) else value
+
+
+class PrinterState:
+    def __init__(self) -> None:
+        '''
+        The state is only "ready" once a full subscription snapshot was loaded.
+        Deltas received while a subscription is pending are kept aside and
+        replayed on top of the snapshot so that no update is lost or reordered.
+        '''
+        self.objects: Dict[str, Dict[str, Any]] = {}
+        self.eventtime: float = 0.
+        self.ready: bool = False
+        # filament (spoolman) information, None when it must be fetched again
+        self.filament: Optional[Dict[str, Any]] = None
+        self._syncing: bool = False
+        self._backlog: List[Tuple[Dict[str, Any], float]] = []
+
+    def begin_sync(self) -> None:
+        '''
+        Called right before sending printer.objects.subscribe
+        '''
+        self._syncing = True
+        self._backlog = []
+
+    def load(self, status: Dict[str, Any], eventtime: float) -> None:
+        '''
+        Load the full snapshot returned by printer.objects.subscribe
+        @param status: result.status of the subscribe response
+        @param eventtime: result.eventtime of the subscribe response
+        '''
+        self.objects = {}
+        _merge(self.objects, status)
+        self.eventtime = eventtime
+        for delta, delta_time in self._backlog:
+            if delta_time >= eventtime:
+                self._apply(delta, delta_time)
+        self._backlog = []
+        self._syncing = False
+        self.ready = True
+
+    def apply_update(self, params: List[Any]) -> None:
+        '''
+        Apply the params of a notify_status_update notification
+        @param params: [status_delta, eventtime]
+        '''
+        if not params or not isinstance(params[0], dict):
+            return
+        delta = params[0]
+        eventtime = params[1] if len(params) > 1 and isinstance(params[1], (int, float)) else self.eventtime
+        if self._syncing:
+            self._backlog.append((delta, eventtime))
+        elif self.ready:
+            self._apply(delta, eventtime)
+
+    def reset(self) -> None:
+        '''
+        Forget the printer state (Klippy or Moonraker went away)
+        '''
+        self.objects = {}
+        self.ready = False
+        self._syncing = False
+        self._backlog = []
+
+    def get(self, obj: str) -> Dict[str, Any]:
+        '''
+        @param obj: Printer object name (e.g. print_stats)
+        @return: Current fields of that object (empty if unknown)
+        '''
+        return self.objects.get(obj, {})
+
+    def _apply(self, delta: Dict[str, Any], eventtime: float) -> None:
+        _merge(self.objects, delta)
+        self.eventtime = max(self.eventtime, eventtime)
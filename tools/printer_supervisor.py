@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+'''
+###############################################################################
+##
+## 88        88 88
+## 88        88 88
+## 88        88 88
+## 88        88 88,dPPYba,   ,adPPYba,   ,adPPYba,
+## 88        88 88P'    "8a a8"     "8a a8P_____88
+## 88        88 88       d8 8b       d8 8PP"""""""
+## Y8a.    .a8P 88b,   ,a8" "8a,   ,a8" "8b,   ,aa
+##  `"Y8888Y"'  `"8Ybbd8"'   `"YbbdP"'   `"Ybbd8"'
+##
+###############################################################################
+Several printers served by a single process.
+Every printer keeps its own Moonraker connection, camera settings and keybase
+channel, they all run on one asyncio loop and share one Keybase session. Chat
+events are routed by channel: a printer channel reaches its printer, the
+printfarm channel reaches all of them.
+'''
+from __future__ import annotations
+import asyncio
+import json
+import logging
+import os
+import signal
+import sys
+
+import pykeybasebot.types.chat1 as chat1
+
+from KeybaseBot import KeybaseBot, PRINTFARM_CHANNEL, create_bot, listen_options
+from config_store import CONFIG
+from metrics import serve_metrics
+from typing import Any, Dict, List
+
+this_dir = os.path.dirname(os.path.abspath(__file__))
+
+
+def load_printers(path: str) -> List[Dict[str, Any]]:
+    '''
+    Read the printers file, a JSON list of
+    {"name": ..., "sockpath": ..., "camera_config": ... (optional), "http_host": ... (optional),
+     "cache_dir": ... (optional)}
+    @param path: Printers file
+    @return: Printer configurations
+    '''
+    with open(path, 'r') as file:
+        printers = json.load(file)
+    if not isinstance(printers, list) or not printers:
+        raise ValueError(f"{path} must hold a non empty list of printers")
+    names = set()
+    for printer in printers:
+        if not printer.get('name') or not printer.get('sockpath'):
+            raise ValueError(f"Printer {printer} needs a name and a sockpath")
+        if printer['name'] == PRINTFARM_CHANNEL or printer['name'] in names:
+            raise ValueError(f"Printer name {printer['name']} is reserved or used twice")
+        names.add(printer['name'])
+    return printers
+
+
+class PrinterSupervisor:
+    def __init__(
+        self, printers: List[Dict[str, Any]], presets: List[Dict[str, Any]], paperkey: str, logger: logging.Logger
+    ) -> None:
+        '''
+        @param printers: Printer configurations (see load_printers)
+        @param presets: List of API presets to send to Moonraker
+        @param paperkey: Path of the Keybase paperkey file
+        @param logger: Logger instance
+        '''
+        self.logger = logger
+        self.bot = create_bot(paperkey, self, logger)
+        self.printers: Dict[str, KeybaseBot] = {}
+        for printer in printers:
+            name = printer['name']
+            self.printers[name] = KeybaseBot(
+                sockpath=printer['sockpath'],
+                presets=presets,
+                paperkey=None,
+                logger=logger.getChild(name),
+                bot=self.bot,
+                name=name,
+                camera_config=printer.get('camera_config') or os.path.join(this_dir, '..', 'config', f'camera_{name}.json'),
+                http_host=printer.get('http_host'),
+                cache_dir=printer.get('cache_dir'),
+            )
+        self.listen_options = listen_options(list(self.printers))
+
+    async def __call__(self, bot, chat_event: chat1.Message) -> None:
+        '''
+        Handler for the shared keybase bot, hands the chat event to the printers of its channel
+        @param bot: Keybase bot instance
+        @param chat_event: Keybase chat event
+        '''
+        topic = chat_event.msg.channel.topic_name
+        if topic == PRINTFARM_CHANNEL:
+            targets = list(self.printers.values())
+        elif topic in self.printers:
+            targets = [self.printers[topic]]
+        else:
+            self.logger.debug(f"Ignoring message from channel {topic}")
+            return
+        results = await asyncio.gather(*(printer(bot, chat_event) for printer in targets), return_exceptions=True)
+        for printer, result in zip(targets, results):
+            if isinstance(result, Exception):
+                self.logger.error(f"Printer {printer.name} failed to handle a message: {result!r}")
+
+    async def run_bot(self) -> None:
+        '''
+        Start the shared keybase bot
+        '''
+        try:
+            await self.bot.ensure_initialized()
+        except Exception as e:
+            self.logger.error(f"Error: {e}")
+            sys.exit(1)
+        for printer in self.printers.values():
+            printer.mark_startup('keybase_ready')
+            printer.keybase_ready.set()
+        await self.bot.start(listen_options=self.listen_options)
+
+    def run(self) -> None:
+        '''
+        Main loop: the keybase bot and every Moonraker connection
+        '''
+        loop = asyncio.get_event_loop()
+        # a single endpoint serves the metrics of every printer
+        listen = next(iter(self.printers.values())).service_config.metrics_listen
+        loop.create_task(serve_metrics(listen, logger=self.logger))
+        CONFIG.watch()
+        loop.create_task(self.run_bot())
+        for printer in self.printers.values():
+            loop.create_task(printer.run_moonraker())
+        loop.add_signal_handler(signal.SIGTERM, loop.stop)
+        try:
+            loop.run_forever()
+        finally:
+            for printer in self.printers.values():
+                printer.shutdown()
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+'''
+###############################################################################
+##
+## 88        88 88
+## 88        88 88
+## 88        88 88
+## 88        88 88,dPPYba,   ,adPPYba,   ,adPPYba,
+## 88        88 88P'    "8a a8"     "8a a8P_____88
+## 88        88 88       d8 8b       d8 8PP"""""""
+## Y8a.    .a8P 88b,   ,a8" "8a,   ,a8" "8b,   ,aa
+##  `"Y8888Y"'  `"8Ybbd8"'   `"YbbdP"'   `"Ybbd8"'
+##
+###############################################################################
+In-memory cache of the processed camera snapshots.
+A snapshot younger than max_age is served from memory, concurrent requests for
+the same camera share a single fetch and the total size is capped with LRU
+eviction. A fetch running when the cache is invalidated (e.g. the camera
+rotation changed) is not stored and not shared with the later requests.
+'''
+from __future__ import annotations
+import asyncio
+import time
+from collections import OrderedDict
+
+from typing import Any, Awaitable, Callable, Dict, Hashable, Tuple
+
+
+class SnapshotCache:
+    def __init__(self, max_age: float = 2., max_bytes: int = 8 * 1024 * 1024) -> None:
+        '''
+        @param max_age: Maximum age (in seconds) of a snapshot served from memory, 0 disables caching
+        @param max_bytes: Maximum total size of the cached snapshots
+        '''
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self._entries: OrderedDict[Hashable, Tuple[bytes, float]] = OrderedDict()
+        self._inflight: Dict[Hashable, asyncio.Future] = {}
+        self._size = 0
+        # bumped by invalidate(), fetches started before are not stored
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+
+    async def get(self, key: Hashable, fetch: Callable[[], Awaitable[bytes]]) -> bytes:
+        '''
+        Get a snapshot, fetching it only if there is no fresh copy
+        @param key: Camera id
+        @param fetch: Coroutine function downloading/processing the snapshot
+        @return: Snapshot data
+        Fetch errors are raised to every waiting caller and are not cached.
+        '''
+        entry = self._entries.get(key)
+        if entry is not None and time.monotonic() - entry[1] < self.max_age:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+        fut = self._inflight.get(key)
+        if fut is not None:
+            self.coalesced += 1
+        else:
+            self.misses += 1
+            fut = asyncio.ensure_future(self._fetch(key, fetch))
+            # the error is retrieved here in case every caller gave up already
+            fut.add_done_callback(lambda f: f.cancelled() or f.exception())
+            self._inflight[key] = fut
+        # a caller giving up (timeout) must not cancel the fetch shared with the others
+        return await asyncio.shield(fut)
+
+    def invalidate(self, key: Hashable = None) -> None:
+        '''
+        Drop one cached snapshot, or all of them if no key is given
+        '''
+        self._generation += 1
+        keys = list(self._entries) if key is None else [key]
+        for k in keys:
+            self._drop(k)
+        # later requests start a new fetch rather than wait for the stale one
+        for k in list(self._inflight) if key is None else [key]:
+            self._inflight.pop(k, None)
+
+    def stats(self) -> Dict[str, Any]:
+        '''
+        @return: Cache counters
+        '''
+        return {
+            'hits' : self.hits,
+            'misses' : self.misses,
+            'coalesced' : self.coalesced,
+            'evictions' : self.evictions,
+            'entries' : len(self._entries),
+            'bytes' : self._size,
+        }
+
+    async def _fetch(self, key: Hashable, fetch: Callable[[], Awaitable[bytes]]) -> bytes:
+        generation = self._generation
+        task = asyncio.current_task()
+        try:
+            data = await fetch()
+        finally:
+            if self._inflight.get(key) is task:
+                del self._inflight[key]
+        if self.max_age > 0 and generation == self._generation:
+            self._store(key, data)
+        return data
+
+    def _drop(self, key: Hashable) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._size -= len(entry[0])
+
+    def _store(self, key: Hashable, data: bytes) -> None:
+        self._drop(key)
+        if len(data) > self.max_bytes:
+            return
+        self._entries[key] = (data, time.monotonic())
+        self._size += len(data)
+        while self._size > self.max_bytes:
+            _, (old, _) = self._entries.popitem(last=False)
+            self._size -= len(old)
+            self.evictions += 1
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+'''
+###############################################################################
+##
+## 88        88 88
+## 88        88 88
+## 88        88 88
+## 88        88 88,dPPYba,   ,adPPYba,   ,adPPYba,
+## 88        88 88P'    "8a a8"     "8a a8P_____88
+## 88        88 88       d8 8b       d8 8PP"""""""
+## Y8a.    .a8P 88b,   ,a8" "8a,   ,a8" "8b,   ,aa
+##  `"Y8888Y"'  `"8Ybbd8"'   `"YbbdP"'   `"Ybbd8"'
+##
+###############################################################################
+In-memory post-processing of webcam snapshots (rotation, downscaling and JPEG
+re-encoding). These functions are CPU bound and meant to run in a worker pool,
+Pillow releases the GIL while decoding and encoding.
+'''
+from __future__ import annotations
+import io
+
+from typing import Optional
+
+JPEG_QUALITY = 85
+
+# rotations that do not need resampling (PIL.Image.Transpose members)
+_TRANSPOSE = {
+    90 : 'ROTATE_90',
+    180 : 'ROTATE_180',
+    270 : 'ROTATE_270',
+}
+
+
+def needs_processing(rotate: int = 0, max_size: Optional[int] = None) -> bool:
+    '''
+    @return: False if the downloaded image can be used as is
+    '''
+    return bool(rotate % 360) or bool(max_size)
+
+
+def process_snapshot(data: bytes, rotate: int = 0, max_size: Optional[int] = None) -> bytes:
+    '''
+    Rotate, downscale and re-encode a snapshot
+    @param data: Downloaded image
+    @param rotate: Counter clockwise rotation in degrees
+    @param max_size: Maximum width/height in pixels, the aspect ratio is kept
+    @return: JPEG encoded image
+    '''
+    if not needs_processing(rotate, max_size):
+        return data
+    # PIL is only loaded once a camera needs processing, it is not part of the bot startup
+    from PIL import Image
+    img = Image.open(io.BytesIO(data))
+    if max_size:
+        # draft() lets the JPEG decoder downscale while decoding
+        img.draft('RGB', (max_size, max_size))
+        img.thumbnail((max_size, max_size))
+    rotate %= 360
+    if rotate in _TRANSPOSE:
+        img = img.transpose(getattr(Image.Transpose, _TRANSPOSE[rotate]))
+    elif rotate:
+        img = img.rotate(rotate)
+    if img.mode not in ('RGB', 'L'):
+        img = img.convert('RGB')
+    out = io.BytesIO()
+    img.save(out, format='JPEG', quality=JPEG_QUALITY)
+    return out.getvalue()
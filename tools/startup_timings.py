@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+'''
+###############################################################################
+##
+## 88        88 88
+## 88        88 88
+## 88        88 88
+## 88        88 88,dPPYba,   ,adPPYba,   ,adPPYba,
+## 88        88 88P'    "8a a8"     "8a a8P_____88
+## 88        88 88       d8 8b       d8 8PP"""""""
+## Y8a.    .a8P 88b,   ,a8" "8a,   ,a8" "8b,   ,aa
+##  `"Y8888Y"'  `"8Ybbd8"'   `"YbbdP"'   `"Ybbd8"'
+##
+###############################################################################
+Startup timings of the bot.
+Each phase (imports, logging, keybase_ready, moonraker_connected, ...) is
+recorded once, in seconds since this module was imported, which is the first
+thing the main program does. STARTUP is shared by every printer of the
+process, the first one reaching a phase records it.
+'''
+from __future__ import annotations
+import time
+
+from typing import Dict, Optional
+
+_START = time.monotonic()
+
+
+class StartupTimings:
+    def __init__(self, start: Optional[float] = None) -> None:
+        '''
+        @param start: time.monotonic() of the start, defaults to the import of this module
+        '''
+        self.start = _START if start is None else start
+        self.phases: Dict[str, float] = {}
+
+    def mark(self, phase: str) -> float:
+        '''
+        Record the end of a phase, only its first occurrence is kept
+        @param phase: Phase name
+        @return: Seconds since the start at which the phase was first reached
+        '''
+        if phase not in self.phases:
+            self.phases[phase] = round(time.monotonic() - self.start, 3)
+        return self.phases[phase]
+
+    def __str__(self) -> str:
+        return ", ".join(f"{phase}={seconds:.3f}s" for phase, seconds in self.phases.items())
+
+
+STARTUP = StartupTimings()
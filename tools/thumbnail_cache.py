@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+'''
+###############################################################################
+##
+## 88        88 88
+## 88        88 88
+## 88        88 88
+## 88        88 88,dPPYba,   ,adPPYba,   ,adPPYba,
+## 88        88 88P'    "8a a8"     "8a a8P_____88
+## 88        88 88       d8 8b       d8 8PP"""""""
+## Y8a.    .a8P 88b,   ,a8" "8a,   ,a8" "8b,   ,aa
+##  `"Y8888Y"'  `"8Ybbd8"'   `"YbbdP"'   `"Ybbd8"'
+##
+###############################################################################
+Gcode thumbnails sent with the print notifications.
+Only one size variant per job is sent, so only that one is downloaded. It is
+cached by gcode file (uuid/modified): a reprint of the same file is served from
+memory or from the disk cache, which is capped in size with LRU eviction.
+The disk cache is indexed on first use and its files are read, written and
+removed in the default executor, never on the event loop.
+'''
+from __future__ import annotations
+import asyncio
+import hashlib
+import logging
+import os
+from collections import OrderedDict
+
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+# largest width sent to the chat, bigger variants are only used when there is no smaller one
+MAX_WIDTH = 512
+# thumbnails kept in memory on top of the disk cache
+MEMORY_ENTRIES = 8
+
+
+def select_thumbnail(thumbnails: List[Dict[str, Any]], max_width: int = MAX_WIDTH) -> Optional[Dict[str, Any]]:
+    '''
+    Pick the size variant to send
+    @param thumbnails: Thumbnails list from the job metadata
+    @param max_width: Maximum width in pixels
+    @return: The largest variant not wider than max_width, the smallest one if they all are, None if there is none
+    '''
+    variants = [t for t in thumbnails or [] if t.get('relative_path')]
+    if not variants:
+        return None
+    variants.sort(key=lambda t: (t.get('width') or 0) * (t.get('height') or 0))
+    fitting = [t for t in variants if (t.get('width') or 0) <= max_width]
+    return fitting[-1] if fitting else variants[0]
+
+
+def thumbnail_key(filename: str, metadata: Dict[str, Any], thumbnail: Dict[str, Any]) -> str:
+    '''
+    @return: Cache key of a thumbnail, it changes whenever the gcode file is sliced again
+    '''
+    ident = f"{metadata.get('uuid') or filename}|{metadata.get('modified')}|{thumbnail['relative_path']}"
+    return hashlib.sha1(ident.encode()).hexdigest()
+
+
+def _list_files(cache_dir: str) -> List[Tuple[str, int]]:
+    '''
+    @return: Keys and sizes of the cached files, oldest first
+    '''
+    os.makedirs(cache_dir, exist_ok=True)
+    files = []
+    for entry in os.scandir(cache_dir):
+        if entry.is_file() and entry.name.endswith('.png'):
+            stat = entry.stat()
+            files.append((stat.st_mtime, entry.name[:-len('.png')], stat.st_size))
+    return [(key, size) for _, key, size in sorted(files)]
+
+
+def _read_file(path: str) -> bytes:
+    with open(path, 'rb') as f:
+        data = f.read()
+    # keep the LRU order across restarts
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+    return data
+
+
+def _write_file(path: str, data: bytes) -> None:
+    with open(path + '.part', 'wb') as f:
+        f.write(data)
+    os.replace(path + '.part', path)
+
+
+class ThumbnailCache:
+    def __init__(
+        self, cache_dir: str, max_bytes: int = 16 * 1024 * 1024,
+        memory_entries: int = MEMORY_ENTRIES, logger: Optional[logging.Logger] = None
+    ) -> None:
+        '''
+        @param cache_dir: Directory of the disk cache
+        @param max_bytes: Maximum total size of the disk cache, 0 disables it
+        @param memory_entries: Number of thumbnails also kept in memory
+        @param logger: Logger instance
+        '''
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.memory_entries = memory_entries
+        self.logger = logger or logging.getLogger(__name__)
+        self._memory: OrderedDict[str, bytes] = OrderedDict()
+        # files of the disk cache (key -> size), least recently used first
+        self._files: OrderedDict[str, int] = OrderedDict()
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._indexed: Optional[asyncio.Future] = None
+        self._size = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    async def get(self, key: str, fetch: Callable[[], Awaitable[Optional[bytes]]]) -> Optional[bytes]:
+        '''
+        Get a thumbnail, downloading it only if it is not cached
+        @param key: Key returned by thumbnail_key()
+        @param fetch: Coroutine function downloading the thumbnail, returns None on failure
+        @return: Thumbnail data, None if it could not be retrieved (failures are not cached)
+        '''
+        data = self._memory.get(key)
+        if data is not None:
+            self._memory.move_to_end(key)
+            self._touch(key)
+            self.memory_hits += 1
+            return data
+        if self.max_bytes > 0:
+            if self._indexed is None:
+                self._indexed = asyncio.ensure_future(self._scan())
+            await asyncio.shield(self._indexed)
+        data = await self._read(key)
+        if data is not None:
+            self.disk_hits += 1
+            self._remember(key, data)
+            return data
+        fut = self._inflight.get(key)
+        if fut is None:
+            self.misses += 1
+            fut = asyncio.ensure_future(self._fetch(key, fetch))
+            fut.add_done_callback(lambda f: f.cancelled() or f.exception())
+            self._inflight[key] = fut
+        return await asyncio.shield(fut)
+
+    def stats(self) -> Dict[str, Any]:
+        '''
+        @return: Cache counters
+        '''
+        return {
+            'memory_hits' : self.memory_hits,
+            'disk_hits' : self.disk_hits,
+            'misses' : self.misses,
+            'evictions' : self.evictions,
+            'files' : len(self._files),
+            'bytes' : self._size,
+        }
+
+    async def _fetch(self, key: str, fetch: Callable[[], Awaitable[Optional[bytes]]]) -> Optional[bytes]:
+        try:
+            data = await fetch()
+        finally:
+            self._inflight.pop(key, None)
+        if data:
+            self._remember(key, data)
+            await self._write(key, data)
+        return data
+
+    def _remember(self, key: str, data: bytes) -> None:
+        self._memory[key] = data
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f'{key}.png')
+
+    async def _scan(self) -> None:
+        '''
+        Index the files left by a previous run, oldest first
+        '''
+        try:
+            files = await asyncio.get_event_loop().run_in_executor(None, _list_files, self.cache_dir)
+        except OSError as e:
+            self.logger.warning(f"Thumbnail cache disabled, {self.cache_dir} is not usable: {e}")
+            self.max_bytes = 0
+            return
+        for key, size in files:
+            self._files[key] = size
+            self._size += size
+        await self._evict()
+
+    def _touch(self, key: str) -> None:
+        if key in self._files:
+            self._files.move_to_end(key)
+
+    async def _read(self, key: str) -> Optional[bytes]:
+        if key not in self._files:
+            return None
+        self._files.move_to_end(key)
+        try:
+            return await asyncio.get_event_loop().run_in_executor(None, _read_file, self._path(key))
+        except OSError:
+            # evicted meanwhile or removed from the disk
+            if key in self._files:
+                self._size -= self._files.pop(key)
+            return None
+
+    async def _write(self, key: str, data: bytes) -> None:
+        if self.max_bytes <= 0 or len(data) > self.max_bytes:
+            return
+        path = self._path(key)
+        try:
+            await asyncio.get_event_loop().run_in_executor(None, _write_file, path, data)
+        except OSError as e:
+            self.logger.warning(f"Could not cache thumbnail {path}: {e}")
+            return
+        self._size += len(data) - self._files.pop(key, 0)
+        self._files[key] = len(data)
+        await self._evict()
+
+    async def _evict(self) -> None:
+        keys = []
+        while self._size > self.max_bytes and self._files:
+            key, size = self._files.popitem(last=False)
+            self._size -= size
+            self.evictions += 1
+            keys.append(key)
+        if keys:
+            await asyncio.get_event_loop().run_in_executor(None, self._remove, keys)
+
+    def _remove(self, keys: List[str]) -> None:
+        for key in keys:
+            try:
+                os.unlink(self._path(key))
+            except OSError as e:
+                self.logger.debug(f"Could not remove cached thumbnail {key}: {e}")
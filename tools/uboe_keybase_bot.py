@@ -16,22 +16,58 @@
 This is the main program, it fetches all spoolman filaments and generates a user
 profile folder for OrcaSliccer to point to when it starts.
 '''
+from startup_timings import STARTUP
+import getpass
 import json
 import logging as log
 import os
-import subprocess
-import sys, re
-import coloredlogs
-
-import colored_traceback.auto
-import colored_traceback.always
+import sys
 
 import argparse
 
 from KeybaseBot import KeybaseBot
+from log_setup import LOG_FORMAT, setup_logging
+from printer_supervisor import PrinterSupervisor, load_printers
 this_dir = os.path.dirname(os.path.abspath(__file__))
+STARTUP.mark('imports')
+
+
+def colored_excepthook(*exc_info) -> None:
+    '''
+    Print uncaught exceptions with colored_traceback, imported on the first one rather than at startup
+    '''
+    import colored_traceback
+    colored_traceback.add_hook(always=True)
+    sys.excepthook(*exc_info)
+
+
+def console_formatter() -> log.Formatter:
+    '''
+    Colored console output on a terminal, coloredlogs is not loaded when running as a service
+    '''
+    if not sys.stderr.isatty():
+        return log.Formatter(LOG_FORMAT)
+    import coloredlogs
+    return coloredlogs.ColoredFormatter(LOG_FORMAT)
+
 
-log.basicConfig(level=log.DEBUG)
+def git_branch(repo_dir: str) -> str:
+    '''
+    Current branch of the repository, read from .git/HEAD instead of running git
+    @param repo_dir: Repository root
+    @return: Branch name, HEAD when detached, empty if it cannot be read
+    '''
+    git_dir = os.path.join(repo_dir, '.git')
+    try:
+        if os.path.isfile(git_dir):
+            # worktree or submodule: .git points to the actual git directory
+            with open(git_dir, 'r') as file:
+                git_dir = os.path.join(repo_dir, file.read().strip()[len('gitdir: '):])
+        with open(os.path.join(git_dir, 'HEAD'), 'r') as file:
+            head = file.read().strip()
+    except OSError:
+        return ''
+    return head[len('ref: refs/heads/'):] if head.startswith('ref: refs/heads/') else 'HEAD'
 
 
 def main():
@@ -69,36 +105,59 @@ def main():
         choices=['debug', 'info', 'warning', 'error', 'critical', 'DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'],
         help='Logging level'
     )
-    loglvl = getattr(log, parser.parse_args().loglvl.upper())
+    parser.add_argument(
+        '--printers',
+        type=str,
+        default=None,
+        help='JSON file listing the printers served by this process (name, sockpath, camera_config, http_host),\n'
+             'they share a single Keybase session. Without it the local printer is served.'
+    )
+    parser.add_argument(
+        '--log-format',
+        type=str,
+        default='text',
+        choices=['text', 'json'],
+        help='Format of the log file, json writes one JSON object per line'
+    )
+    parser.add_argument(
+        '--log-max-mb',
+        type=float,
+        default=10.,
+        help='Size (in MB) at which the log file is rotated, 0 only rotates it by time'
+    )
+    parser.add_argument(
+        '--log-rotate',
+        type=str,
+        default='midnight',
+        help='Time interval at which the log file is rotated (S, M, H, D, midnight, W0-W6)'
+    )
+    parser.add_argument(
+        '--log-backups',
+        type=int,
+        default=7,
+        help='Rotated log files kept'
+    )
     args = parser.parse_args()
-    # configure logging with colored output
-    # Create a logger object.
+    loglvl = getattr(log, args.loglvl.upper())
+    # console and log file are written by a listener thread, the log file keeps its history across restarts
+    listener = setup_logging(
+        loglvl, os.path.join(this_dir, '..', 'logs', 'keybase_bot.log'), json_lines=args.log_format == 'json',
+        max_bytes=int(args.log_max_mb * 1024 * 1024), when=args.log_rotate, backup_count=args.log_backups,
+        console=console_formatter()
+    )
+    sys.excepthook = colored_excepthook
     logger = log.getLogger(__name__)
+    STARTUP.mark('logging')
 
-    # By default the install() function installs a handler on the root logger,
-    # this means that log messages from your code and log messages from the
-    # libraries that you use will all show up on the terminal.
-    coloredlogs.install(level=args.loglvl)
+    print(banner)
 
-    # If you don't want to see log messages from libraries, you can pass a
-    # specific logger object to the install() function. In this case only log
-    # messages originating from that logger will show up on the terminal.
-    coloredlogs.install(level=args.loglvl, logger=logger)
+    try:
+        run(args, logger)
+    finally:
+        listener.stop()
 
-    print(banner)
 
-    # set the logger up to log into a file aswell as the console
-    # create a file handler
-    handler = log.FileHandler(os.path.join(this_dir, '..', 'logs','keybase_bot.log'))
-    # clear the file
-    open(os.path.join(this_dir, '..', 'logs','keybase_bot.log'), 'w').close()
-    # set the logging level
-    handler.setLevel(loglvl)
-    # create a logging format
-    formatter = log.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-    handler.setFormatter(formatter)
-    # add the handlers to the logger
-    logger.addHandler(handler)
+def run(args, logger):
     # log the start of the program
 
     logger.info('Starting KeybaseBot.py')
@@ -108,11 +167,11 @@ def main():
     logger.info('Called with the following arguments:')
     for arg in vars(args):
         logger.info('	{}: {}'.format(arg, getattr(args, arg)))
-    logger.warning('Working on branch {}'.format(os.popen('git rev-parse --abbrev-ref HEAD').read().strip()))
+    logger.warning('Working on branch {}'.format(git_branch(os.path.join(this_dir, '..'))))
     logger.info('='*80)
     # what linux user is running this script
-    user = subprocess.run(['whoami'], stdout=subprocess.PIPE).stdout.decode('utf-8').strip()
-    log.info(f"Running as user: {user}")
+    user = getpass.getuser()
+    logger.info(f"Running as user: {user}")
     #if /home/user/keybase_bot does not exist, exit with error
     if not os.path.exists(f'/home/{user}/keybase_bot'):
         logger.error(f"Could not find /home/{user}/keybase_bot")
@@ -121,6 +180,12 @@ def main():
     # load api_presets.json from ../common/api_presets.json
     with open(f'/home/{user}/keybase_bot/common/api_presets.json', 'r') as file:
         api_presets = json.load(file)
+    if args.printers:
+        printers = load_printers(args.printers)
+        logger.info(f"Serving printers: {', '.join(p['name'] for p in printers)}")
+        supervisor = PrinterSupervisor(printers, presets=api_presets, paperkey=args.paperkey, logger=logger)
+        supervisor.run()
+        return
     # create a moonraker connection
     kbBot = KeybaseBot(sockpath=f'/home/{user}/printer_data/comms/moonraker.sock', presets=api_presets, paperkey=args.paperkey ,logger=logger)
     # connect to moonraker
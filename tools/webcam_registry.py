@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+'''
+###############################################################################
+##
+## 88        88 88
+## 88        88 88
+## 88        88 88
+## 88        88 88,dPPYba,   ,adPPYba,   ,adPPYba,
+## 88        88 88P'    "8a a8"     "8a a8P_____88
+## 88        88 88       d8 8b       d8 8PP"""""""
+## Y8a.    .a8P 88b,   ,a8" "8a,   ,a8" "8b,   ,aa
+##  `"Y8888Y"'  `"8Ybbd8"'   `"YbbdP"'   `"Ybbd8"'
+##
+###############################################################################
+In-memory copy of the Moonraker webcam list (`server.webcams.list`).
+The list is loaded once and then served from memory until Moonraker reports a
+change (`notify_webcams_changed`) or the optional TTL expires.
+A caller fetching the list itself (e.g. within a batch of requests) announces it
+with expect(), lookups made meanwhile wait for that fetch.
+'''
+from __future__ import annotations
+import asyncio
+import time
+import logging
+
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+
+class WebcamRegistry:
+    def __init__(
+        self,
+        loader: Callable[[], Awaitable[List[Dict[str, Any]]]],
+        ttl: float = 0.,
+        logger: Optional[logging.Logger] = None
+    ) -> None:
+        '''
+        @param loader: Coroutine function returning the webcam list from Moonraker
+        @param ttl: Maximum age (in seconds) of the cached list, 0 disables expiry
+        @param logger: Logger instance
+        '''
+        self.loader = loader
+        self.ttl = ttl
+        self.logger = logger or logging.getLogger(__name__)
+        self._webcams: Optional[List[Dict[str, Any]]] = None
+        self._loaded_at: float = 0.
+        self._loading: Optional[asyncio.Future] = None
+        self._generation: int = 0
+
+    @property
+    def is_fresh(self) -> bool:
+        if self._webcams is None:
+            return False
+        return not self.ttl or time.monotonic() - self._loaded_at < self.ttl
+
+    async def get(self) -> List[Dict[str, Any]]:
+        '''
+        Get the webcam list, loading it from Moonraker only if needed.
+        Concurrent callers share a single load.
+        @return: List of webcam configurations
+        '''
+        if self.is_fresh:
+            return self._webcams
+        if self._loading is None:
+            asyncio.ensure_future(self._load(self.expect()))
+        # shield the shared load so that a cancelled caller does not cancel it for the others
+        return await asyncio.shield(self._loading)
+
+    async def get_snapshot_url(self, id) -> Optional[str]:
+        '''
+        Get the snapshot url of a camera
+        @param id: Camera id (1 based index in the Moonraker webcam list)
+        @return: Snapshot url or None if the camera is unknown
+        '''
+        webcams = await self.get()
+        try :
+            return webcams[int(id)-1]['snapshot_url']
+        except (IndexError, KeyError, ValueError) :
+            self.logger.error(f"Camera {id} not found")
+            return None
+
+    def expect(self) -> Optional[asyncio.Future]:
+        '''
+        Announce that the caller fetches the list itself, lookups made meanwhile wait for it
+        rather than sending their own request.
+        @return: Future to complete with the list (or an exception), None if a load is already in progress
+        '''
+        if self._loading is not None:
+            return None
+        generation = self._generation
+        fut = asyncio.get_event_loop().create_future()
+
+        def loaded(fut : asyncio.Future) -> None:
+            self._loading = None
+            # do not overwrite a list pushed or invalidated while loading
+            if not fut.cancelled() and fut.exception() is None and generation == self._generation:
+                self.update(fut.result())
+
+        fut.add_done_callback(loaded)
+        self._loading = fut
+        return fut
+
+    def update(self, webcams: List[Dict[str, Any]]) -> None:
+        '''
+        Replace the cached list (e.g. from a notify_webcams_changed payload)
+        @param webcams: New webcam list
+        '''
+        self._generation += 1
+        self._webcams = list(webcams)
+        self._loaded_at = time.monotonic()
+        self.logger.debug(f"Webcam list updated ({len(self._webcams)} webcams)")
+
+    def invalidate(self) -> None:
+        '''
+        Drop the cached list, the next lookup reloads it from Moonraker
+        '''
+        self._generation += 1
+        self._webcams = None
+
+    async def _load(self, fut : asyncio.Future) -> None:
+        try :
+            fut.set_result(await self.loader())
+        except asyncio.CancelledError:
+            fut.cancel()
+            raise
+        except Exception as e :
+            fut.set_exception(e)